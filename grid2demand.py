@@ -19,11 +19,30 @@ import math
 import csv
 import locale
 import sys
+import shutil
+import tempfile
+import hashlib
+import json
+import time
+import platform
+import functools
+import tracemalloc
 from pprint import pprint
 from collections import defaultdict
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 import logging
-import random
-from random import choice
+try:
+    import scipy.sparse
+    import scipy.sparse.csgraph
+    import scipy.spatial
+except ImportError:  # comments: scipy is only needed for the sparse OD mode and network impedances
+    scipy = None
+try:
+    import resource
+except ImportError:  # comments: resource is not available on Windows, where the peak rss is not reported
+    resource = None
 
 
 class Node:
@@ -111,406 +130,1370 @@ class Link:
         self.geometry = None
 
 
-# create a logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+class NodeTable: # comments: columnar store of network nodes, one numpy array per node attribute
+    def __init__(self, number_of_nodes=0):
+        self.id = np.zeros(number_of_nodes, dtype=np.int64)
+        self.osm_node_id = np.full(number_of_nodes, None, dtype=object)
+        self.x_coord = np.zeros(number_of_nodes)
+        self.y_coord = np.zeros(number_of_nodes)
+        self.boundary_flag = np.zeros(number_of_nodes, dtype=np.int64)
+        self.activity_type = np.full(number_of_nodes, '', dtype=object)
+        self.activity_tab = np.zeros(number_of_nodes, dtype=np.int8)  # comments: index in g_activity_location_tab_list
+        self.poi_id = np.full(number_of_nodes, -1, dtype=np.int64)  # comments: = -1 (current node is not poi node)
+        self.zone_index = np.full(number_of_nodes, -1, dtype=np.int64)  # comments: index in zone_id_list, -1 if no zone
+        self.production = np.zeros(number_of_nodes)
+        self.attraction = np.zeros(number_of_nodes)
+        self.zone_id_list = []  # comments: zone ids of the model which owns the table
+        self.zone_index_dict = {}
+
+    def __len__(self):
+        return len(self.id)
+
+
+class POITable: # comments: columnar store of pois, one numpy array per poi attribute
+    def __init__(self, number_of_pois=0):
+        self.id = np.zeros(number_of_pois, dtype=np.int64)
+        self.x_coord = np.zeros(number_of_pois)
+        self.y_coord = np.zeros(number_of_pois)
+        self.area = np.zeros(number_of_pois)
+        self.type = np.full(number_of_pois, '', dtype=object)
+        self.zone_index = np.full(number_of_pois, -1, dtype=np.int64)  # comments: index in zone_id_list, -1 if no zone
+        self.zone_id_list = []  # comments: zone ids of the model which owns the table
+        self.zone_index_dict = {}
+
+    def __len__(self):
+        return len(self.id)
+
+
+class _RowView:
+    """ a row of a columnar table viewed as an object, for backward compatibility with Node and POI """
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_index', index)
+
+    def __getattr__(self, name):
+        value = getattr(self._table, name)[self._index]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __setattr__(self, name, value):
+        if isinstance(getattr(type(self), name, None), property):
+            object.__setattr__(self, name, value)
+        else:
+            getattr(self._table, name)[self._index] = value
 
-"""PART 1  READ INPUT NETWORK FILES"""
-g_node_list = []
-g_boundary_node_list = []
-g_outside_boundary_node_list = [] # comments: nodes outside the study area 
-g_poi_list = []
-g_poi_id_type_dict = {}
-g_poi_id_area_dict = {}
-g_outside_boundary_node_id_index = {}
-g_output_folder = ''
-g_node_id_to_node = {}
-g_node_id_to_index = {}
-g_poi_map = {}
-g_average_latitude = 0
+    def __eq__(self, other):
+        return type(self) is type(other) and self._table is other._table and self._index == other._index
 
+    def __hash__(self):
+        return hash((id(self._table), self._index))
 
-def ReadNetworkFiles(input_folder=None):
-    global g_poi_id_type_dict
-    global g_poi_id_area_dict
-    global g_output_folder
-    global g_average_latitude
-
-    if input_folder:
-        node_filepath = os.path.join(input_folder, 'node.csv')
-        poi_filepath = os.path.join(input_folder, 'poi.csv')
-        g_output_folder = input_folder
-        logfile = os.path.join(g_output_folder, 'log.txt')
-    else:
-        node_filepath = 'node.csv'
-        poi_filepath = 'poi.csv'
-        logfile = 'log.txt'
-
-    # create a handler to write the log file
-    fh = logging.FileHandler(logfile, mode='w')
-    fh.setLevel(logging.DEBUG)
-
-    # create a handler to print out in console
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.WARNING)
-
-    # define output format
-    formatter = logging.Formatter('%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
-    fh.setFormatter(formatter)
-    ch.setFormatter(formatter)
-
-    # add handler to logger
-    logger.addHandler(fh)
-    logger.addHandler(ch)
-
-    logger.debug('Starting ReadNetworkFiles')
-
-    with open(node_filepath, errors='ignore') as fp:
-        reader = csv.DictReader(fp)
-        exclude_boundary_node_index = 0
-        poi_flag = 0
-        log_flag = 0
-        index = 0
-        for line in reader:
-            node = Node()
-            node_id = line['node_id']
-            if node_id:
-                node.id = int(node_id)
-                g_node_id_to_index[node.id] = index
-            else:
-                # print('Error: node_id is not defined in node.csv, please check it!')
-                logger.error("node_id is not defined in node.csv, please check it!")
-                sys.exit(0)
 
-            osm_node_id = line['osm_node_id']
-            if osm_node_id:
-                node.osm_node_id = str(osm_node_id)
-            else:
-                node.osm_node_id = None
-
-            activity_type = line['activity_type']
-            if activity_type:
-                node.activity_type = str(activity_type)
-                if node.activity_type == 'residential':
-                    node.activity_location_tab = 'residential'
-                if node.activity_type == 'poi':
-                    node.activity_location_tab = 'poi'
-                if node.activity_type == 'centroid node':
-                    continue
-
-            x_coord = line['x_coord']
-            if x_coord:
-                node.x_coord = round(float(x_coord),7)
-            else:
-                # print('Error: x_coord is not defined in node.csv, please check it!')
-                logger.error("x_coord is not defined in node.csv, please check it!")
-                sys.exit(0)
+class NodeView(_RowView): # comments: a node of a NodeTable with the same attributes as Node
+    __slots__ = ()
+    node_type = ''
 
-            y_coord = line['y_coord']
-            if y_coord:
-                node.y_coord = round(float(y_coord),7)
-            else:
-                # print('Error: y_coord is not defined in node.csv, please check it!')
-                logger.error("y_coord is not defined in node.csv, please check it!")
-                sys.exit(0)
+    @property
+    def zone_id(self):
+        zone_index = self._table.zone_index[self._index]
+        return str(self._table.zone_id_list[zone_index]) if zone_index >= 0 else None
 
-            poi_id = line['poi_id']
-            if poi_id:
-                node.poi_id = str(poi_id)
-                try:
-                    # print(int(float(poi_id)))
-                    poi_flag = int(float(poi_id)) # comments: = 1 if poi_id exists
-                except:
-                    continue
+    @zone_id.setter
+    def zone_id(self, value):
+        self._table.zone_index[self._index] = self._table.zone_index_dict[int(value)] if value is not None else -1
 
-            boundary_flag = line['is_boundary']
-            if boundary_flag:
-                node.boundary_flag = int(float(boundary_flag))
-                if node.boundary_flag == 1:
-                    node.activity_location_tab = 'boundary'
-            else:
-                logger.info("is_boundary is not defined in node.csv. Default value is 0.")
-                node.boundary_flag = 0
+    @property
+    def poi_id(self):
+        poi_id = self._table.poi_id[self._index]
+        return str(poi_id) if poi_id >= 0 else ''
 
-            g_node_id_to_node[node.id] = node
-            g_node_list.append(node)
+    @poi_id.setter
+    def poi_id(self, value):
+        self._table.poi_id[self._index] = int(float(value)) if value != '' else -1
 
-            if node.boundary_flag == 1:
-                g_boundary_node_list.append(node)
-            else:
-                g_outside_boundary_node_list.append(node) # comments: outside boundary node
-                g_outside_boundary_node_id_index[node.id] = exclude_boundary_node_index
-                exclude_boundary_node_index += 1
+    @property
+    def activity_location_tab(self):
+        return g_activity_location_tab_list[self._table.activity_tab[self._index]]
 
-            index += 1
+    @activity_location_tab.setter
+    def activity_location_tab(self, value):
+        self._table.activity_tab[self._index] = g_activity_location_tab_list.index(value)
 
-        if poi_flag == 0: 
-            if (log_flag == 0):
-                print('Field poi_id is not in node.csv. Please check it!')
-                logger.warning('Field poi_id is NOT defined in node.csv. Please check node.csv! \
-                    It could lead to empty demand volume and zero agent. \
-                    Please ensure to POIs=True in osm2gmns: \
-                    net = og.getNetFromOSMFile')
-                log_flag = 1
 
-        try:
-            g_latitude_list = [node.y_coord for node in g_node_list]
-            g_average_latitude = sum(g_latitude_list) / len(g_latitude_list)
-        except:
-            g_average_latitude = 99
-            print('Please check y_coord in node.csv!')
-            logger.warning('Please check y_coord in node.csv!')
+class POIView(_RowView): # comments: a poi of a POITable with the same attributes as POI
+    __slots__ = ()
+    count = 1
 
-    with open(poi_filepath, errors='ignore') as fp:
-        reader = csv.DictReader(fp)
-        for line in reader:
-            poi = POI()
+    @property
+    def zone_id(self):
+        zone_index = self._table.zone_index[self._index]
+        return str(self._table.zone_id_list[zone_index]) if zone_index >= 0 else 0
 
-            poi_id = line['poi_id']
-            if poi_id:
-                poi.id = int(poi_id)
-            else:
-                logger.error("poi_id is not defined in poi.csv, please check it!")
-                sys.exit(0)
+    @zone_id.setter
+    def zone_id(self, value):
+        self._table.zone_index[self._index] = self._table.zone_index_dict[int(value)] if value else -1
 
-            centroid = line['centroid']
-            if centroid:
-                temp_centroid = str(centroid)
-            else:
-                # print('Error: centroid is not defined in poi.csv, please check it!')
-                logger.error("centroid is not defined in poi.csv, please check it!")
-                sys.exit(0)
-            str_centroid = temp_centroid.replace('POINT (', '').replace(')', '').replace(' ', ';').strip().split(';')
-
-            x_coord = str_centroid[0]
-            if x_coord:
-                poi.x_coord = float(x_coord)
-            else:
-                # print('Error: x_coord is not defined in poi.csv, please check it!')
-                logger.error("x_coord is not defined in poi.csv, please check it!")
-                sys.exit(0)
 
-            y_coord = str_centroid[1]
-            if y_coord:
-                poi.y_coord = float(y_coord)
-            else:
-                # print('Error: y_coord is not defined in poi.csv, please check it!')
-                logger.error("y_coord is not defined in poi.csv, please check it!")
-                sys.exit(0)
+class _RowViewList(Sequence):
+    """ a list of rows of a columnar table, where each row is created as a view when it is accessed """
+    def __init__(self, view_class, table, index_array):
+        self._view_class = view_class
+        self._table = table
+        self._index_array = np.asarray(index_array, dtype=np.int64)
 
+    def __len__(self):
+        return len(self._index_array)
 
-            area = line['area']
-            if area:
-                area_meter = float(area)
-            else:
-                # print('Error: area is not defined in poi.csv, please check it!')
-                logger.error('area is not defined for POI No.' + str(poi_id) + ' in poi.csv, please check it!')
-                sys.exit(0)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return _RowViewList(self._view_class, self._table, self._index_array[i])
+        return self._view_class(self._table, int(self._index_array[i]))
 
-            if area_meter > 90000:  # comments: a simple benchmark to exclude extra large poi nodes
-                poi.area = 0
-                area_feet = 0
-            else:
-                poi.area = area_meter
-                area_feet = area_meter * 10.7639104  # comments: convert the area in square meters to square feet
-                # poi.area = area_feet  # comments: convert the area unit of normal poi nodes to square feet
+    def __iter__(self):
+        for index in self._index_array.tolist():
+            yield self._view_class(self._table, index)
+
+
+class _RowViewDict(Mapping):
+    """ a dict from id to the row of a columnar table, where each row is created as a view when it is accessed """
+    def __init__(self, view_class, table, id_to_index_dict):
+        self._view_class = view_class
+        self._table = table
+        self._id_to_index_dict = id_to_index_dict
+
+    def __getitem__(self, key):
+        return self._view_class(self._table, self._id_to_index_dict[key])
 
-            building = line['building']
-            if building:
-                poi.type = str(building)
+    def __iter__(self):
+        return iter(self._id_to_index_dict)
 
+    def __len__(self):
+        return len(self._id_to_index_dict)
+
+
+# create a logger
+# comments: each DemandModel logs to a logger of its own with the handlers of its own output folder
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
-            g_poi_id_area_dict[poi.id] = area_feet
-            g_poi_id_type_dict[poi.id] = poi.type
-            g_poi_list.append(poi)
+"""PART 1  READ INPUT NETWORK FILES"""
+g_activity_location_tab_list = ['', 'residential', 'poi', 'boundary']
 
-            g_poi_map[poi.id] = g_poi_list.index(poi)
 
-    logger.debug('Ending ReadNetworkFiles')
+def _ReadNetworkCSV(filepath, column_list, str_column_list):
+    """ read the given columns of a csv file, where empty cells are NaN and columns in str_column_list are str """
+    # comments: columns which do not exist in the file are not returned
+    return pd.read_csv(filepath, usecols=lambda column: column in column_list,
+                       dtype={column: str for column in str_column_list},
+                       keep_default_na=False, na_values=[''], float_precision='round_trip',
+                       encoding_errors='ignore')
 
 
 """PART 2  GRID GENERATION"""
-g_zone_list = []
-g_number_of_zones = 0
-g_zone_id_list = []
-g_zone_index_dict = {}
-g_node_zone_dict = {}
-g_poi_zone_dict = {}
-g_used_latitude = 0
 
 
 g_scale_list = [0.006, 0.005, 0.004, 0.003, 0.002, 0.001] # comments: default the scale for each grid zone
 g_degree_length_dict = {60: 55.8, 51: 69.47, 45: 78.85, 30: 96.49,
                         0: 111.3}  
 # comments: default longitudinal length (km) equivalent at selected latitude
+g_distance_method_list = ['latitude_table', 'equirectangular', 'haversine']
+g_earth_radius = 6371.0088  # comments: mean radius of the earth (km)
+
+
+def _CheckDistanceMethod(distance_method, logger=logger):
+    if distance_method not in g_distance_method_list:
+        logger.error('Distance method ' + str(distance_method) + ' is not supported! Please choose from ' +
+                     str(g_distance_method_list) + '.')
+        sys.exit(0)
+
+
+def _GetDegreeLength(latitude, distance_method='latitude_table'):
+    """ get the length (km) of one degree of longitude and of one degree of latitude at a latitude """
+    # comments: 'latitude_table' takes the length of g_degree_length_dict for both, where latitude is one of its keys
+    if distance_method == 'latitude_table':
+        return g_degree_length_dict[latitude], g_degree_length_dict[latitude]
+    degree_length = g_earth_radius * math.pi / 180
+    return degree_length * math.cos(math.radians(latitude)), degree_length
+
+
+def _GetDistance(x1, y1, x2, y2, degree_length, distance_method='latitude_table'):
+    """ get the distance (km) between points given by longitude and latitude, with numpy broadcasting """
+    # comments: 'haversine' is the great-circle distance, and the other methods scale the coordinate differences by
+    # degree_length of _GetDegreeLength, which is the local equirectangular projection for 'equirectangular'.
+    # The result has the float type of the coordinates
+    if distance_method == 'haversine':
+        y1_radian = np.radians(y1)
+        y2_radian = np.radians(y2)
+        haversine = np.sin((y2_radian - y1_radian) / 2) ** 2 + \
+            np.cos(y1_radian) * np.cos(y2_radian) * np.sin(np.radians(x2 - x1) / 2) ** 2
+        return 2 * g_earth_radius * np.arcsin(np.sqrt(np.minimum(haversine, 1)))
+    return (((x1 - x2) * degree_length[0]) ** 2 + ((y1 - y2) * degree_length[1]) ** 2) ** 0.5
+
+
+g_poi_category_type_list = [['apartments', 'dormitory', 'house', 'residential'],  # residential
+                            ['office', 'industrial'],  # office
+                            ['commercial', 'retail', 'supermarket', 'warehouse'],  # shopping
+                            ['school', 'kindergarten', 'university', 'college', 'university;yes'],  # school
+                            ['parking', 'garage', 'garages', 'bicycle_parking']]  # parking
+# comments: poi types counted in each category of zone.csv
 
 alphabet_list = []
 for letter in range(65, 91):
     alphabet_list.append(chr(letter))
 
 
-def PartitionGrid(number_of_x_blocks=None,
-                  number_of_y_blocks=None,
-                  cell_width=None,
-                  cell_height=None,
-                  latitude=None,
-                  connector=True):
-    logger.debug('Starting PartitionGrid')
+def _GetBlockMembership(x_array, y_array, block_bound_array, block_index_grid, x_origin, y_origin, scale_x, scale_y):
+    """ get (point index, block index) pairs of points inside blocks, sorted by block index and then point index """
+    # comments: the grid index of a point may be off by one due to rounding of block boundaries,
+    # so the point is checked against the exact boundary of its own block and the eight neighboring blocks
+    row_array = np.floor((y_origin - y_array) / scale_y).astype(int)
+    col_array = np.floor((x_array - x_origin) / scale_x).astype(int)
+    number_of_rows, number_of_cols = block_index_grid.shape
+    point_index_list = []
+    block_index_list = []
+    for delta_row in (-1, 0, 1):
+        for delta_col in (-1, 0, 1):
+            row = row_array + delta_row
+            col = col_array + delta_col
+            point_index = np.nonzero((row >= 0) & (row < number_of_rows) & (col >= 0) & (col < number_of_cols))[0]
+            block_index = block_index_grid[row[point_index], col[point_index]]
+            point_index = point_index[block_index >= 0]
+            block_index = block_index[block_index >= 0]
+            x_coord = x_array[point_index]
+            y_coord = y_array[point_index]
+            inside = (x_coord <= block_bound_array[block_index, 1]) & (x_coord >= block_bound_array[block_index, 0]) \
+                & (y_coord <= block_bound_array[block_index, 3]) & (y_coord >= block_bound_array[block_index, 2])
+            point_index_list.append(point_index[inside])
+            block_index_list.append(block_index[inside])
+
+    point_index_array = np.concatenate(point_index_list)
+    block_index_array = np.concatenate(block_index_list)
+    order = np.lexsort((point_index_array, block_index_array))
+    return point_index_array[order], block_index_array[order]
+
+
+def _GetGateMembership(coord_array, gate_index_array, gate_bound_array):
+    """ get (point index, gate index) pairs of points inside gates along one side, sorted by gate index """
+    # comments: the gate index of a point may be off by one due to rounding of gate boundaries,
+    # so the point is checked against the exact boundary of its own gate and the two neighboring gates
+    number_of_gates = len(gate_bound_array)
+    point_index_list = []
+    gate_index_list = []
+    for delta in (-1, 0, 1):
+        gate_index = gate_index_array + delta
+        point_index = np.nonzero((gate_index >= 0) & (gate_index < number_of_gates))[0]
+        gate_index = gate_index[point_index]
+        coord = coord_array[point_index]
+        inside = (coord <= gate_bound_array[gate_index, 1]) & (coord >= gate_bound_array[gate_index, 0])
+        point_index_list.append(point_index[inside])
+        gate_index_list.append(gate_index[inside])
+
+    point_index_array = np.concatenate(point_index_list)
+    gate_index_array = np.concatenate(gate_index_list)
+    order = np.lexsort((point_index_array, gate_index_array))
+    return point_index_array[order], gate_index_array[order]
 
-    # Error: Given grid scales and number of blocks simultaneously
-    if ((number_of_x_blocks is not None) and (number_of_y_blocks is not None) \
-            and (cell_width is not None) and (cell_height is not None)):
-        logger.error('Grid scales and number of blocks can only choose ONE to customize!')
-        sys.exit(0)
 
-    global g_number_of_zones 
-    global g_zone_id_list
-    global g_zone_index_dict
-    global g_node_zone_dict
-    global g_used_latitude
-    global g_average_latitude
-
-    # initialize parameters
-    x_max = max(node.x_coord for node in g_outside_boundary_node_list)
-    x_min = min(node.x_coord for node in g_outside_boundary_node_list)
-    y_max = max(node.y_coord for node in g_outside_boundary_node_list)
-    y_min = min(node.y_coord for node in g_outside_boundary_node_list)
-
-    if latitude is None:  # use the average latitude according to node.csv
-        if g_average_latitude == 99:
-            latitude = 30  # comments: default value if no given latitude value
-            flat_length_per_degree_km = g_degree_length_dict[latitude]
-            g_used_latitude = latitude
-            logger.warning('Please check y_coord in node.csv! Default latitude is 30 degree!')
+"""PART 3  TRIP GENERATION"""
+trip_purpose_list = [1, 2, 3]
+
+
+"""PART 4  CALCULATE ACCESSIBILITY"""
+g_output_format_list = ['csv', 'npy', 'parquet']  # comments: supported formats of OD outputs
+g_impedance_list = ['distance', 'time']  # comments: network impedances, shortest path length (km) or free-flow time (min)
+g_default_free_speed = 30  # comments: free speed (km/h) of connectors and of links without free_speed
+g_table_output_format_list = ['csv', 'parquet']  # comments: supported formats of the other outputs
+g_geometry_column_list = ['geometry', 'centroid']  # comments: wkt columns, which parquet files can omit
+
+
+def _GetOutputFormatList(output_format, supported_format_list=None, logger=logger):
+    """ get the list of output formats from a format name or a list of format names """
+    if supported_format_list is None:
+        supported_format_list = g_output_format_list
+    if output_format is None:
+        output_format_list = ['csv']
+    elif isinstance(output_format, str):
+        output_format_list = [output_format]
+    else:
+        output_format_list = list(output_format)
+    for item in output_format_list:
+        if item not in supported_format_list:
+            logger.error('Output format ' + str(item) + ' is not supported! Please choose from ' +
+                         str(supported_format_list) + '.')
+            sys.exit(0)
+    return output_format_list
+
+
+def _IsSparse(od_matrix):
+    """ check whether a zone-by-zone matrix is stored as a scipy sparse matrix """
+    return (scipy is not None) and scipy.sparse.issparse(od_matrix)
+
+
+def _GetSparseDistanceMatrix(centroid_x_array, centroid_y_array, degree_length, distance_cutoff,
+                             distance_method='latitude_table'):
+    """ get the csr matrix of straight distances between zone centroids which are within distance_cutoff in km """
+    # comments: the pairs are found with a kd-tree on the centroids in km, so the dense matrix is never built, and
+    # their distances are computed by _GetDistance in the same way as the dense matrix of ProduceAccessMatrix
+    search_distance = distance_cutoff
+    x_length = degree_length[0]
+    if distance_method == 'haversine':
+        # comments: the kd-tree takes the shortest degree of longitude among the centroids and a margin, so that it
+        # finds all pairs within the great-circle distance
+        x_length = degree_length[1] * float(np.cos(np.radians(np.abs(centroid_y_array).max())))
+        search_distance = distance_cutoff * 1.01
+    coord_array = np.column_stack((centroid_x_array * x_length, centroid_y_array * degree_length[1]))
+    kd_tree = scipy.spatial.cKDTree(coord_array)
+    pair_array = kd_tree.sparse_distance_matrix(kd_tree, search_distance, output_type='ndarray')
+    o_zone_index, d_zone_index = pair_array['i'], pair_array['j']
+    distance_array = _GetDistance(centroid_x_array[o_zone_index], centroid_y_array[o_zone_index],
+                                  centroid_x_array[d_zone_index], centroid_y_array[d_zone_index], degree_length,
+                                  distance_method)
+    pair_flag = distance_array <= distance_cutoff
+    # comments: intra-zone pairs are stored with an explicit distance of 0
+    distance_matrix = scipy.sparse.coo_matrix((distance_array[pair_flag],
+                                               (o_zone_index[pair_flag], d_zone_index[pair_flag])),
+                                              shape=(len(coord_array), len(coord_array))).tocsr()
+    distance_matrix.sort_indices()
+    return distance_matrix
+
+
+g_skim_memory_budget = 256 * 1024 ** 2  # comments: bytes of the result of one dijkstra call, a row per origin zone
+g_skim_context = None  # comments: (graph, source and sink indexes, shared memory blocks) in a worker process of skims
+
+
+def _ShareArrays(array_list):
+    """ copy arrays to new shared memory blocks, and get the blocks and the (name, shape, dtype) of each array """
+    shared_memory_list = []
+    array_info_list = []
+    for array in array_list:
+        shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory.buf)[...] = array
+        shared_memory_list.append(shared_memory)
+        array_info_list.append((shared_memory.name, array.shape, array.dtype.str))
+    return shared_memory_list, array_info_list
+
+
+def _InitSkimWorker(array_info_list):
+    """ attach the csr graph and centroid indexes shared by _ShareArrays in a worker process without copying them """
+    global g_skim_context
+    shared_memory_list = [SharedMemory(name=name) for name, shape, dtype in array_info_list]
+    indptr, indices, data, source_index_array, sink_index_array = \
+        [np.ndarray(shape, dtype=dtype, buffer=shared_memory.buf)
+         for shared_memory, (name, shape, dtype) in zip(shared_memory_list, array_info_list)]
+    graph = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, len(indptr) - 1), copy=False)
+    g_skim_context = (graph, source_index_array, sink_index_array, shared_memory_list)
+
+
+def _ComputeSkimBlock(o_zone_index_list, limit=np.inf, skim_filepath=None, context=None):
+    """ compute the shortest path impedance from the centroids of the given origin zones to all centroids """
+    # comments: if limit is inf, the rows of the origin zones are written to the .npy file skim_filepath, otherwise
+    # only the pairs within limit are returned as (o, d, impedance) arrays
+    graph, source_index_array, sink_index_array = (g_skim_context if context is None else context)[:3]
+    # comments: the rows of dijkstra over all graph nodes are cut to the sink columns at once, so only one block of
+    # them is held at a time
+    skim_block = scipy.sparse.csgraph.dijkstra(graph, directed=True, indices=source_index_array[o_zone_index_list],
+                                               limit=limit)[:, sink_index_array]
+    # comments: the source and sink of a zone are joined through its own activity nodes, and intra-zone pairs keep
+    # an impedance of 0 as the straight distance does
+    skim_block[np.arange(len(o_zone_index_list)), o_zone_index_list] = 0
+    if np.isinf(limit):
+        skim_matrix = np.load(skim_filepath, mmap_mode='r+')
+        skim_matrix[o_zone_index_list[0]:o_zone_index_list[-1] + 1] = skim_block
+        skim_matrix.flush()
+        return None
+    o_index, d_zone_index = np.nonzero(np.isfinite(skim_block))
+    return np.asarray(o_zone_index_list)[o_index], d_zone_index, skim_block[o_index, d_zone_index]
+
+
+def _GetODPairIndex(od_matrix, position):
+    """ get the origin and destination zone index of the position-th value of a zone-by-zone matrix """
+    if _IsSparse(od_matrix):
+        return int(np.searchsorted(od_matrix.indptr, position, side='right')) - 1, int(od_matrix.indices[position])
+    return divmod(int(position), od_matrix.shape[1])
+
+
+class _ParquetWriter:
+    """ write data frames one after another as row groups of a parquet file """
+    def __init__(self, filepath, geometry=True, logger=logger):
+        # comments: pyarrow is only needed for parquet outputs, so it is imported here, and a missing pyarrow is
+        # reported to the logger of the calling model
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logger.error("pyarrow is not installed! Please install it by pip install pyarrow for output_format "
+                         "'parquet'.")
+            sys.exit(0)
+        self.pyarrow = pyarrow
+        self.filepath = filepath
+        self.geometry = geometry  # comments: wkt columns are omitted if geometry is False
+        self.schema = None
+        self.writer = None
+
+    def write(self, data):
+        if not self.geometry:
+            data = data.drop(columns=[column for column in g_geometry_column_list if column in data.columns])
+        if self.schema is None:
+            # comments: the column types are fixed by the first data frame, where columns without any value are strings
+            schema = self.pyarrow.Schema.from_pandas(data, preserve_index=False)
+            self.schema = self.pyarrow.schema([self.pyarrow.field(field.name, self.pyarrow.string())
+                                               if self.pyarrow.types.is_null(field.type) else field
+                                               for field in schema])
+        table = self.pyarrow.Table.from_pandas(data, schema=self.schema, preserve_index=False)
+        # comments: names of zones and types are dictionary-encoded, so each distinct name is stored once per row group
+        for i, column in enumerate(table.column_names):
+            if column.endswith('name') and self.pyarrow.types.is_string(table.schema.field(i).type):
+                table = table.set_column(i, column, table.column(i).dictionary_encode())
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.filepath, table.schema)
+        self.writer.write_table(table)
+
+    def write_file(self, filepath):
+        """ append the row groups of a parquet file written by another _ParquetWriter with the same columns """
+        parquet_file = self.pyarrow.parquet.ParquetFile(filepath)
+        for i in range(parquet_file.num_row_groups):
+            table = parquet_file.read_row_group(i)
+            if self.writer is None:
+                self.writer = self.pyarrow.parquet.ParquetWriter(self.filepath, table.schema)
+            self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+"""PART 5  TRIP DISTRIBUTION"""
+g_friction_factor_coefficient_dict = {1: (28507, -0.02, -0.123),  # comments: default (a, b, c) of each trip purpose
+                                      2: (139173, -1.285, -0.094),
+                                      3: (219113, -1.332, -0.1)}
+
+
+def _RunGravityKernel(distance_matrix, zone_production, zone_attraction, a, b, c, friction_cutoff=None,
+                      log_distance_matrix=None):
+    """ get the friction matrix and trip matrix of the production-constrained gravity model """
+    # comments: friction factor follows the gamma function a * d^b * e^(c*d), and is 0 for intra-zone pairs and
+    # for pairs with a friction factor below friction_cutoff
+    # comments: log_distance_matrix is log(d) computed once by the caller for many coefficients, and the friction
+    # factor is then taken as a * e^(b*log(d) + c*d) with one exp instead of a power and an exp
+    if _IsSparse(distance_matrix):
+        return _RunSparseGravityKernel(distance_matrix, zone_production, zone_attraction, a, b, c, friction_cutoff,
+                                       log_distance_matrix)
+    distance_matrix = np.asarray(distance_matrix, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if log_distance_matrix is None:
+            friction_matrix = np.where((distance_matrix != 0) & (distance_matrix != np.inf),
+                                       a * (distance_matrix ** b) * np.exp(c * distance_matrix), 0)
         else:
-            # match the closest latitude key according to the given latitude
-            dif = float('inf')
-            for i in g_degree_length_dict.keys():
-                if abs(abs(g_average_latitude) - i) < dif:
-                    temp_latitude = i
-                    dif = abs(abs(g_average_latitude) - i)
-                    g_used_latitude = temp_latitude
-            flat_length_per_degree_km = g_degree_length_dict[temp_latitude]
-    else:  # use the given latitude
-        # match the closest latitude key according to the given latitude
-        dif = float('inf')
-        for i in g_degree_length_dict.keys():
-            if abs(abs(latitude) - i) < dif:
-                temp_latitude = i
-                dif = abs(abs(latitude) - i)
-                g_used_latitude = temp_latitude
-        flat_length_per_degree_km = g_degree_length_dict[temp_latitude]
-
-
-    print('\nLatitude used for grid partition = ', g_used_latitude)
-    logger.info('Latitude used for grid partition = ' + str(g_used_latitude))
-
-    # Case 0: Default
-    if (number_of_x_blocks is None) and (number_of_y_blocks is None) \
-            and (cell_width is None) and (cell_height is None):
-        logger.warning('Default cell width and height are the length on a flat surface under a specific latitude '
-                       'corresponding to the degree of 0.006!')
-        scale_x = g_scale_list[0]
-        scale_y = g_scale_list[0]
-        x_max = math.ceil(x_max / scale_x) * scale_x
-        x_min = math.floor(x_min / scale_x) * scale_x
-        y_max = math.ceil(y_max / scale_y) * scale_y
-        y_min = math.floor(y_min / scale_y) * scale_y
-        number_of_x_blocks = round((x_max - x_min) / scale_x)
-        number_of_y_blocks = round((y_max - y_min) / scale_y)
-
-    # Case 1: Given number_of_x_blocks and number_of_y_blocks
-    if (number_of_x_blocks is not None) and (number_of_y_blocks is not None) \
-            and (cell_width is None) and (cell_height is None):
-        scale_x = round((x_max - x_min) / number_of_x_blocks, 5) + 0.00001
-        scale_y = round((y_max - y_min) / number_of_y_blocks, 5) + 0.00001
-        x_max = round(x_min + scale_x * number_of_x_blocks, 5)
-        y_min = round(y_max - scale_y * number_of_y_blocks, 5)
-
-    # Case 2: Given scale_x and scale_y in meter
-    if (number_of_x_blocks is None) and (number_of_y_blocks is None) \
-            and (cell_width is not None) and (cell_height is not None):
-        scale_x = round(cell_width / (1000 * flat_length_per_degree_km), 5)
-        scale_y = round(cell_height / (1000 * flat_length_per_degree_km), 5)
-        x_max = round(math.ceil(x_max / scale_x) * scale_x, 5)
-        x_min = round(math.floor(x_min / scale_x) * scale_x, 5)
-        y_max = round(math.ceil(y_max / scale_y) * scale_y, 5)
-        y_min = round(math.floor(y_min / scale_y) * scale_y, 5)
-        number_of_x_blocks = round((x_max - x_min) / scale_x)
-        number_of_y_blocks = round((y_max - y_min) / scale_y)
-
-    block_numbers = number_of_x_blocks * number_of_y_blocks
-    x_temp = round(x_min, 5)
-    y_temp = round(y_max, 5)
-
-    for block_no in range(1, block_numbers + 1):
-        block = Zone()
-        block.id = block_no
-        block.x_min = x_temp
-        block.x_max = x_temp + scale_x
-        block.y_max = y_temp
-        block.y_min = y_temp - scale_y
-
-        for node in g_outside_boundary_node_list:
-            if ((node.x_coord <= block.x_max) & (node.x_coord >= block.x_min) \
-                    & (node.y_coord <= block.y_max) & (node.y_coord >= block.y_min)) and \
-                    (node.activity_type == 'poi' or node.activity_type == 'residential'):
-                node.zone_id = str(block.id)
-                g_node_zone_dict[node.id] = block.id
-                block.node_id_list.append(node.id)
-
-        for poi in g_poi_list:
-            if ((poi.x_coord <= block.x_max) & (poi.x_coord >= block.x_min) \
-                    & (poi.y_coord <= block.y_max) & (poi.y_coord >= block.y_min)):
-                poi.zone_id = str(block.id)
-                g_poi_zone_dict[poi.id] = block.id
-                block.poi_id_list.append(poi.id)
-                block.poi_node_list.append(poi)
-
-        # get centroid coordinates of each zone with nodes by calculating average x_coord and y_coord
-        if len(block.node_id_list) != 0:
-            block.poi_count = len(block.poi_id_list)  # number of all poi nodes in the zone
-            block.residential_count = 0  # number of residential poi nodes in the zone
-            block.office_count = 0  # number of office poi nodes in the zone
-            block.shopping_count = 0  # number of shopping poi nodes in the zone
-            block.school_count = 0  # number of school poi nodes in the zone
-            block.parking_count = 0  # number of parking poi nodes in the zone
-
-            for poi in block.poi_node_list:
-                if poi.type == 'apartments' or poi.type == 'dormitory' or poi.type == 'house' or poi.type == 'residential':
-                    block.residential_count += 1  # number of residential poi nodes in the zone
-                elif poi.type == 'office' or poi.type == 'industrial':
-                    block.office_count += 1  # number of office poi nodes in the zone
-                elif poi.type == 'commercial' or poi.type == 'retail' or poi.type == 'supermarket' or poi.type == 'warehouse':
-                    block.shopping_count += 1
-                elif poi.type == 'school' or poi.type == 'kindergarten' or poi.type == 'university' \
-                    or poi.type == 'college' or poi.type == 'university;yes':
-                    block.school_count += 1
-                elif poi.type == 'parking' or poi.type == 'garage' or poi.type == 'garages' or poi.type == 'bicycle_parking':
-                    block.parking_count += 1  # number of parking poi nodes in the zone
-
-            block.centroid_x = sum(g_outside_boundary_node_list[g_outside_boundary_node_id_index[node_id]].x_coord for
-                                   node_id in block.node_id_list) / len(block.node_id_list)
-            block.centroid_y = sum(g_outside_boundary_node_list[g_outside_boundary_node_id_index[node_id]].y_coord for
-                                   node_id in block.node_id_list) / len(block.node_id_list)
-            str_name_a = str(alphabet_list[math.ceil(block.id / number_of_x_blocks) - 1])
-            if int(block.id % number_of_x_blocks) != 0:
-                str_name_no = str(int(block.id % number_of_x_blocks))
-            else:
-                str_name_no = str(number_of_x_blocks)
-            block.name = str_name_a + str_name_no
+            friction_matrix = np.where((distance_matrix != 0) & (distance_matrix != np.inf),
+                                       a * np.exp(b * log_distance_matrix + c * distance_matrix), 0)
+    if friction_cutoff is not None:
+        friction_matrix[friction_matrix < friction_cutoff] = 0
+
+    "step 1: calculate total attraction for each zone"
+    total_attraction_friction = friction_matrix.dot(zone_attraction)
+
+    "step 2: update OD matrix"
+    trip_matrix = zone_production[:, np.newaxis] * zone_attraction[np.newaxis, :] * friction_matrix / \
+        np.maximum(0.000001, total_attraction_friction)[:, np.newaxis]
+    return friction_matrix, trip_matrix
+
+
+def _RunSparseGravityKernel(distance_matrix, zone_production, zone_attraction, a, b, c, friction_cutoff=None,
+                            log_distance_array=None):
+    """ get the friction matrix and trip matrix of the gravity model on the OD pairs stored in a csr distance matrix """
+    # comments: the friction and trip matrices keep the stored pairs of distance_matrix, so the total attraction
+    # of each origin zone is taken over the kept pairs only and its production is distributed among them
+    # comments: log_distance_array is log(d) of the stored pairs, as log_distance_matrix of _RunGravityKernel
+    distance_array = distance_matrix.data
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if log_distance_array is None:
+            friction_array = np.where(distance_array != 0, a * (distance_array ** b) * np.exp(c * distance_array), 0)
+        else:
+            friction_array = np.where(distance_array != 0, a * np.exp(b * log_distance_array + c * distance_array), 0)
+    if friction_cutoff is not None:
+        friction_array[friction_array < friction_cutoff] = 0
+    friction_matrix = scipy.sparse.csr_matrix((friction_array, distance_matrix.indices, distance_matrix.indptr),
+                                              shape=distance_matrix.shape)
 
-            str_polygon = 'POLYGON ((' + \
-                          str(block.x_min) + ' ' + str(block.y_min) + ',' + \
-                          str(block.x_min) + ' ' + str(block.y_max) + ',' + \
-                          str(block.x_max) + ' ' + str(block.y_max) + ',' + \
-                          str(block.x_max) + ' ' + str(block.y_min) + ',' + \
-                          str(block.x_min) + ' ' + str(block.y_min) + '))'
-            block.polygon = str_polygon
+    "step 1: calculate total attraction for each zone"
+    total_attraction_friction = friction_matrix.dot(zone_attraction)
+
+    "step 2: update OD matrix"
+    o_zone_index = np.repeat(np.arange(distance_matrix.shape[0]), np.diff(distance_matrix.indptr))
+    trip_array = zone_production[o_zone_index] * zone_attraction[distance_matrix.indices] * friction_array / \
+        np.maximum(0.000001, total_attraction_friction)[o_zone_index]
+    trip_matrix = scipy.sparse.csr_matrix((trip_array, distance_matrix.indices, distance_matrix.indptr),
+                                          shape=distance_matrix.shape)
+    return friction_matrix, trip_matrix
+
+
+def _BalanceTripMatrix(trip_matrix, zone_production, zone_attraction, tolerance=0.0001, max_iterations=100):
+    """ scale the rows and columns of a trip matrix in place to match zone production and attraction (Furness) """
+    # comments: the balanced matrix is row_factor[i] * column_factor[j] * trip_matrix[i, j], so each iteration only
+    # takes two matrix-vector products, and trip_matrix is scaled once at the end. Zones without any trip in
+    # trip_matrix cannot be balanced and are left out, and the attraction of the other zones is scaled to their
+    # total production
+    # comments: the residual is the largest relative difference between a row total and its production, as the
+    # column totals match the attraction after each iteration
+    if _IsSparse(trip_matrix):
+        o_zone_index = np.repeat(np.arange(trip_matrix.shape[0]), np.diff(trip_matrix.indptr))
+        row_sum = np.bincount(o_zone_index, weights=trip_matrix.data, minlength=trip_matrix.shape[0])
+        column_sum = np.bincount(trip_matrix.indices, weights=trip_matrix.data, minlength=trip_matrix.shape[1])
+    else:
+        row_sum = trip_matrix.sum(axis=1)
+        column_sum = trip_matrix.sum(axis=0)
+    target_production = np.where(row_sum > 0, zone_production, 0)
+    target_attraction = np.where(column_sum > 0, zone_attraction, 0)
+    if target_attraction.sum() > 0:
+        target_attraction = target_attraction * (target_production.sum() / target_attraction.sum())
+
+    row_factor = np.ones(trip_matrix.shape[0])
+    column_factor = np.ones(trip_matrix.shape[1])
+    number_of_iterations = 0
+    residual = 0
+    while number_of_iterations < max_iterations:
+        number_of_iterations += 1
+        row_factor = np.divide(target_production, row_sum, out=np.zeros_like(row_sum), where=row_sum > 0)
+        column_sum = trip_matrix.T.dot(row_factor)
+        column_factor = np.divide(target_attraction, column_sum, out=np.zeros_like(column_sum), where=column_sum > 0)
+        row_sum = trip_matrix.dot(column_factor)
+        residual = float(np.max(np.abs(row_factor * row_sum - target_production) /
+                                np.maximum(target_production, 0.000001), initial=0))
+        if residual <= tolerance:
+            break
+
+    if _IsSparse(trip_matrix):
+        trip_matrix.data *= row_factor[o_zone_index] * column_factor[trip_matrix.indices]
+    else:
+        trip_matrix *= row_factor[:, np.newaxis]
+        trip_matrix *= column_factor[np.newaxis, :]
+    return target_attraction, number_of_iterations, residual
+
+
+"""PART 6  GENERATE AGENT"""
+
+
+def _GenerateZoneAgentBatches(context, o_zone_index, seed_sequence, first_agent_id, batch_size=None):
+    """ yield the rows of input_agent.csv for the agents of one origin zone, at most batch_size agents at a time """
+    # comments: agents of the origin zone are math.ceil(volume) agents per destination zone, and each of their
+    # random draws is the next value of an own stream derived for the origin zone, so the rows depend neither on
+    # batch_size nor on the number of workers
+    volume_indptr, volume_d_zone_index, volume_array, zone_node_index, zone_node_start_array, zone_node_count_array, \
+        node_id_array, osm_node_id_array, node_coord_array, zone_id_array, departure_time_array = context
+    agent_type = 'v'
+    o_rng, d_rng, time_rng = [np.random.default_rng(child_seed_sequence)
+                              for child_seed_sequence in seed_sequence.spawn(3)]
+    od_pair_slice = slice(volume_indptr[o_zone_index], volume_indptr[o_zone_index + 1])
+    d_zone_index_list = volume_d_zone_index[od_pair_slice]
+    cumulative_volume_list = np.cumsum(volume_array[od_pair_slice])
+    number_of_agents = int(cumulative_volume_list[-1]) if len(cumulative_volume_list) > 0 else 0
+    if batch_size is None:
+        batch_size = number_of_agents
+    batch_size = max(int(batch_size), 1)
+
+    o_node_start = zone_node_start_array[o_zone_index]
+    o_node_count = zone_node_count_array[o_zone_index]
+    for start in range(0, number_of_agents, batch_size):
+        agent_index = np.arange(start, min(start + batch_size, number_of_agents))
+        d_zone_index = d_zone_index_list[np.searchsorted(cumulative_volume_list, agent_index, side='right')]
+        # generate o_node_id and d_node_id randomly according to o_zone_id and d_zone_id
+        d_node_count = zone_node_count_array[d_zone_index]
+        o_node_index = zone_node_index[o_node_start + np.minimum(
+            (o_rng.random(len(agent_index)) * o_node_count).astype(np.int64), o_node_count - 1)]
+        d_node_index = zone_node_index[zone_node_start_array[d_zone_index] + np.minimum(
+            (d_rng.random(len(agent_index)) * d_node_count).astype(np.int64), d_node_count - 1)]
+        time_stamp = np.ceil(time_rng.uniform(1, 60, len(agent_index))).astype(np.int64)
+
+        yield pd.DataFrame({'agent_id': first_agent_id + agent_index,
+                            'agent_type': agent_type,
+                            'o_node_id': node_id_array[o_node_index],
+                            'd_node_id': node_id_array[d_node_index],
+                            'o_osm_node_id': osm_node_id_array[o_node_index],
+                            'd_osm_node_id': osm_node_id_array[d_node_index],
+                            'o_zone_id': zone_id_array[o_zone_index],
+                            'd_zone_id': zone_id_array[d_zone_index],
+                            'geometry': 'LINESTRING(' + node_coord_array[o_node_index] + ',' +
+                                        node_coord_array[d_node_index] + ')',
+                            'departure_time': departure_time_array[time_stamp]})
+
+
+def _OpenAgentWriters(filepath_dict, geometry=True, logger=logger):
+    """ open a csv file object and/or a _ParquetWriter for each output format of agents """
+    writer_list = []
+    for output_format, filepath in filepath_dict.items():
+        if output_format == 'csv':
+            writer_list.append(open(filepath, 'w', newline='', encoding='gbk'))
+        else:
+            writer_list.append(_ParquetWriter(filepath, geometry, logger))
+    return writer_list
+
+
+def _WriteZoneAgents(writer_list, context, o_zone_index_list, seed_sequence_list, first_agent_id_list,
+                     batch_size=None):
+    """ write the agents of the given origin zones to open writers, one bulk write per batch """
+    number_of_agents = 0
+    for o_zone_index, seed_sequence, first_agent_id in zip(o_zone_index_list, seed_sequence_list,
+                                                           first_agent_id_list):
+        for data in _GenerateZoneAgentBatches(context, o_zone_index, seed_sequence, first_agent_id, batch_size):
+            for writer in writer_list:
+                if isinstance(writer, _ParquetWriter):
+                    writer.write(data)
+                else:
+                    writer.write(data.to_csv(index=False, header=False, line_terminator='\r\n'))
+            number_of_agents += len(data)
+    return number_of_agents
+
+
+g_agent_context = None  # comments: arrays of _GetAgentContext in a worker process of GenerateAgentBasedDemand
+
+
+def _InitAgentWorker(context):
+    global g_agent_context
+    g_agent_context = context
+
+
+def _WriteAgentShard(shard_filepath_dict, o_zone_index_list, seed_sequence_list, first_agent_id_list,
+                     batch_size=None, geometry=True):
+    """ write the agents of a block of origin zones to shard files in a worker process """
+    writer_list = _OpenAgentWriters(shard_filepath_dict, geometry)
+    try:
+        return _WriteZoneAgents(writer_list, g_agent_context, o_zone_index_list, seed_sequence_list,
+                                first_agent_id_list, batch_size)
+    finally:
+        for writer in writer_list:
+            writer.close()
+
+
+"""DEMAND MODEL"""
+def _GetPeakRSS():
+    """ get the peak resident set size (MB) of this process so far """
+    if resource is None:
+        return None
+    # comments: ru_maxrss is in KB on Linux and in bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / 2 ** 20, 1)
+
+
+def _ReportStage(stage_method):
+    """ record the wall time, cpu time, memory and counts of a stage of DemandModel in its run report """
+    @functools.wraps(stage_method)
+    def _RunStage(self, *args, **kwargs):
+        # comments: tracemalloc is process-wide and slows down the stage, so it is only used if trace_memory is True
+        start_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start_wall_time = time.perf_counter()
+        start_cpu_time = os.times()
+
+        result = stage_method(self, *args, **kwargs)
+
+        # comments: cpu time includes the worker processes of the stage, which are finished when it returns
+        end_cpu_time = os.times()
+        stage_report = {'stage': stage_method.__name__,
+                        'wall_time': round(time.perf_counter() - start_wall_time, 3),
+                        'cpu_time': round(sum(end_cpu_time[:4]) - sum(start_cpu_time[:4]), 3),
+                        'peak_rss_mb': _GetPeakRSS()}
+        if self.trace_memory:
+            stage_report['peak_traced_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            if start_tracing:
+                tracemalloc.stop()
+        stage_report.update(self._GetRunCounts())
+        self.stage_report_list.append(stage_report)
+        self.logger.info(stage_report['stage'] + ': wall time = ' + str(stage_report['wall_time']) + ' s, cpu time = ' +
+                         str(stage_report['cpu_time']) + ' s, peak rss = ' + str(stage_report['peak_rss_mb']) + ' MB')
+        self._WriteRunReport()
+        return result
+    return _RunStage
+
+
+class DemandModel: # comments: all data of one run of the pipeline, so that models do not share any state
+    def __init__(self, trace_memory=False):
+        """ the attribute of demand model """
+
+        # read input network files
+        self.node_table = NodeTable()
+        self.poi_table = POITable()
+        self.node_list = [] # comments: views of all nodes in self.node_table
+        self.boundary_node_list = []
+        self.outside_boundary_node_list = [] # comments: nodes outside the study area 
+        self.poi_list = [] # comments: views of all pois in self.poi_table
+        self.poi_id_type_dict = {}
+        self.poi_id_area_dict = {}
+        self.output_folder = ''
+        self.node_id_to_node = {}
+        self.node_id_to_index = {}
+        self.poi_map = {}
+        self.average_latitude = 0
+
+        # grid generation
+        self.zone_list = []
+        self.number_of_zones = 0
+        self.zone_id_list = []
+        self.zone_index_dict = {}
+        self.node_zone_dict = {}
+        self.poi_zone_dict = {}
+        self.used_latitude = 0
+
+        # trip generation
+        self.trip_purpose = 0 # comments: this set of attributes are used in the trip generation
+        self.poi_type_list = []
+        self.poi_prod_rate_list = []
+        self.poi_attr_rate_list = []
+        self.poi_prod_rate_notes_list = []
+        self.poi_attr_rate_notes_list = []
+        self.node_prod_list = []
+        self.node_attr_list = []
+        self.undefined_prod_rate_poi_name_list = []
+        self.undefined_attr_rate_poi_name_list = []
+        self.poi_type_prod_rate_dict = {}
+        self.poi_type_attr_rate_dict = {}
+        self.poi_prod_rate_flag = {}
+        self.poi_attr_rate_flag = {}
+        self.poi_purpose_prod_dict = defaultdict(defaultdict)
+        self.poi_purpose_attr_dict = defaultdict(defaultdict)
+        self.number_of_unmatched_poi_production_rate = 0
+        self.number_of_unmatched_poi_attraction_rate = 0
+        self.purpose_list = [] # comments: trip purposes of the node demand of GetMultiPurposeNodeDemand
+        self.node_production_matrix = []
+        self.node_attraction_matrix = []
+
+        # calculate accessibility
+        self.distance_matrix = []
+
+        # trip distribution
+        self.friction_matrix = []
+        self.trip_matrix = []
+        self.total_production_list = []
+        self.total_attraction_list = []
+        self.zone_to_nodes_dict = {}
+        self.purpose_friction_matrix_list = []
+        self.purpose_trip_matrix_list = []
+
+        # generate agent
+        self.number_of_agents = 0
+
+        # log
+        # comments: the logger of the model is not registered in the logging module, so models running side by side
+        # write their own log.txt only, and a model leaves nothing behind in the logging module once it is released
+        self.logger = logging.Logger(__name__ + '.DemandModel', logging.INFO)
+
+        # run report
+        self.trace_memory = trace_memory  # comments: peak memory of each stage is also traced by tracemalloc if True
+        self.stage_report_list = []
+
+    def close(self):
+        """ remove and close the log handlers of the model """
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _GetRunCounts(self):
+        """ get the numbers of rows of the current run which are recorded after each stage """
+        return {'number_of_nodes': len(self.node_table),
+                'number_of_pois': len(self.poi_table),
+                'number_of_zones': self.number_of_zones,
+                'number_of_od_pairs': 0 if isinstance(self.distance_matrix, list) else int(self.distance_matrix.size),
+                'number_of_agents': self.number_of_agents}
+
+    def _WriteRunReport(self):
+        """ write run_report.json with the records of all stages of the current run next to the outputs """
+        run_report = {'platform': platform.platform(),
+                      'python_version': platform.python_version(),
+                      'number_of_cpus': os.cpu_count(),
+                      'trace_memory': self.trace_memory,
+                      'total_wall_time': round(sum(stage_report['wall_time'] for stage_report in self.stage_report_list), 3),
+                      'stage_list': self.stage_report_list}
+        with open(os.path.join(self.output_folder or '', 'run_report.json'), 'w') as fp:
+            json.dump(run_report, fp, indent=2)
+
+    @_ReportStage
+    def ReadNetworkFiles(self, input_folder=None):
+        # comments: the network read by an earlier call is replaced, and a new run report is started
+        self.stage_report_list = []
+        self.node_id_to_index = {}
+        self.poi_id_type_dict = {}
+        self.poi_id_area_dict = {}
+        self.poi_map = {}
+
+        if input_folder:
+            node_filepath = os.path.join(input_folder, 'node.csv')
+            poi_filepath = os.path.join(input_folder, 'poi.csv')
+            self.output_folder = input_folder
+            logfile = os.path.join(self.output_folder, 'log.txt')
+        else:
+            node_filepath = 'node.csv'
+            poi_filepath = 'poi.csv'
+            logfile = 'log.txt'
+
+        # create a handler to write the log file
+        fh = logging.FileHandler(logfile, mode='w')
+        fh.setLevel(logging.DEBUG)
+
+        # create a handler to print out in console
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.WARNING)
+
+        # define output format
+        formatter = logging.Formatter('%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+        fh.setFormatter(formatter)
+        ch.setFormatter(formatter)
+
+        # comments: the handlers of an earlier call are closed and replaced by those of the current output folder
+        self.close()
+        self.logger.addHandler(fh)
+        self.logger.addHandler(ch)
+
+        self.logger.debug('Starting ReadNetworkFiles')
+
+        # read the needed columns of node.csv with the C parser of pandas and validate them column by column
+        data = _ReadNetworkCSV(node_filepath, ['node_id', 'osm_node_id', 'activity_type', 'x_coord', 'y_coord',
+                                               'poi_id', 'is_boundary'],
+                               str_column_list=['osm_node_id', 'activity_type', 'poi_id'])
+        if ('node_id' not in data.columns) or data['node_id'].isna().any():
+            # print('Error: node_id is not defined in node.csv, please check it!')
+            self.logger.error("node_id is not defined in node.csv, please check it!")
+            sys.exit(0)
+
+        activity_type = data['activity_type'].fillna('') if 'activity_type' in data.columns else \
+            pd.Series('', index=data.index)
+        data = data[activity_type != 'centroid node']
+        activity_type = activity_type[data.index]
+
+        if ('x_coord' not in data.columns) or data['x_coord'].isna().any():
+            # print('Error: x_coord is not defined in node.csv, please check it!')
+            self.logger.error("x_coord is not defined in node.csv, please check it!")
+            sys.exit(0)
+        if ('y_coord' not in data.columns) or data['y_coord'].isna().any():
+            # print('Error: y_coord is not defined in node.csv, please check it!')
+            self.logger.error("y_coord is not defined in node.csv, please check it!")
+            sys.exit(0)
+
+        # comments: nodes with a poi_id which is not a number are skipped
+        poi_id = data['poi_id'] if 'poi_id' in data.columns else pd.Series(np.nan, index=data.index, dtype=object)
+        poi_id_value = pd.to_numeric(poi_id, errors='coerce').to_numpy(dtype=float)
+        valid_poi_id_mask = np.isfinite(poi_id_value)
+        kept_node_mask = poi_id.isna().to_numpy() | valid_poi_id_mask
+        poi_flag = int(poi_id_value[valid_poi_id_mask][-1]) if valid_poi_id_mask.any() else 0 # comments: = 1 if poi_id exists
+        if poi_flag == 0:
+            print('Field poi_id is not in node.csv. Please check it!')
+            self.logger.warning('Field poi_id is NOT defined in node.csv. Please check node.csv! \
+                It could lead to empty demand volume and zero agent. \
+                Please ensure to POIs=True in osm2gmns: \
+                net = og.getNetFromOSMFile')
+
+        boundary_flag = data['is_boundary'] if 'is_boundary' in data.columns else pd.Series(np.nan, index=data.index)
+        if boundary_flag[kept_node_mask].isna().any():
+            self.logger.info("is_boundary is not defined in node.csv. Default value is 0.")
+
+        data = data[kept_node_mask]
+        self.node_table = NodeTable(len(data))
+        self.node_table.id[:] = data['node_id'].astype(np.int64)
+        if 'osm_node_id' in data.columns:
+            self.node_table.osm_node_id[:] = data['osm_node_id'].astype(object).where(data['osm_node_id'].notna(), None)
+        # comments: the built-in round is correctly rounded while numpy rounding is not, so the coordinates keep using it
+        self.node_table.x_coord[:] = [round(x_coord, 7) for x_coord in data['x_coord'].astype(float).tolist()]
+        self.node_table.y_coord[:] = [round(y_coord, 7) for y_coord in data['y_coord'].astype(float).tolist()]
+        self.node_table.boundary_flag[:] = boundary_flag[kept_node_mask].fillna(0).astype(float).astype(np.int64)
+        self.node_table.activity_type[:] = activity_type[kept_node_mask].to_numpy(dtype=object)
+        self.node_table.poi_id[valid_poi_id_mask[kept_node_mask]] = poi_id_value[valid_poi_id_mask].astype(np.int64)
+        # comments: activity_location_tab is 'boundary' for boundary nodes, or else the activity type of residential or poi
+        self.node_table.activity_tab[self.node_table.activity_type == 'residential'] = \
+            g_activity_location_tab_list.index('residential')
+        self.node_table.activity_tab[self.node_table.activity_type == 'poi'] = g_activity_location_tab_list.index('poi')
+        self.node_table.activity_tab[self.node_table.boundary_flag == 1] = g_activity_location_tab_list.index('boundary')
+
+        if len(self.node_table) > 0:
+            self.average_latitude = self.node_table.y_coord.mean()
+        else:
+            self.average_latitude = 99
+            print('Please check y_coord in node.csv!')
+            self.logger.warning('Please check y_coord in node.csv!')
+
+        self.node_id_to_index.update(zip(self.node_table.id.tolist(), range(len(self.node_table))))
+        self.node_id_to_node = _RowViewDict(NodeView, self.node_table, self.node_id_to_index)
+        self.node_list = _RowViewList(NodeView, self.node_table, np.arange(len(self.node_table)))
+        self.boundary_node_list = _RowViewList(NodeView, self.node_table, np.nonzero(self.node_table.boundary_flag == 1)[0])
+        self.outside_boundary_node_list = _RowViewList(NodeView, self.node_table,
+                                                    np.nonzero(self.node_table.boundary_flag != 1)[0])
+
+        # read the needed columns of poi.csv with the C parser of pandas and validate them column by column
+        data = _ReadNetworkCSV(poi_filepath, ['poi_id', 'centroid', 'area', 'building'],
+                               str_column_list=['centroid', 'building'])
+        if ('poi_id' not in data.columns) or data['poi_id'].isna().any():
+            self.logger.error("poi_id is not defined in poi.csv, please check it!")
+            sys.exit(0)
+        if ('centroid' not in data.columns) or data['centroid'].isna().any():
+            # print('Error: centroid is not defined in poi.csv, please check it!')
+            self.logger.error("centroid is not defined in poi.csv, please check it!")
+            sys.exit(0)
+
+        # comments: centroid is a wkt point such as POINT (x y)
+        str_centroid = data['centroid'].str.replace('POINT (', '', regex=False).str.replace(')', '', regex=False) \
+            .str.strip().str.split(' ', expand=True).reindex(columns=[0, 1]).fillna('')
+        if (str_centroid[0] == '').any():
+            # print('Error: x_coord is not defined in poi.csv, please check it!')
+            self.logger.error("x_coord is not defined in poi.csv, please check it!")
+            sys.exit(0)
+        if (str_centroid[1] == '').any():
+            # print('Error: y_coord is not defined in poi.csv, please check it!')
+            self.logger.error("y_coord is not defined in poi.csv, please check it!")
+            sys.exit(0)
+
+        if ('area' not in data.columns) or data['area'].isna().any():
+            # print('Error: area is not defined in poi.csv, please check it!')
+            poi_id = data['poi_id'][data['area'].isna()].iloc[0] if 'area' in data.columns else data['poi_id'].iloc[0]
+            self.logger.error('area is not defined for POI No.' + str(poi_id) + ' in poi.csv, please check it!')
+            sys.exit(0)
+
+        area_meter = data['area'].astype(float).to_numpy()
+        large_poi_mask = area_meter > 90000  # comments: a simple benchmark to exclude extra large poi nodes
+        area = np.where(large_poi_mask, 0, area_meter)
+        area_feet = np.where(large_poi_mask, 0, area_meter * 10.7639104)  # comments: convert the area in square meters to square feet
+
+        self.poi_table = POITable(len(data))
+        self.poi_table.id[:] = data['poi_id'].astype(np.int64)
+        self.poi_table.x_coord[:] = str_centroid[0].astype(float)
+        self.poi_table.y_coord[:] = str_centroid[1].astype(float)
+        self.poi_table.area[:] = area
+        if 'building' in data.columns:
+            self.poi_table.type[:] = data['building'].fillna('').to_numpy(dtype=object)
+
+        poi_id_list = self.poi_table.id.tolist()
+        self.poi_id_area_dict.update(zip(poi_id_list, area_feet.tolist()))
+        self.poi_id_type_dict.update(zip(poi_id_list, self.poi_table.type.tolist()))
+        self.poi_map.update(zip(poi_id_list, range(len(poi_id_list))))  # comments: index of the poi in self.poi_table
+        self.poi_list = _RowViewList(POIView, self.poi_table, np.arange(len(self.poi_table)))
+
+        self.logger.debug('Ending ReadNetworkFiles')
+
+    @_ReportStage
+    def PartitionGrid(self, number_of_x_blocks=None,
+                      number_of_y_blocks=None,
+                      cell_width=None,
+                      cell_height=None,
+                      latitude=None,
+                      connector=True,
+                      cache_folder=None,
+                      update_input_files=True,
+                      output_format='csv',
+                      geometry=True,
+                      distance_method='latitude_table'):
+        # comments: distance_method is 'latitude_table', 'equirectangular' or 'haversine'. cell_width and cell_height
+        # are converted to degrees by the lengths of a degree of g_degree_length_dict at the nearest latitude key for
+        # 'latitude_table', and at the given or average latitude of nodes otherwise
+        # comments: if cache_folder is given, the partition is saved there and loaded instead of generated again
+        # for the same nodes, pois and grid parameters
+        # comments: if update_input_files is False, poi.csv is left untouched and activity_zone_id and area of each
+        # poi are saved to poi_zone.npz instead
+        # comments: output_format is 'csv', 'parquet' or a list of them for zone and connector outputs, and parquet
+        # files omit the wkt columns if geometry is False
+        self.logger.debug('Starting PartitionGrid')
+        output_format_list = _GetOutputFormatList(output_format, g_table_output_format_list, self.logger)
+        _CheckDistanceMethod(distance_method, self.logger)
+
+        # Error: Given grid scales and number of blocks simultaneously
+        if ((number_of_x_blocks is not None) and (number_of_y_blocks is not None) \
+                and (cell_width is not None) and (cell_height is not None)):
+            self.logger.error('Grid scales and number of blocks can only choose ONE to customize!')
+            sys.exit(0)
+
+        # comments: the zones generated by an earlier call are replaced
+        self.zone_list = []
+        self.zone_index_dict = {}
+        self.node_zone_dict = {}
+        self.poi_zone_dict = {}
+        self.node_table.zone_index[:] = -1
+        self.poi_table.zone_index[:] = -1
+
+        cache_filepath = None
+        if cache_folder is not None:
+            cache_filepath = os.path.join(cache_folder, 'partition_' + self._GetPartitionKey(
+                number_of_x_blocks, number_of_y_blocks, cell_width, cell_height, latitude, distance_method) + '.npz')
+        if (cache_filepath is not None) and os.path.exists(cache_filepath):
+            self._LoadPartition(cache_filepath)
+            print('\nLatitude used for grid partition = ', self.used_latitude)
+            self.logger.info('Latitude used for grid partition = ' + str(self.used_latitude))
+            print('\nNumber of zones including virtual zones = ' + str(self.number_of_zones))
+            self.logger.info('Number of zones including virtual zones = ' + str(self.number_of_zones))
+            self.logger.info('Partitioned grid is loaded from ' + cache_filepath)
+        else:
+            self._GeneratePartition(number_of_x_blocks, number_of_y_blocks, cell_width, cell_height, latitude,
+                                    distance_method)
+            if cache_filepath is not None:
+                self._SavePartition(cache_filepath)
+                self.logger.info('Partitioned grid is saved to ' + cache_filepath)
+
+        if 'csv' in output_format_list:
+            with open(os.path.join(self.output_folder or '', 'connector.csv'), 'w', newline='') as outfile:
+                writer = csv.writer(outfile)
+                line = ['name','link_id','osm_way_id','from_node_id','to_node_id','dir_flag','length','lanes','free_speed',\
+                    'capacity','link_type_name','link_type','geometry','allowed_uses','from_biway']
+                writer.writerow(line)
+
+                for block in self.zone_list:
+                    for connector_link in block.connector_list:
+                        line = [ \
+                                '', # name
+                                connector_link.link_id, # link_id
+                                '', # osm_way_id
+                                connector_link.from_node_id, # from_node_id
+                                connector_link.to_node_id, # to_node_id
+                                '', # dir_flag
+                                '', # length
+                                '', # lanes
+                                '', # free_speed
+                                '', # capacity
+                                connector_link.link_type_name, # link_type_name
+                                connector_link.link_type_id, # link_type
+                                connector_link.geometry # geometry
+                        ]
+                        writer.writerow(line)
+        if 'parquet' in output_format_list:
+            connector_list = [connector_link for block in self.zone_list for connector_link in block.connector_list]
+            data_connector = pd.DataFrame({'link_id': [link.link_id for link in connector_list],
+                                           'from_node_id': [link.from_node_id for link in connector_list],
+                                           'to_node_id': [link.to_node_id for link in connector_list],
+                                           'link_type_name': [link.link_type_name for link in connector_list],
+                                           'link_type': [link.link_type_id for link in connector_list],
+                                           'geometry': [link.geometry for link in connector_list]})
+            with _ParquetWriter(os.path.join(self.output_folder or '', 'connector.parquet'), geometry,
+                                self.logger) as writer:
+                writer.write(data_connector)
+
+        # update poi.csv with zone_id
+        zone_id_array = np.array(self.zone_id_list)
+        poi_zone_id_array = np.where(self.poi_table.zone_index >= 0, zone_id_array[self.poi_table.zone_index], 0)
+        local_encoding = locale.getdefaultlocale()
+        if not update_input_files:
+            np.savez(os.path.join(self.output_folder or '', 'poi_zone.npz'), poi_id=self.poi_table.id,
+                     activity_zone_id=poi_zone_id_array, area=self.poi_table.area)
+        elif self.output_folder is not None:
+            poi_filepath = os.path.join(self.output_folder, 'poi.csv')
+            try:
+                data = pd.read_csv(poi_filepath)
+            except UnicodeDecodeError:
+                data = pd.read_csv(poi_filepath, encoding=local_encoding[1])
+            data['activity_zone_id'] = pd.Series(poi_zone_id_array)
+            data['area'] = pd.Series(self.poi_table.area)
+            # print(data)
+            data.to_csv(poi_filepath, index=False, line_terminator='\n')
+
+        else:
+            try:
+                data = pd.read_csv('poi.csv')
+            except UnicodeDecodeError:
+                data = pd.read_csv('poi.csv', encoding=local_encoding[1])
+            data['activity_zone_id'] = pd.Series(poi_zone_id_array)
+            # print(data)
+            data.to_csv('poi.csv', index=False, line_terminator='\n')
+
+        # create zone.csv
+        data_list = [zone.id for zone in self.zone_list]
+        data_zone = pd.DataFrame(data_list)
+        data_zone.columns = ["activity_zone_id"]
+
+        data_list = [zone.name for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['name'] = data1
+
+        data_list = [zone.centroid_x for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['centroid_x'] = data1
+
+        data_list = [zone.centroid_y for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['centroid_y'] = data1
+
+        data_list = [zone.polygon for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['geometry'] = data1
 
-            str_centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
-            block.centroid = str_centroid
+        data_list = [zone.centroid for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['centroid'] = data1
+
+        data_list = [zone.poi_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['total_poi_count'] = data1
+
+        data_list = [zone.residential_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['residential_poi_count'] = data1
+
+        data_list = [zone.office_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['office_poi_count'] = data1
 
+        data_list = [zone.shopping_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['shopping_poi_count'] = data1
+
+        data_list = [zone.school_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['school_poi_count'] = data1
+
+        data_list = [zone.parking_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['parking_poi_count'] = data1
+
+        data_list = [zone.boundary_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['boundary_node_count'] = data1
+
+        # print(data_zone)
+        self._WriteTable('zone', data_zone, output_format_list, geometry)
+
+        self.logger.debug("Ending Partition Grid")
+
+    def _GetReferenceDegreeLength(self, latitude, distance_method='latitude_table'):
+        """ get the lengths of a degree of _GetDegreeLength at the given latitude or the average latitude of nodes """
+        if latitude is None:  # use the average latitude according to node.csv
+            if self.average_latitude == 99:
+                self.logger.warning('Please check y_coord in node.csv! Default latitude is 30 degree!')
+                latitude = 30  # comments: default value if no given latitude value
+            else:
+                latitude = self.average_latitude
+        if distance_method == 'latitude_table':
+            # match the closest latitude key according to the latitude
+            latitude = min(g_degree_length_dict, key=lambda i: abs(abs(latitude) - i))
+        self.used_latitude = latitude
+        return _GetDegreeLength(latitude, distance_method)
+
+    def _GeneratePartition(self, number_of_x_blocks, number_of_y_blocks, cell_width, cell_height, latitude,
+                           distance_method='latitude_table'):
+        """ generate the zones of the grid, assign nodes and pois to zones and generate the connectors """
+        # initialize parameters
+        outside_boundary_node_index = np.nonzero(self.node_table.boundary_flag != 1)[0]
+        x_max = float(self.node_table.x_coord[outside_boundary_node_index].max())
+        x_min = float(self.node_table.x_coord[outside_boundary_node_index].min())
+        y_max = float(self.node_table.y_coord[outside_boundary_node_index].max())
+        y_min = float(self.node_table.y_coord[outside_boundary_node_index].min())
+
+        degree_length = self._GetReferenceDegreeLength(latitude, distance_method)
+
+        print('\nLatitude used for grid partition = ', self.used_latitude)
+        self.logger.info('Latitude used for grid partition = ' + str(self.used_latitude))
+
+        # Case 0: Default
+        if (number_of_x_blocks is None) and (number_of_y_blocks is None) \
+                and (cell_width is None) and (cell_height is None):
+            self.logger.warning('Default cell width and height are the length on a flat surface under a specific latitude '
+                                'corresponding to the degree of 0.006!')
+            scale_x = g_scale_list[0]
+            scale_y = g_scale_list[0]
+            x_max = math.ceil(x_max / scale_x) * scale_x
+            x_min = math.floor(x_min / scale_x) * scale_x
+            y_max = math.ceil(y_max / scale_y) * scale_y
+            y_min = math.floor(y_min / scale_y) * scale_y
+            number_of_x_blocks = round((x_max - x_min) / scale_x)
+            number_of_y_blocks = round((y_max - y_min) / scale_y)
+
+        # Case 1: Given number_of_x_blocks and number_of_y_blocks
+        if (number_of_x_blocks is not None) and (number_of_y_blocks is not None) \
+                and (cell_width is None) and (cell_height is None):
+            scale_x = round((x_max - x_min) / number_of_x_blocks, 5) + 0.00001
+            scale_y = round((y_max - y_min) / number_of_y_blocks, 5) + 0.00001
+            x_max = round(x_min + scale_x * number_of_x_blocks, 5)
+            y_min = round(y_max - scale_y * number_of_y_blocks, 5)
+
+        # Case 2: Given scale_x and scale_y in meter
+        if (number_of_x_blocks is None) and (number_of_y_blocks is None) \
+                and (cell_width is not None) and (cell_height is not None):
+            scale_x = round(cell_width / (1000 * degree_length[0]), 5)
+            scale_y = round(cell_height / (1000 * degree_length[1]), 5)
+            x_max = round(math.ceil(x_max / scale_x) * scale_x, 5)
+            x_min = round(math.floor(x_min / scale_x) * scale_x, 5)
+            y_max = round(math.ceil(y_max / scale_y) * scale_y, 5)
+            y_min = round(math.floor(y_min / scale_y) * scale_y, 5)
+            number_of_x_blocks = round((x_max - x_min) / scale_x)
+            number_of_y_blocks = round((y_max - y_min) / scale_y)
+
+        block_numbers = number_of_x_blocks * number_of_y_blocks
+        x_temp = round(x_min, 5)
+        y_temp = round(y_max, 5)
+
+        # generate the boundary of each block and record its row and column in the grid
+        block_list = []
+        block_row_list = []
+        block_col_list = []
+        row_no = 0
+        col_no = 0
+        for block_no in range(1, block_numbers + 1):
+            block = Zone()
+            block.id = block_no
+            block.x_min = x_temp
+            block.x_max = x_temp + scale_x
+            block.y_max = y_temp
+            block.y_min = y_temp - scale_y
+            block_list.append(block)
+            block_row_list.append(row_no)
+            block_col_list.append(col_no)
+
+            if round(abs(x_temp + scale_x - x_max) / scale_x) >= 1:
+                x_temp = x_temp + scale_x
+                col_no += 1
+            else:
+                x_temp = x_min
+                y_temp = y_temp - scale_y
+                row_no += 1
+                col_no = 0
+
+        block_bound_array = np.array([[block.x_min, block.x_max, block.y_min, block.y_max] for block in block_list])
+        block_index_grid = -np.ones((max(block_row_list, default=-1) + 1, max(block_col_list, default=-1) + 1), dtype=int)
+        block_index_grid[block_row_list, block_col_list] = np.arange(len(block_list))
+
+        # assign nodes and pois to blocks by their grid index instead of scanning all points for each block
+        # comments: a point on the shared edge of several blocks belongs to all of them and its zone_id is the last one
+        zone_offset = len(self.zone_list)  # comments: blocks are appended to self.zone_list in order, followed by gates
+        activity_node_index = outside_boundary_node_index[
+            (self.node_table.activity_type[outside_boundary_node_index] == 'poi') |
+            (self.node_table.activity_type[outside_boundary_node_index] == 'residential')]
+        point_index_array, block_index_array = _GetBlockMembership(
+            self.node_table.x_coord[activity_node_index], self.node_table.y_coord[activity_node_index],
+            block_bound_array, block_index_grid, x_min, y_max, scale_x, scale_y)
+        node_index_array = activity_node_index[point_index_array]
+        np.maximum.at(self.node_table.zone_index, node_index_array, zone_offset + block_index_array)
+        self.node_zone_dict.update(zip(self.node_table.id[node_index_array].tolist(),
+                                    [block_list[block_index].id for block_index in block_index_array.tolist()]))
+        block_node_index_list = np.split(node_index_array,
+                                         np.searchsorted(block_index_array, np.arange(1, len(block_list))))
+        for block, node_index in zip(block_list, block_node_index_list):
+            block.node_id_list = self.node_table.id[node_index].tolist()
+
+        point_index_array, block_index_array = _GetBlockMembership(
+            self.poi_table.x_coord, self.poi_table.y_coord,
+            block_bound_array, block_index_grid, x_min, y_max, scale_x, scale_y)
+        np.maximum.at(self.poi_table.zone_index, point_index_array, zone_offset + block_index_array)
+        self.poi_zone_dict.update(zip(self.poi_table.id[point_index_array].tolist(),
+                                   [block_list[block_index].id for block_index in block_index_array.tolist()]))
+        block_poi_index_list = np.split(point_index_array,
+                                        np.searchsorted(block_index_array, np.arange(1, len(block_list))))
+        for block, poi_index in zip(block_list, block_poi_index_list):
+            block.poi_id_list = self.poi_table.id[poi_index].tolist()
+            block.poi_node_list = _RowViewList(POIView, self.poi_table, poi_index)
+
+        # comments: category of each poi type in zone.csv, 0 if the poi type is not counted in any category
+        poi_category_array = np.zeros(len(self.poi_table), dtype=np.int64)
+        for category, poi_type_list in enumerate(g_poi_category_type_list, start=1):
+            poi_category_array[np.isin(self.poi_table.type, poi_type_list)] = category
+
+        for block, block_node_index, block_poi_index in zip(block_list, block_node_index_list, block_poi_index_list):
+            # get centroid coordinates of each zone with nodes by calculating average x_coord and y_coord
+            if len(block.node_id_list) != 0:
+                block.poi_count = len(block.poi_id_list)  # number of all poi nodes in the zone
+                poi_category_count = np.bincount(poi_category_array[block_poi_index], minlength=6).tolist()
+                block.residential_count = poi_category_count[1]  # number of residential poi nodes in the zone
+                block.office_count = poi_category_count[2]  # number of office poi nodes in the zone
+                block.shopping_count = poi_category_count[3]  # number of shopping poi nodes in the zone
+                block.school_count = poi_category_count[4]  # number of school poi nodes in the zone
+                block.parking_count = poi_category_count[5]  # number of parking poi nodes in the zone
+
+                block.centroid_x = sum(self.node_table.x_coord[block_node_index].tolist()) / len(block.node_id_list)
+                block.centroid_y = sum(self.node_table.y_coord[block_node_index].tolist()) / len(block.node_id_list)
+                str_name_a = str(alphabet_list[math.ceil(block.id / number_of_x_blocks) - 1])
+                if int(block.id % number_of_x_blocks) != 0:
+                    str_name_no = str(int(block.id % number_of_x_blocks))
+                else:
+                    str_name_no = str(number_of_x_blocks)
+                block.name = str_name_a + str_name_no
+
+                str_polygon = 'POLYGON ((' + \
+                              str(block.x_min) + ' ' + str(block.y_min) + ',' + \
+                              str(block.x_min) + ' ' + str(block.y_max) + ',' + \
+                              str(block.x_max) + ' ' + str(block.y_max) + ',' + \
+                              str(block.x_max) + ' ' + str(block.y_min) + ',' + \
+                              str(block.x_min) + ' ' + str(block.y_min) + '))'
+                block.polygon = str_polygon
+
+                str_centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
+                block.centroid = str_centroid
+
+
+                centroid_node = Node()
+                centroid_node.id = 100000 + block.id
+                centroid_node.zone_id = block.id
+                centroid_node.x_coord = block.centroid_x
+                centroid_node.y_coord = block.centroid_y
+                centroid_node.node_type = 'centroid node'
+                block.centroid_node = centroid_node
+                self.zone_list.append(block)
+
+
+            # centroid of each zone with zero node is the center point of the grid
+            if (len(block.node_id_list) == 0):
+                block.poi_count = 0  # number of all poi nodes in the zone
+                block.residential_count = 0  # number of residential poi nodes in the zone
+                block.office_count = 0  # number of office poi nodes in the zone
+                block.shopping_count = 0  # number of shopping poi nodes in the zone
+                block.school_count = 0  # number of school poi nodes in the zone
+                block.parking_count = 0  # number of parking poi nodes in the zone
+                block.centroid_x = (block.x_max + block.x_min) / 2
+                block.centroid_y = (block.y_max + block.y_min) / 2
+                str_name_a = str(alphabet_list[math.ceil(block.id / number_of_x_blocks) - 1])
+                if int(block.id % number_of_x_blocks) != 0:
+                    str_name_no = str(int(block.id % number_of_x_blocks))
+                else:
+                    str_name_no = str(number_of_x_blocks)
+                block.name = str_name_a + str_name_no
+
+                str_polygon = 'POLYGON ((' + \
+                              str(block.x_min) + ' ' + str(block.y_min) + ',' + \
+                              str(block.x_min) + ' ' + str(block.y_max) + ',' + \
+                              str(block.x_max) + ' ' + str(block.y_max) + ',' + \
+                              str(block.x_max) + ' ' + str(block.y_min) + ',' + \
+                              str(block.x_min) + ' ' + str(block.y_min) + '))'
+                block.polygon = str_polygon
+
+                str_centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
+                block.centroid = str_centroid
+
+                centroid_node = Node()
+                centroid_node.id = 100000 + block.id
+                centroid_node.zone_id = block.id
+                centroid_node.x_coord = block.centroid_x
+                centroid_node.y_coord = block.centroid_y
+                centroid_node.node_type = 'centroid node'
+                block.centroid_node = centroid_node
+                self.zone_list.append(block)
+
+        # generate the grid address for boundary nodes and generate virtual zones around the boundary of the area
+        left_gate_list = []
+        upper_gate_list = []
+        right_gate_list = []
+        lower_gate_list = []
+
+        # left side virtual zones
+        i = 1
+        delta_y = 0
+        while i <= number_of_y_blocks:
+            block = Zone()
+            block.id = block_numbers + i
+            block.name = 'Gate' + str(i)
+            block.x_min = x_min - scale_x / 2
+            block.x_max = x_min
+            block.y_max = y_min + delta_y + scale_y
+            block.y_min = y_min + delta_y
+            block.centroid_x = block.x_min
+            block.centroid_y = (block.y_max + block.y_min) / 2
+            block.centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
+            block.polygon = ''
+            block.poi_id_list = []
+            block.boundary_count = 0
 
             centroid_node = Node()
             centroid_node.id = 100000 + block.id
@@ -519,36 +1502,60 @@ def PartitionGrid(number_of_x_blocks=None,
             centroid_node.y_coord = block.centroid_y
             centroid_node.node_type = 'centroid node'
             block.centroid_node = centroid_node
-            g_zone_list.append(block)
-
-
-        # centroid of each zone with zero node is the center point of the grid
-        if (len(block.node_id_list) == 0):
-            block.poi_count = 0  # number of all poi nodes in the zone
-            block.residential_count = 0  # number of residential poi nodes in the zone
-            block.office_count = 0  # number of office poi nodes in the zone
-            block.shopping_count = 0  # number of shopping poi nodes in the zone
-            block.school_count = 0  # number of school poi nodes in the zone
-            block.parking_count = 0  # number of parking poi nodes in the zone
+            self.zone_list.append(block)
+            left_gate_list.append(block)
+
+            delta_y += scale_y
+            i += 1
+
+        # upper side virtual zones
+        i = number_of_y_blocks + 1
+        delta_x = 0
+        while i <= number_of_y_blocks + number_of_x_blocks:
+            block = Zone()
+            block.id = block_numbers + i
+            block.name = 'Gate' + str(i)
+            block.x_min = x_min + delta_x
+            block.x_max = x_min + delta_x + scale_x
+            block.y_max = y_max + scale_y / 2
+            block.y_min = y_max
             block.centroid_x = (block.x_max + block.x_min) / 2
-            block.centroid_y = (block.y_max + block.y_min) / 2
-            str_name_a = str(alphabet_list[math.ceil(block.id / number_of_x_blocks) - 1])
-            if int(block.id % number_of_x_blocks) != 0:
-                str_name_no = str(int(block.id % number_of_x_blocks))
-            else:
-                str_name_no = str(number_of_x_blocks)
-            block.name = str_name_a + str_name_no
-
-            str_polygon = 'POLYGON ((' + \
-                          str(block.x_min) + ' ' + str(block.y_min) + ',' + \
-                          str(block.x_min) + ' ' + str(block.y_max) + ',' + \
-                          str(block.x_max) + ' ' + str(block.y_max) + ',' + \
-                          str(block.x_max) + ' ' + str(block.y_min) + ',' + \
-                          str(block.x_min) + ' ' + str(block.y_min) + '))'
-            block.polygon = str_polygon
+            block.centroid_y = block.y_max
+            block.centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
+            block.polygon = ''
+            block.poi_id_list = []
+            block.boundary_count = 0
 
-            str_centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
-            block.centroid = str_centroid
+            centroid_node = Node()
+            centroid_node.id = 100000 + block.id
+            centroid_node.zone_id = block.id
+            centroid_node.x_coord = block.centroid_x
+            centroid_node.y_coord = block.centroid_y
+            centroid_node.node_type = 'centroid node'
+            block.centroid_node = centroid_node
+            self.zone_list.append(block)
+            upper_gate_list.append(block)
+
+            i += 1
+            delta_x += scale_x
+
+        # right side virtual zones
+        i = number_of_y_blocks + number_of_x_blocks + 1
+        delta_y = 0
+        while i <= 2 * number_of_y_blocks + number_of_x_blocks:
+            block = Zone()
+            block.id = block_numbers + i
+            block.name = 'Gate' + str(i)
+            block.x_min = x_max
+            block.x_max = x_max + scale_x / 2
+            block.y_max = y_max - delta_y
+            block.y_min = y_max - delta_y - scale_y
+            block.centroid_x = block.x_max
+            block.centroid_y = (block.y_max + block.y_min) / 2
+            block.centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
+            block.polygon = ''
+            block.poi_id_list = []
+            block.boundary_count = 0
 
             centroid_node = Node()
             centroid_node.id = 100000 + block.id
@@ -557,1071 +1564,1489 @@ def PartitionGrid(number_of_x_blocks=None,
             centroid_node.y_coord = block.centroid_y
             centroid_node.node_type = 'centroid node'
             block.centroid_node = centroid_node
-            g_zone_list.append(block)
+            self.zone_list.append(block)
+            right_gate_list.append(block)
+
+            i += 1
+            delta_y += scale_y
+
+        # lower side virtual zones
+        i = 2 * number_of_y_blocks + number_of_x_blocks + 1
+        delta_x = 0
+        while i <= 2 * (number_of_y_blocks + number_of_x_blocks):
+            block = Zone()
+            block.id = block_numbers + i
+            block.name = 'Gate' + str(i)
+            block.x_min = x_max - delta_x - scale_x
+            block.x_max = x_max - delta_x
+            block.y_max = y_min
+            block.y_min = y_min - scale_y / 2
+            block.centroid_x = (block.x_max + block.x_min) / 2
+            block.centroid_y = block.y_min
+            block.centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
+            block.polygon = ''
+            block.poi_id_list = []
+            block.boundary_count = 0
 
+            centroid_node = Node()
+            centroid_node.id = 100000 + block.id
+            centroid_node.zone_id = block.id
+            centroid_node.x_coord = block.centroid_x
+            centroid_node.y_coord = block.centroid_y
+            centroid_node.node_type = 'centroid node'
+            block.centroid_node = centroid_node
+            self.zone_list.append(block)
+            lower_gate_list.append(block)
+
+            i += 1
+            delta_x += scale_x
+
+        # classify each boundary node once into its nearest side and the gate index along that side
+        boundary_node_index = np.nonzero(self.node_table.boundary_flag == 1)[0]
+        boundary_x_array = self.node_table.x_coord[boundary_node_index]
+        boundary_y_array = self.node_table.y_coord[boundary_node_index]
+        side_distance_array = np.array([np.abs(boundary_x_array - x_max), np.abs(boundary_x_array - x_min),
+                                        np.abs(boundary_y_array - y_max), np.abs(boundary_y_array - y_min)])
+        nearest_distance_array = side_distance_array.min(axis=0)
+
+        # comments: a node equally near to two sides or on the shared edge of two gates belongs to all of them
+        # and its zone_id is the last one
+        left_bound_array = np.array([[block.y_min, block.y_max] for block in left_gate_list]).reshape(-1, 2)
+        upper_bound_array = np.array([[block.x_min, block.x_max] for block in upper_gate_list]).reshape(-1, 2)
+        right_bound_array = np.array([[block.y_min, block.y_max] for block in right_gate_list]).reshape(-1, 2)
+        lower_bound_array = np.array([[block.x_min, block.x_max] for block in lower_gate_list]).reshape(-1, 2)
+        point_index_list = []
+        gate_index_list = []
+        gate_offset = 0
+        for side_distance, coord_array, gate_index_array, gate_bound_array in [
+                (side_distance_array[1], boundary_y_array, (boundary_y_array - y_min) / scale_y, left_bound_array),
+                (side_distance_array[2], boundary_x_array, (boundary_x_array - x_min) / scale_x, upper_bound_array),
+                (side_distance_array[0], boundary_y_array, (y_max - boundary_y_array) / scale_y, right_bound_array),
+                (side_distance_array[3], boundary_x_array, (x_max - boundary_x_array) / scale_x, lower_bound_array)]:
+            side_point_index = np.nonzero(side_distance == nearest_distance_array)[0]
+            point_index, gate_index = _GetGateMembership(coord_array[side_point_index],
+                                                         np.floor(gate_index_array[side_point_index]).astype(int),
+                                                         gate_bound_array)
+            point_index_list.append(side_point_index[point_index])
+            gate_index_list.append(gate_index + gate_offset)
+            gate_offset += len(gate_bound_array)
+
+        gate_list = left_gate_list + upper_gate_list + right_gate_list + lower_gate_list
+        point_index_array = np.concatenate(point_index_list)
+        gate_index_array = np.concatenate(gate_index_list)
+        order = np.lexsort((point_index_array, gate_index_array))
+        node_index_array = boundary_node_index[point_index_array[order]]
+        gate_index_array = gate_index_array[order]
+        np.maximum.at(self.node_table.zone_index, node_index_array, zone_offset + len(block_list) + gate_index_array)
+        self.node_zone_dict.update(zip(self.node_table.id[node_index_array].tolist(),
+                                    [gate_list[gate_index].id for gate_index in gate_index_array.tolist()]))
+        gate_node_index_list = np.split(node_index_array, np.searchsorted(gate_index_array, np.arange(1, len(gate_list))))
+        for block, node_index in zip(gate_list, gate_node_index_list):
+            block.node_id_list = self.node_table.id[node_index].tolist()
+            block.boundary_count = len(block.node_id_list)
+
+        self.number_of_zones = len(self.zone_list)
+        print('\nNumber of zones including virtual zones = ' + str(self.number_of_zones))
+        self.logger.info('Number of zones including virtual zones = ' + str(self.number_of_zones))
+        self.zone_id_list = [zone.id for zone in self.zone_list]
+
+        # get zone index
+        for i in range(self.number_of_zones):
+            self.zone_index_dict[self.zone_id_list[i]] = i
+        self.node_table.zone_id_list = self.poi_table.zone_id_list = self.zone_id_list
+        self.node_table.zone_index_dict = self.poi_table.zone_index_dict = self.zone_index_dict
+
+        # generate the connector
+        for block in self.zone_list:
+            centroid_node = block.centroid_node
 
+            link_id_temp = 0
+            for node_id in block.node_id_list:
+                if (link_id_temp < 50):
+                    node_index = self.node_id_to_index[node_id]
+                    activity_location_tab = g_activity_location_tab_list[self.node_table.activity_tab[node_index]]
+                    if (activity_location_tab in ['residential', 'boundary', 'poi']):
+
+                        connector_link = Link(link_id = block.id * 100000 + link_id_temp,
+                                            from_node_id = node_id,
+                                            to_node_id = centroid_node.id,
+                                            link_type_name = 'connector with ' + activity_location_tab,
+                                            link_type_id = -1)
+
+                        connector_link.geometry = 'LINESTRING (' + \
+                                                str(self.node_table.x_coord[node_index].item()) + ' ' + \
+                                                str(self.node_table.y_coord[node_index].item()) + ' ' + ',' + \
+                                                str(centroid_node.x_coord) + ' ' + \
+                                                str(centroid_node.y_coord) + ')' 
+
+                        block.connector_list.append(connector_link)
+                        link_id_temp = link_id_temp + 1
+                else:
+                    break
+
+    def _GetPartitionKey(self, number_of_x_blocks, number_of_y_blocks, cell_width, cell_height, latitude,
+                         distance_method='latitude_table'):
+        """ get the hash of the node and poi columns and grid parameters which decide the partition """
+        # comments: the columns are hashed as read from node.csv and poi.csv rather than the files themselves,
+        # because the output columns added to poi.csv and node.csv in place do not change the partition
+        partition_hash = hashlib.sha256()
+        partition_hash.update(repr((number_of_x_blocks, number_of_y_blocks, cell_width, cell_height, latitude,
+                                    distance_method, self.average_latitude, g_scale_list, g_degree_length_dict,
+                                    g_poi_category_type_list)).encode())
+        for array in [self.node_table.id, self.node_table.x_coord, self.node_table.y_coord,
+                      self.node_table.boundary_flag, self.node_table.activity_tab,
+                      self.poi_table.id, self.poi_table.x_coord, self.poi_table.y_coord]:
+            partition_hash.update(np.ascontiguousarray(array).tobytes())
+        for array in [self.node_table.activity_type, self.poi_table.type]:
+            partition_hash.update('\n'.join(map(str, array.tolist())).encode())
+        return partition_hash.hexdigest()
+
+    def _SavePartition(self, cache_filepath):
+        """ save the zones, zone indexes of nodes and pois and connectors to a compressed npz file """
+        # comments: node and poi lists of the zones are saved as indexes in the tables, concatenated in zone order
+        zone_node_index_list = [np.array([self.node_id_to_index[node_id] for node_id in zone.node_id_list],
+                                         dtype=np.int64) for zone in self.zone_list]
+        zone_poi_index_list = [zone.poi_node_list._index_array if isinstance(zone.poi_node_list, _RowViewList)
+                               else np.zeros(0, dtype=np.int64) for zone in self.zone_list]
+        connector_list = [connector_link for zone in self.zone_list for connector_link in zone.connector_list]
+        array_dict = {
+            'used_latitude': np.array(self.used_latitude),
+            'zone_id': np.array([zone.id for zone in self.zone_list], dtype=np.int64),
+            'zone_name': np.array([zone.name for zone in self.zone_list], dtype=str),
+            'zone_bound': np.array([[zone.x_min, zone.x_max, zone.y_min, zone.y_max]
+                                    for zone in self.zone_list], dtype=float).reshape(-1, 4),
+            'zone_centroid_coord': np.array([[zone.centroid_x, zone.centroid_y]
+                                             for zone in self.zone_list], dtype=float).reshape(-1, 2),
+            'zone_centroid': np.array([zone.centroid for zone in self.zone_list], dtype=str),
+            'zone_polygon': np.array([zone.polygon for zone in self.zone_list], dtype=str),
+            'zone_count': np.array([[zone.poi_count, zone.residential_count, zone.office_count, zone.shopping_count,
+                                     zone.school_count, zone.parking_count, zone.boundary_count]
+                                    for zone in self.zone_list], dtype=np.int64).reshape(-1, 7),
+            'zone_node_count': np.array([len(node_index) for node_index in zone_node_index_list], dtype=np.int64),
+            'zone_node_index': np.concatenate(zone_node_index_list + [np.zeros(0, dtype=np.int64)]),
+            'zone_poi_count': np.array([len(poi_index) for poi_index in zone_poi_index_list], dtype=np.int64),
+            'zone_poi_index': np.concatenate(zone_poi_index_list + [np.zeros(0, dtype=np.int64)]),
+            'node_zone_index': self.node_table.zone_index,
+            'poi_zone_index': self.poi_table.zone_index,
+            'zone_connector_count': np.array([len(zone.connector_list) for zone in self.zone_list], dtype=np.int64),
+            'connector_link_id': np.array([link.link_id for link in connector_list], dtype=np.int64),
+            'connector_from_node_id': np.array([link.from_node_id for link in connector_list], dtype=np.int64),
+            'connector_link_type_name': np.array([link.link_type_name for link in connector_list], dtype=str),
+            'connector_geometry': np.array([link.geometry for link in connector_list], dtype=str)}
+        # comments: the file is written under a temporary name first, so that an interrupted run leaves no cache
+        temp_filepath = cache_filepath + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_filepath, 'wb') as fp:
+            np.savez_compressed(fp, **array_dict)
+        os.replace(temp_filepath, cache_filepath)
+
+    def _LoadPartition(self, cache_filepath):
+        """ load the zones, zone indexes of nodes and pois and connectors saved by _SavePartition """
+        with np.load(cache_filepath, allow_pickle=False) as array_dict:
+            array_dict = dict(array_dict)
+        self.used_latitude = array_dict['used_latitude'].item()
+        self.node_table.zone_index[:] = array_dict['node_zone_index']
+        self.poi_table.zone_index[:] = array_dict['poi_zone_index']
+
+        zone_node_index_list = np.split(array_dict['zone_node_index'], np.cumsum(array_dict['zone_node_count'])[:-1])
+        zone_poi_index_list = np.split(array_dict['zone_poi_index'], np.cumsum(array_dict['zone_poi_count'])[:-1])
+        zone_connector_end_list = np.cumsum(array_dict['zone_connector_count']).tolist()
+        for i in range(len(array_dict['zone_id'])):
+            zone = Zone()
+            zone.id = int(array_dict['zone_id'][i])
+            zone.name = str(array_dict['zone_name'][i])
+            zone.x_min, zone.x_max, zone.y_min, zone.y_max = array_dict['zone_bound'][i].tolist()
+            zone.centroid_x, zone.centroid_y = array_dict['zone_centroid_coord'][i].tolist()
+            zone.centroid = str(array_dict['zone_centroid'][i])
+            zone.polygon = str(array_dict['zone_polygon'][i])
+            zone.poi_count, zone.residential_count, zone.office_count, zone.shopping_count, zone.school_count, \
+                zone.parking_count, zone.boundary_count = array_dict['zone_count'][i].tolist()
+            zone.node_id_list = self.node_table.id[zone_node_index_list[i]].tolist()
+            zone.poi_id_list = self.poi_table.id[zone_poi_index_list[i]].tolist()
+            zone.poi_node_list = _RowViewList(POIView, self.poi_table, zone_poi_index_list[i])
 
-        if round(abs(x_temp + scale_x - x_max) / scale_x) >= 1:
-            x_temp = x_temp + scale_x
+            centroid_node = Node()
+            centroid_node.id = 100000 + zone.id
+            centroid_node.zone_id = zone.id
+            centroid_node.x_coord = zone.centroid_x
+            centroid_node.y_coord = zone.centroid_y
+            centroid_node.node_type = 'centroid node'
+            zone.centroid_node = centroid_node
+
+            for j in range(zone_connector_end_list[i] - int(array_dict['zone_connector_count'][i]),
+                           zone_connector_end_list[i]):
+                connector_link = Link(link_id=int(array_dict['connector_link_id'][j]),
+                                      from_node_id=int(array_dict['connector_from_node_id'][j]),
+                                      to_node_id=centroid_node.id,
+                                      link_type_name=str(array_dict['connector_link_type_name'][j]),
+                                      link_type_id=-1)
+                connector_link.geometry = str(array_dict['connector_geometry'][j])
+                zone.connector_list.append(connector_link)
+            self.zone_list.append(zone)
+
+        self.number_of_zones = len(self.zone_list)
+        self.zone_id_list = [zone.id for zone in self.zone_list]
+        for i in range(self.number_of_zones):
+            self.zone_index_dict[self.zone_id_list[i]] = i
+        self.node_table.zone_id_list = self.poi_table.zone_id_list = self.zone_id_list
+        self.node_table.zone_index_dict = self.poi_table.zone_index_dict = self.zone_index_dict
+        zoned_node_index = np.nonzero(self.node_table.zone_index >= 0)[0]
+        self.node_zone_dict.update(zip(self.node_table.id[zoned_node_index].tolist(),
+                                       np.array(self.zone_id_list)[self.node_table.zone_index[zoned_node_index]].tolist()))
+        zoned_poi_index = np.nonzero(self.poi_table.zone_index >= 0)[0]
+        self.poi_zone_dict.update(zip(self.poi_table.id[zoned_poi_index].tolist(),
+                                      np.array(self.zone_id_list)[self.poi_table.zone_index[zoned_poi_index]].tolist()))
+
+    @_ReportStage
+    def GetPoiTripRate(self, trip_rate_folder=None,
+                       trip_purpose=None,
+                       output_format='csv'):
+        # comments: output_format is 'csv', 'parquet' or a list of them for the poi trip rate output
+        self.logger.debug("Starting GetPOITripRate")
+        output_format_list = _GetOutputFormatList(output_format, g_table_output_format_list, self.logger)
+        # comments: the trip rates of an earlier call are replaced
+        self.poi_prod_rate_list = []
+        self.poi_attr_rate_list = []
+        self.poi_prod_rate_notes_list = []
+        self.poi_attr_rate_notes_list = []
+        self.undefined_prod_rate_poi_name_list = []
+        self.undefined_attr_rate_poi_name_list = []
+        self.poi_type_prod_rate_dict = {}
+        self.poi_type_attr_rate_dict = {}
+        self.poi_prod_rate_flag = {}
+        self.poi_attr_rate_flag = {}
+        self.number_of_unmatched_poi_production_rate = 0
+        self.number_of_unmatched_poi_attraction_rate = 0
+        self.poi_purpose_prod_dict = defaultdict(defaultdict)
+        self.poi_purpose_attr_dict = defaultdict(defaultdict)
+
+        if trip_rate_folder:
+            trip_rate_filepath = os.path.join(trip_rate_folder, 'poi_trip_rate.csv')
         else:
-            x_temp = x_min
-            y_temp = y_temp - scale_y
-
-    # generate the grid address for boundary nodes and generate virtual zones around the boundary of the area
-
-    # left side virtual zones
-    i = 1
-    delta_y = 0
-    while i <= number_of_y_blocks:
-        block = Zone()
-        block.id = block_numbers + i
-        block.name = 'Gate' + str(i)
-        block.x_min = x_min - scale_x / 2
-        block.x_max = x_min
-        block.y_max = y_min + delta_y + scale_y
-        block.y_min = y_min + delta_y
-        block.centroid_x = block.x_min
-        block.centroid_y = (block.y_max + block.y_min) / 2
-        block.centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
-        block.polygon = ''
-        block.poi_id_list = []
-        block.boundary_count = 0
-        for node in g_boundary_node_list:
-            if abs(node.x_coord - x_min) == min(abs(node.x_coord - x_max), abs(node.x_coord - x_min),
-                                                abs(node.y_coord - y_max), abs(node.y_coord - y_min)) \
-                    and block.y_max >= node.y_coord >= block.y_min and node.boundary_flag == 1:
-                node.zone_id = str(block.id)
-                g_node_zone_dict[node.id] = block.id
-                block.node_id_list.append(node.id)
-                block.boundary_count += 1
-
-        centroid_node = Node()
-        centroid_node.id = 100000 + block.id
-        centroid_node.zone_id = block.id
-        centroid_node.x_coord = block.centroid_x
-        centroid_node.y_coord = block.centroid_y
-        centroid_node.node_type = 'centroid node'
-        block.centroid_node = centroid_node
-        g_zone_list.append(block)
-
-        delta_y += scale_y
-        i += 1
-
-    # upper side virtual zones
-    i = number_of_y_blocks + 1
-    delta_x = 0
-    while i <= number_of_y_blocks + number_of_x_blocks:
-        block = Zone()
-        block.id = block_numbers + i
-        block.name = 'Gate' + str(i)
-        block.x_min = x_min + delta_x
-        block.x_max = x_min + delta_x + scale_x
-        block.y_max = y_max + scale_y / 2
-        block.y_min = y_max
-        block.centroid_x = (block.x_max + block.x_min) / 2
-        block.centroid_y = block.y_max
-        block.centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
-        block.polygon = ''
-        block.poi_id_list = []
-        block.boundary_count = 0
-        for node in g_boundary_node_list:
-            if abs(node.y_coord - y_max) == min(abs(node.x_coord - x_max), abs(node.x_coord - x_min),
-                                                abs(node.y_coord - y_max), abs(node.y_coord - y_min)) \
-                    and block.x_max >= node.x_coord >= block.x_min and node.boundary_flag == 1:
-                node.zone_id = str(block.id)
-                g_node_zone_dict[node.id] = block.id
-                block.node_id_list.append(node.id)
-                block.boundary_count += 1
-
-        centroid_node = Node()
-        centroid_node.id = 100000 + block.id
-        centroid_node.zone_id = block.id
-        centroid_node.x_coord = block.centroid_x
-        centroid_node.y_coord = block.centroid_y
-        centroid_node.node_type = 'centroid node'
-        block.centroid_node = centroid_node
-        g_zone_list.append(block)
-
-        i += 1
-        delta_x += scale_x
-
-    # right side virtual zones
-    i = number_of_y_blocks + number_of_x_blocks + 1
-    delta_y = 0
-    while i <= 2 * number_of_y_blocks + number_of_x_blocks:
-        block = Zone()
-        block.id = block_numbers + i
-        block.name = 'Gate' + str(i)
-        block.x_min = x_max
-        block.x_max = x_max + scale_x / 2
-        block.y_max = y_max - delta_y
-        block.y_min = y_max - delta_y - scale_y
-        block.centroid_x = block.x_max
-        block.centroid_y = (block.y_max + block.y_min) / 2
-        block.centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
-        block.polygon = ''
-        block.poi_id_list = []
-        block.boundary_count = 0
-        for node in g_boundary_node_list:
-            if abs(node.x_coord - x_max) == min(abs(node.x_coord - x_max), abs(node.x_coord - x_min),
-                                                abs(node.y_coord - y_max), abs(node.y_coord - y_min)) \
-                    and block.y_max >= node.y_coord >= block.y_min and node.boundary_flag == 1:
-                node.zone_id = str(block.id)
-                g_node_zone_dict[node.id] = block.id
-                block.node_id_list.append(node.id)
-                block.boundary_count += 1
-
-        centroid_node = Node()
-        centroid_node.id = 100000 + block.id
-        centroid_node.zone_id = block.id
-        centroid_node.x_coord = block.centroid_x
-        centroid_node.y_coord = block.centroid_y
-        centroid_node.node_type = 'centroid node'
-        block.centroid_node = centroid_node
-        g_zone_list.append(block)
-
-        i += 1
-        delta_y += scale_y
-
-    # lower side virtual zones
-    i = 2 * number_of_y_blocks + number_of_x_blocks + 1
-    delta_x = 0
-    while i <= 2 * (number_of_y_blocks + number_of_x_blocks):
-        block = Zone()
-        block.id = block_numbers + i
-        block.name = 'Gate' + str(i)
-        block.x_min = x_max - delta_x - scale_x
-        block.x_max = x_max - delta_x
-        block.y_max = y_min
-        block.y_min = y_min - scale_y / 2
-        block.centroid_x = (block.x_max + block.x_min) / 2
-        block.centroid_y = block.y_min
-        block.centroid = 'POINT (' + str(block.centroid_x) + ' ' + str(block.centroid_y) + ')'
-        block.polygon = ''
-        block.poi_id_list = []
-        block.boundary_count = 0
-        for node in g_boundary_node_list:
-            if abs(node.y_coord - y_min) == min(abs(node.x_coord - x_max), abs(node.x_coord - x_min),
-                                                abs(node.y_coord - y_max), abs(node.y_coord - y_min)) \
-                    and block.x_max >= node.x_coord >= block.x_min and node.boundary_flag == 1:
-                node.zone_id = str(block.id)
-                g_node_zone_dict[node.id] = block.id
-                block.node_id_list.append(node.id)
-                block.boundary_count += 1
-
-        centroid_node = Node()
-        centroid_node.id = 100000 + block.id
-        centroid_node.zone_id = block.id
-        centroid_node.x_coord = block.centroid_x
-        centroid_node.y_coord = block.centroid_y
-        centroid_node.node_type = 'centroid node'
-        block.centroid_node = centroid_node
-        g_zone_list.append(block)
-
-        i += 1
-        delta_x += scale_x
-
-    g_number_of_zones = len(g_zone_list)
-    print('\nNumber of zones including virtual zones = ' + str(g_number_of_zones))
-    logger.info('Number of zones including virtual zones = ' + str(g_number_of_zones))
-    g_zone_id_list = [zone.id for zone in g_zone_list]
-
-    # get zone index
-    for i in range(g_number_of_zones):
-        g_zone_index_dict[g_zone_id_list[i]] = i
-
-    # generate the connector
-    for block in g_zone_list:
-        centroid_node = block.centroid_node
-
-        link_id_temp = 0
-        for node_id in block.node_id_list:
-            if (link_id_temp < 50):
-                if (g_node_list[g_node_id_to_index[node_id]].activity_location_tab in ['residential', 'boundary', 'poi']):
-
-                    connector_link = Link(link_id = block.id * 100000 + link_id_temp,
-                                        from_node_id = node_id,
-                                        to_node_id = centroid_node.id,
-                                        link_type_name = 'connector with ' +
-                                                         g_node_list[g_node_id_to_index[node_id]].activity_location_tab,
-                                        link_type_id = -1)
-
-                    connector_link.geometry = 'LINESTRING (' + \
-                                            str(g_node_list[g_node_id_to_index[node_id]].x_coord) + ' ' + \
-                                            str(g_node_list[g_node_id_to_index[node_id]].y_coord) + ' ' + ',' + \
-                                            str(centroid_node.x_coord) + ' ' + \
-                                            str(centroid_node.y_coord) + ')' 
-                    
-                    block.connector_list.append(connector_link)
-                    link_id_temp = link_id_temp + 1
-            else:
-                break
-
-        
-
-    with open('connector.csv', 'w', newline='') as outfile:
-        writer = csv.writer(outfile)
-        line = ['name','link_id','osm_way_id','from_node_id','to_node_id','dir_flag','length','lanes','free_speed',\
-            'capacity','link_type_name','link_type','geometry','allowed_uses','from_biway']
-        writer.writerow(line)
-
-        for block in g_zone_list:
-            for connector_link in block.connector_list:
-                line = [ \
-                        '', # name
-                        connector_link.link_id, # link_id
-                        '', # osm_way_id
-                        connector_link.from_node_id, # from_node_id
-                        connector_link.to_node_id, # to_node_id
-                        '', # dir_flag
-                        '', # length
-                        '', # lanes
-                        '', # free_speed
-                        '', # capacity
-                        connector_link.link_type_name, # link_type_name
-                        connector_link.link_type_id, # link_type
-                        connector_link.geometry # geometry
-                ]
-                writer.writerow(line)
-
-    # update poi.csv with zone_id
-    local_encoding = locale.getdefaultlocale()
-    if g_output_folder is not None:
-        poi_filepath = os.path.join(g_output_folder, 'poi.csv')
-        try:
-            data = pd.read_csv(poi_filepath)
-        except UnicodeDecodeError:
-            data = pd.read_csv(poi_filepath, encoding=local_encoding[1])
-        data_list = [poi.zone_id for poi in g_poi_list]
-        data1 = pd.DataFrame(data_list)
-        data['activity_zone_id'] = data1
-        data_list = [poi.area for poi in g_poi_list]
-        data1 = pd.DataFrame(data_list)
-        data['area'] = data1
-        # print(data)
-        data.to_csv(poi_filepath, index=False, line_terminator='\n')
+            trip_rate_filepath = 'poi_trip_rate.csv'
 
-    else:
+        # define production/attraction rates of each land use type and trip purpose
         try:
-            data = pd.read_csv('poi.csv')
-        except UnicodeDecodeError:
-            data = pd.read_csv('poi.csv', encoding=local_encoding[1])
-        data_list = [poi.zone_id for poi in g_poi_list]
-        data1 = pd.DataFrame(data_list)
-        data['activity_zone_id'] = data1
-        # print(data)
-        data.to_csv('poi.csv', index=False, line_terminator='\n')
-
-    # create zone.csv
-    data_list = [zone.id for zone in g_zone_list]
-    data_zone = pd.DataFrame(data_list)
-    data_zone.columns = ["activity_zone_id"]
-
-    data_list = [zone.name for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['name'] = data1
-
-    data_list = [zone.centroid_x for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['centroid_x'] = data1
-
-    data_list = [zone.centroid_y for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['centroid_y'] = data1
-
-    data_list = [zone.polygon for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['geometry'] = data1
-
-    data_list = [zone.centroid for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['centroid'] = data1
-
-    data_list = [zone.poi_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['total_poi_count'] = data1
-
-    data_list = [zone.residential_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['residential_poi_count'] = data1
-
-    data_list = [zone.office_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['office_poi_count'] = data1
-
-    data_list = [zone.shopping_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['shopping_poi_count'] = data1
-
-    data_list = [zone.school_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['school_poi_count'] = data1
-
-    data_list = [zone.parking_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['parking_poi_count'] = data1
-
-    data_list = [zone.boundary_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['boundary_node_count'] = data1
-
-    # print(data_zone)
-    if g_output_folder is not None:
-        zone_filepath = os.path.join(g_output_folder, 'zone.csv')
-        data_zone.to_csv(zone_filepath, index=False, line_terminator='\n')
-    else:
-        data_zone.to_csv('zone.csv', index=False, line_terminator='\n')
-
-    logger.debug("Ending Partition Grid")
-
+            # user can customize poi_trip_rate.csv in advance
+            with open(trip_rate_filepath, errors='ignore') as fp:
+                reader = csv.DictReader(fp)
+                for line in reader:
+                    poi_type = line['building']
+                    for i in trip_purpose_list:
+                        try:
+                            self.poi_purpose_prod_dict[poi_type][i] = float(line['production_rate' + str(i)])
+                        except:
+                            self.poi_purpose_prod_dict[poi_type][i] = 0
+                        try:
+                            self.poi_purpose_attr_dict[poi_type][i] = float(line['attraction_rate' + str(i)])
+                        except:
+                            self.poi_purpose_attr_dict[poi_type][i] = 0
 
+        except:
+            # print('Warning: The folder of poi_trip_rate.csv is NOT defined! Default values will be used...')
+            self.logger.warning('poi_trip_rate.csv does not exist in the current folder. Default values will be used.')
+            # default trip generation rates refer to ITE Trip Generation Manual, 10t Edition
+            # https://www.troutdaleoregon.gov/sites/default/files/fileattachments/public_works/page/966/ite_land_use_list_10th_edition.pdf
+            # unit of measure for all poi nodes is 1,000 SF GFA in this version
+            self.poi_purpose_prod_dict = {'parking': {trip_purpose_list[0]: 0.43},
+                                       'bicycle_parking': {trip_purpose_list[0]: 0.43},
+                                       'digester': {trip_purpose_list[0]: 0.4},
+                                       'service': {trip_purpose_list[0]: 0.48}, 'college': {trip_purpose_list[0]: 1.17},
+                                       'university': {trip_purpose_list[0]: 1.17}, 'school': {trip_purpose_list[0]: 1.37},
+                                       'university;yes': {trip_purpose_list[0]: 1.17},
+                                       'kindergarten': {trip_purpose_list[0]: 11.12},
+                                       'transportation': {trip_purpose_list[0]: 1.72},
+                                       'train_station': {trip_purpose_list[0]: 1.72},
+                                       'public': {trip_purpose_list[0]: 0.11},
+                                       'public_building': {trip_purpose_list[0]: 0.11},
+                                       'hospital': {trip_purpose_list[0]: 0.97},
+                                       'government': {trip_purpose_list[0]: 1.71},
+                                       'administrative/auxiliary': {trip_purpose_list[0]: 1.71},
+                                       'fire_station': {trip_purpose_list[0]: 0.48},
+                                       'bakehouse': {trip_purpose_list[0]: 28}, 'temple': {trip_purpose_list[0]: 4.22},
+                                       'synagogue': {trip_purpose_list[0]: 0.49}, 'shrine': {trip_purpose_list[0]: 4.22},
+                                       'religious': {trip_purpose_list[0]: 0.49}, 'mosque': {trip_purpose_list[0]: 4.22},
+                                       'monastery': {trip_purpose_list[0]: 4.22}, 'church': {trip_purpose_list[0]: 0.49},
+                                       'chapel': {trip_purpose_list[0]: 0.49}, 'cathedral': {trip_purpose_list[0]: 0.49},
+                                       'warehouse': {trip_purpose_list[0]: 0.19}, 'retail': {trip_purpose_list[0]: 6.84},
+                                       'supermarket': {trip_purpose_list[0]: 9.24}, 'office': {trip_purpose_list[0]: 1.15},
+                                       'kiosk': {trip_purpose_list[0]: 7.42}, 'industrial': {trip_purpose_list[0]: 0.63},
+                                       'commercial': {trip_purpose_list[0]: 0.63}, 'library': {trip_purpose_list[0]: 1.17},
+                                       'childcare': {trip_purpose_list[0]: 11.12}, 'yes': {trip_purpose_list[0]: 1}}
+
+            self.poi_purpose_attr_dict = {'apartments': {trip_purpose_list[0]: 0.36}, 'bungalow': {trip_purpose_list[0]: 0.99},
+                                       'cabin': {trip_purpose_list[0]: 0.99}, 'detached': {trip_purpose_list[0]: 0.99},
+                                       'dormitory': {trip_purpose_list[0]: 0.36}, 'ger': {trip_purpose_list[0]: 0.99},
+                                       'hotel': {trip_purpose_list[0]: 0.6}, 'house': {trip_purpose_list[0]: 0.44},
+                                       'residential': {trip_purpose_list[0]: 0.36},
+                                       'semidetached_house': {trip_purpose_list[0]: 0.99},
+                                       'static_caravan': {trip_purpose_list[0]: 0.46},
+                                       'terrace': {trip_purpose_list[0]: 0.44}, 'public': {trip_purpose_list[0]: 0.11},
+                                       'grandstand': {trip_purpose_list[0]: 0.15}, 'pavilion': {trip_purpose_list[0]: 6.29},
+                                       'riding_hall': {trip_purpose_list[0]: 3.45},
+                                       'sports_hall': {trip_purpose_list[0]: 3.45}, 'stadium': {trip_purpose_list[0]: 0.15},
+                                       'yes': {trip_purpose_list[0]: 1}}
+
+        # Get POI production/attraction rates of each poi type with a specific trip purpose
+        if trip_purpose is None:
+            # print('Warning: Trip purpose is not defined! Default trip purpose is Purpose 1.')
+            self.logger.warning('Trip purpose is not defined! Default trip purpose is Purpose 1.')
+            trip_purpose = trip_purpose_list[0]  # default trip purpose is Purpose 1
+            self.trip_purpose = trip_purpose
+        else:
+            self.trip_purpose = trip_purpose
 
+        poi_id = [poi.id for poi in self.poi_list]
+        poi_type = [poi.type for poi in self.poi_list]
 
-"""PART 3  TRIP GENERATION"""
-g_trip_purpose = 0 # comments: this set of global variables are used in the following part 3
-g_poi_type_list = []
-g_poi_prod_rate_list = []
-g_poi_attr_rate_list = []
-g_poi_prod_rate_notes_list = []
-g_poi_attr_rate_notes_list = []
-g_node_prod_list = []
-g_node_attr_list = []
-g_undefined_prod_rate_poi_name_list = []
-g_undefined_attr_rate_poi_name_list = []
-g_poi_type_prod_rate_dict = {}
-g_poi_type_attr_rate_dict = {}
-g_poi_prod_rate_flag = {}
-g_poi_attr_rate_flag = {}
-g_poi_purpose_prod_dict = defaultdict(defaultdict)
-g_poi_purpose_attr_dict = defaultdict(defaultdict)
-trip_purpose_list = [1, 2, 3]
-g_number_of_unmatched_poi_production_rate = 0
-g_number_of_unmatched_poi_attraction_rate = 0
-
-
-def GetPoiTripRate(trip_rate_folder=None,
-                   trip_purpose=None):
-    logger.debug("Starting GetPOITripRate")
-    global g_poi_purpose_prod_dict
-    global g_poi_purpose_attr_dict
-    global g_poi_type_list
-    global g_undefined_prod_rate_poi_name_list
-    global g_undefined_attr_rate_poi_name_list
-    global g_poi_type_prod_rate_dict
-    global g_poi_type_attr_rate_dict
-    global g_trip_purpose
-    global g_output_folder
-    global g_number_of_unmatched_poi_production_rate
-    global g_number_of_unmatched_poi_attraction_rate
-
-    if trip_rate_folder:
-        trip_rate_filepath = os.path.join(trip_rate_folder, 'poi_trip_rate.csv')
-    else:
-        trip_rate_filepath = 'poi_trip_rate.csv'
-
-    # define production/attraction rates of each land use type and trip purpose
-    try:
-        # user can customize poi_trip_rate.csv in advance
-        with open(trip_rate_filepath, errors='ignore') as fp:
-            reader = csv.DictReader(fp)
-            for line in reader:
-                poi_type = line['building']
-                for i in trip_purpose_list:
-                    try:
-                        g_poi_purpose_prod_dict[poi_type][i] = float(line['production_rate' + str(i)])
-                    except:
-                        g_poi_purpose_prod_dict[poi_type][i] = 0
-                    try:
-                        g_poi_purpose_attr_dict[poi_type][i] = float(line['attraction_rate' + str(i)])
-                    except:
-                        g_poi_purpose_attr_dict[poi_type][i] = 0
-
-    except:
-        # print('Warning: The folder of poi_trip_rate.csv is NOT defined! Default values will be used...')
-        logger.warning('poi_trip_rate.csv does not exist in the current folder. Default values will be used.')
-        # default trip generation rates refer to ITE Trip Generation Manual, 10t Edition
-        # https://www.troutdaleoregon.gov/sites/default/files/fileattachments/public_works/page/966/ite_land_use_list_10th_edition.pdf
-        # unit of measure for all poi nodes is 1,000 SF GFA in this version
-        g_poi_purpose_prod_dict = {'parking': {trip_purpose_list[0]: 0.43},
-                                   'bicycle_parking': {trip_purpose_list[0]: 0.43},
-                                   'digester': {trip_purpose_list[0]: 0.4},
-                                   'service': {trip_purpose_list[0]: 0.48}, 'college': {trip_purpose_list[0]: 1.17},
-                                   'university': {trip_purpose_list[0]: 1.17}, 'school': {trip_purpose_list[0]: 1.37},
-                                   'university;yes': {trip_purpose_list[0]: 1.17},
-                                   'kindergarten': {trip_purpose_list[0]: 11.12},
-                                   'transportation': {trip_purpose_list[0]: 1.72},
-                                   'train_station': {trip_purpose_list[0]: 1.72},
-                                   'public': {trip_purpose_list[0]: 0.11},
-                                   'public_building': {trip_purpose_list[0]: 0.11},
-                                   'hospital': {trip_purpose_list[0]: 0.97},
-                                   'government': {trip_purpose_list[0]: 1.71},
-                                   'administrative/auxiliary': {trip_purpose_list[0]: 1.71},
-                                   'fire_station': {trip_purpose_list[0]: 0.48},
-                                   'bakehouse': {trip_purpose_list[0]: 28}, 'temple': {trip_purpose_list[0]: 4.22},
-                                   'synagogue': {trip_purpose_list[0]: 0.49}, 'shrine': {trip_purpose_list[0]: 4.22},
-                                   'religious': {trip_purpose_list[0]: 0.49}, 'mosque': {trip_purpose_list[0]: 4.22},
-                                   'monastery': {trip_purpose_list[0]: 4.22}, 'church': {trip_purpose_list[0]: 0.49},
-                                   'chapel': {trip_purpose_list[0]: 0.49}, 'cathedral': {trip_purpose_list[0]: 0.49},
-                                   'warehouse': {trip_purpose_list[0]: 0.19}, 'retail': {trip_purpose_list[0]: 6.84},
-                                   'supermarket': {trip_purpose_list[0]: 9.24}, 'office': {trip_purpose_list[0]: 1.15},
-                                   'kiosk': {trip_purpose_list[0]: 7.42}, 'industrial': {trip_purpose_list[0]: 0.63},
-                                   'commercial': {trip_purpose_list[0]: 0.63}, 'library': {trip_purpose_list[0]: 1.17},
-                                   'childcare': {trip_purpose_list[0]: 11.12}, 'yes': {trip_purpose_list[0]: 1}}
-
-        g_poi_purpose_attr_dict = {'apartments': {trip_purpose_list[0]: 0.36}, 'bungalow': {trip_purpose_list[0]: 0.99},
-                                   'cabin': {trip_purpose_list[0]: 0.99}, 'detached': {trip_purpose_list[0]: 0.99},
-                                   'dormitory': {trip_purpose_list[0]: 0.36}, 'ger': {trip_purpose_list[0]: 0.99},
-                                   'hotel': {trip_purpose_list[0]: 0.6}, 'house': {trip_purpose_list[0]: 0.44},
-                                   'residential': {trip_purpose_list[0]: 0.36},
-                                   'semidetached_house': {trip_purpose_list[0]: 0.99},
-                                   'static_caravan': {trip_purpose_list[0]: 0.46},
-                                   'terrace': {trip_purpose_list[0]: 0.44}, 'public': {trip_purpose_list[0]: 0.11},
-                                   'grandstand': {trip_purpose_list[0]: 0.15}, 'pavilion': {trip_purpose_list[0]: 6.29},
-                                   'riding_hall': {trip_purpose_list[0]: 3.45},
-                                   'sports_hall': {trip_purpose_list[0]: 3.45}, 'stadium': {trip_purpose_list[0]: 0.15},
-                                   'yes': {trip_purpose_list[0]: 1}}
-
-    # Get POI production/attraction rates of each poi type with a specific trip purpose
-    if trip_purpose is None:
-        # print('Warning: Trip purpose is not defined! Default trip purpose is Purpose 1.')
-        logger.warning('Trip purpose is not defined! Default trip purpose is Purpose 1.')
-        trip_purpose = trip_purpose_list[0]  # default trip purpose is Purpose 1
-        g_trip_purpose = trip_purpose
-    else:
-        g_trip_purpose = trip_purpose
+        for i in range(len(poi_id)):
+            # define production rate of each poi type
+            if (poi_type[i] in self.poi_purpose_prod_dict): 
+                production_rate = self.poi_purpose_prod_dict[poi_type[i]][trip_purpose]
+                self.poi_type_prod_rate_dict[poi_type[i]] = production_rate
+                self.poi_prod_rate_flag[poi_type[i]] = 1  # comments: the poi type production rate is obtained from the input table
+            else:
+                self.poi_type_prod_rate_dict[poi_type[i]] = 0.1  # comments: define default value of production rate
+                self.poi_prod_rate_flag[poi_type[i]] = 0  # comments: the poi type production rate does not exist in the input table
+                self.number_of_unmatched_poi_production_rate += 1
+                if poi_type[i] not in self.undefined_prod_rate_poi_name_list:
+                    # print(g_undefined_trip_rate_poi_name_list)
+                    self.undefined_prod_rate_poi_name_list.append(poi_type[i])
+                    self.logger.info(
+                        'The POI production rate of ' + "'" + str(poi_type[i]) + "'" +
+                        ' is NOT defined! Default production rate is 0.1.')
+
+            # define attraction rate of each poi type
+            if (poi_type[i] in self.poi_purpose_attr_dict): 
+                attraction_rate = self.poi_purpose_attr_dict[poi_type[i]][trip_purpose]
+                self.poi_type_attr_rate_dict[poi_type[i]] = attraction_rate
+                self.poi_attr_rate_flag[poi_type[i]] = 1  # comments: the poi type attraction rate is obtained from the input table
+            else:
+                self.poi_type_attr_rate_dict[poi_type[i]] = 0.1  # comments: define default value of attraction rate
+                self.poi_attr_rate_flag[poi_type[i]] = 0  # comments: the poi type attraction rate does not exist in the input table
+                self.number_of_unmatched_poi_attraction_rate += 1
+                if poi_type[i] not in self.undefined_attr_rate_poi_name_list:
+                    self.undefined_attr_rate_poi_name_list.append(poi_type[i])
+                    self.logger.info(
+                        'The POI attraction rate of ' + "'" + str(poi_type[i]) + "'" +
+                        ' is NOT defined! Default production rate is 0.1.')
+
+        print('\nTab of trip purposes used in grid2demand = ', self.trip_purpose)
+        print('\nTotal number of poi nodes with unmatched production rate = ', self.number_of_unmatched_poi_production_rate)
+        print('Total number of poi nodes with unmatched attraction rate = ', self.number_of_unmatched_poi_attraction_rate)
+        self.logger.info('Tab of trip purpose used in grid2demand = ' + str(self.trip_purpose))
+        self.logger.info('Total number of poi nodes with unmatched production rates = ' + str(
+            self.number_of_unmatched_poi_production_rate))
+        self.logger.info('Total number of poi nodes with unmatched attraction rates = ' + str(
+            self.number_of_unmatched_poi_attraction_rate))
+
+        # create poi_trip_rate.csv
+        poi_type = [poi.type for poi in self.poi_list]
+        self.poi_type_list = list(set(poi_type))  # comments: obtain unique poi types
+
+        data_index = [i for i in range(len(self.poi_type_list))]
+        data_rate = pd.DataFrame(data_index)
+        data_rate.columns = ["poi_type_id"]
+
+        data_type = [building for building in self.poi_type_list]
+        data_rate['building'] = pd.DataFrame(data_type)
+
+        data_rate['unit_of_measure'] = pd.DataFrame(['1,000 Sq. Ft. GFA'] * len(self.poi_type_list))
+
+        data_rate['trip_purpose'] = pd.DataFrame([self.trip_purpose] * len(self.poi_type_list))
+
+        for item in self.poi_type_list:
+            self.poi_prod_rate_list.append(self.poi_type_prod_rate_dict[item])
+            self.poi_attr_rate_list.append(self.poi_type_attr_rate_dict[item])
+            self.poi_prod_rate_notes_list.append(self.poi_prod_rate_flag[item])
+            self.poi_attr_rate_notes_list.append(self.poi_attr_rate_flag[item])
+
+        data_rate['production_rate' + str(self.trip_purpose)] = pd.DataFrame(self.poi_prod_rate_list)
+
+        data_rate['attraction_rate' + str(self.trip_purpose)] = pd.DataFrame(self.poi_attr_rate_list)
+
+        data_rate['production_notes'] = pd.DataFrame(self.poi_prod_rate_notes_list)
+        data_rate['attraction_notes'] = pd.DataFrame(self.poi_attr_rate_notes_list)
+
+        # print(data_rate)
+        self._WriteTable('poi_trip_rate', data_rate, output_format_list)
+
+        self.logger.debug('Ending GetPOITripRate')
+
+    @_ReportStage
+    def GetNodeDemand(self, residential_production = None, residential_attraction = None,
+                      boundary_production = None, boundary_attraction = None, update_input_files=True):
+        # comments: if update_input_files is False, node.csv is left untouched and activity_zone_id (0 if no zone),
+        # production, attraction and activity_location_tab of each node are saved to node_demand.npz instead
+        self.logger.debug('Starting GetNodeDemand')
+
+        production_matrix, attraction_matrix = self._GetNodeDemandMatrix(
+            [self.poi_type_prod_rate_dict], [self.poi_type_attr_rate_dict], residential_production,
+            residential_attraction, boundary_production, boundary_attraction)
+        self.node_table.production[:] = production_matrix[0]
+        self.node_table.attraction[:] = attraction_matrix[0]
+        activity_tab = self.node_table.activity_tab
+
+        self.node_prod_list = self.node_table.production
+        self.node_attr_list = self.node_table.attraction
+
+        # update node.csv with zone_id and demand values
+        zone_id_array = np.array(self.zone_id_list)
+        zoned_node_mask = self.node_table.zone_index >= 0
+        node_zone_id_array = np.full(len(self.node_table), None, dtype=object)
+        node_zone_id_array[zoned_node_mask] = zone_id_array[self.node_table.zone_index[zoned_node_mask]].astype(str)
+        local_encoding = locale.getdefaultlocale()
+        if not update_input_files:
+            np.savez(os.path.join(self.output_folder or '', 'node_demand.npz'), node_id=self.node_table.id,
+                     activity_zone_id=np.where(zoned_node_mask, zone_id_array[self.node_table.zone_index], 0),
+                     production=self.node_prod_list, attraction=self.node_attr_list,
+                     activity_location_tab=np.array(g_activity_location_tab_list)[self.node_table.activity_tab])
+        elif self.output_folder is not None:
+            node_filepath = os.path.join(self.output_folder, 'node.csv')
+            try:
+                data = pd.read_csv(node_filepath)
+            except UnicodeDecodeError:
+                data = pd.read_csv(node_filepath, encoding=local_encoding[1])
+            data['activity_zone_id'] = pd.Series(node_zone_id_array)
+            data['production'] = pd.Series(self.node_prod_list)
+            data['attraction'] = pd.Series(self.node_attr_list)
+            data['activity_location_tab'] = pd.Series(np.array(g_activity_location_tab_list, dtype=object)[activity_tab])
+
+            for block in self.zone_list:
+                centroid_node = block.centroid_node
+                series = pd.Series({"node_id": int(centroid_node.id),   
+                                    "zone_id": int(centroid_node.zone_id),
+                                    "x_coord": centroid_node.x_coord,
+                                    "y_coord": centroid_node.y_coord,
+                                    "activity_type": centroid_node.node_type
+                                    })
+                name = int(centroid_node.id)
+                try:
+                    data.loc[name] = series
+                except:
+                    data = data.append(series)
+            # print(data)
 
-    poi_id = [poi.id for poi in g_poi_list]
-    poi_type = [poi.type for poi in g_poi_list]
+            data.to_csv(node_filepath, index=False, line_terminator='\n')
 
-    for i in range(len(poi_id)):
-        # define production rate of each poi type
-        if (poi_type[i] in g_poi_purpose_prod_dict): 
-            production_rate = g_poi_purpose_prod_dict[poi_type[i]][trip_purpose]
-            g_poi_type_prod_rate_dict[poi_type[i]] = production_rate
-            g_poi_prod_rate_flag[poi_type[i]] = 1  # comments: the poi type production rate is obtained from the input table
         else:
-            g_poi_type_prod_rate_dict[poi_type[i]] = 0.1  # comments: define default value of production rate
-            g_poi_prod_rate_flag[poi_type[i]] = 0  # comments: the poi type production rate does not exist in the input table
-            g_number_of_unmatched_poi_production_rate += 1
-            if poi_type[i] not in g_undefined_prod_rate_poi_name_list:
-                # print(g_undefined_trip_rate_poi_name_list)
-                g_undefined_prod_rate_poi_name_list.append(poi_type[i])
-                logger.info(
-                    'The POI production rate of ' + "'" + str(poi_type[i]) + "'" +
-                    ' is NOT defined! Default production rate is 0.1.')
-
-        # define attraction rate of each poi type
-        if (poi_type[i] in g_poi_purpose_attr_dict): 
-            attraction_rate = g_poi_purpose_attr_dict[poi_type[i]][trip_purpose]
-            g_poi_type_attr_rate_dict[poi_type[i]] = attraction_rate
-            g_poi_attr_rate_flag[poi_type[i]] = 1  # comments: the poi type attraction rate is obtained from the input table
+            try:
+                data = pd.read_csv('node.csv')
+            except UnicodeDecodeError:
+                data = pd.read_csv('node.csv', encoding=local_encoding[1])
+            data['activity_zone_id'] = pd.Series(node_zone_id_array)
+            data['production'] = pd.Series(self.node_prod_list)
+            data['attraction'] = pd.Series(self.node_attr_list)
+            # print(data)
+            data.to_csv('node.csv', index=False, line_terminator='\n')
+        self.logger.debug('Ending GetNodeDemand')
+
+    def _GetNodeDemandMatrix(self, poi_prod_rate_dict_list, poi_attr_rate_dict_list, residential_production=None,
+                             residential_attraction=None, boundary_production=None, boundary_attraction=None):
+        """ get the production and attraction of each node as (purposes x nodes) matrices in one pass """
+        # comments: each purpose has a dict of production rates and a dict of attraction rates keyed by poi type, and
+        # the values of residential and boundary nodes are a number for all purposes or a list of one per purpose
+        if residential_production is None:
+            self.logger.warning('Production value of residential nodes is not defined! Default value is 10.')
+            residential_production = 10  # comments: default value if no given residential_production
+        if residential_attraction is None:
+            self.logger.warning('Attraction value of residential nodes is not defined! Default value is 10.')
+            residential_attraction = 10  # comments: default value if no given residential_attraction
+        if boundary_production is None:
+            self.logger.warning('Production value of boundary nodes is not defined! Default value is 1000.')
+            boundary_production = 1000  # comments: default value if no given boundary_production
+        if boundary_attraction is None:
+            self.logger.warning('Attraction value of boundary nodes is not defined! Default value is 1000.')
+            boundary_attraction = 1000  # comments: default value if no given boundary_attraction
+
+        # calculate production/attraction values of each node
+        number_of_purposes = len(poi_prod_rate_dict_list)
+        activity_tab = self.node_table.activity_tab
+        production_matrix = np.zeros((number_of_purposes, len(self.node_table)))
+        attraction_matrix = np.zeros((number_of_purposes, len(self.node_table)))
+
+        # comments: default production and attraction values of residential node
+        residential_node_mask = activity_tab == g_activity_location_tab_list.index('residential')   # residential node
+        production_matrix[:, residential_node_mask] = np.reshape(residential_production, (-1, 1))
+        attraction_matrix[:, residential_node_mask] = np.reshape(residential_attraction, (-1, 1))
+
+        # comments: default production and attraction values of boundary node
+        boundary_node_mask = activity_tab == g_activity_location_tab_list.index('boundary')   # boundary node
+        production_matrix[:, boundary_node_mask] = np.reshape(boundary_production, (-1, 1))
+        attraction_matrix[:, boundary_node_mask] = np.reshape(boundary_attraction, (-1, 1))
+
+        # comments: production and attraction rates and areas of each poi, keyed by the sorted poi ids
+        poi_id_array = np.fromiter(self.poi_id_type_dict.keys(), dtype=np.int64, count=len(self.poi_id_type_dict))
+        poi_area_array = np.array([self.poi_id_area_dict[poi_id] for poi_id in self.poi_id_type_dict.keys()], dtype=float)
+        poi_type_list, poi_type_index = np.unique(np.array(list(self.poi_id_type_dict.values()), dtype=object),
+                                                  return_inverse=True)
+        poi_prod_rate_matrix = np.array([[poi_type_prod_rate_dict[poi_type] for poi_type in poi_type_list]
+                                         for poi_type_prod_rate_dict in poi_prod_rate_dict_list],
+                                        dtype=float).reshape(number_of_purposes, -1)[:, poi_type_index]
+        poi_attr_rate_matrix = np.array([[poi_type_attr_rate_dict[poi_type] for poi_type in poi_type_list]
+                                         for poi_type_attr_rate_dict in poi_attr_rate_dict_list],
+                                        dtype=float).reshape(number_of_purposes, -1)[:, poi_type_index]
+        poi_order = np.argsort(poi_id_array, kind='stable')
+        poi_id_array = poi_id_array[poi_order]
+
+        # comments: join the poi id of each poi node to the poi arrays, and poi nodes without a matched poi keep 0
+        poi_node_mask = activity_tab == g_activity_location_tab_list.index('poi')   # poi node
+        node_poi_id = self.node_table.poi_id[poi_node_mask]
+        position = np.minimum(np.searchsorted(poi_id_array, node_poi_id), max(len(poi_id_array) - 1, 0))
+        matched_mask = poi_id_array[position] == node_poi_id if len(poi_id_array) > 0 else \
+            np.zeros(len(node_poi_id), dtype=bool)
+        poi_index = poi_order[position[matched_mask]]
+        matched_node_index = np.nonzero(poi_node_mask)[0][matched_mask]
+        # define production and attraction value of each poi node
+        production_matrix[:, matched_node_index] = poi_prod_rate_matrix[:, poi_index] * poi_area_array[
+            poi_index] / 1000  # convert the unit of measure to be 1,000 Sq. Ft. GFA
+        attraction_matrix[:, matched_node_index] = poi_attr_rate_matrix[:, poi_index] * poi_area_array[
+            poi_index] / 1000  # convert the unit of measure to be 1,000 Sq. Ft. GFA
+
+        if not (residential_node_mask | boundary_node_mask | poi_node_mask).all():
+            self.logger.info("This is not a node producing or attracting demand. Default value of production and "
+                             "attraction is 0.")
+        return production_matrix, attraction_matrix
+
+    @_ReportStage
+    def GetMultiPurposeNodeDemand(self, purpose_list=None, residential_production=None, residential_attraction=None,
+                                  boundary_production=None, boundary_attraction=None):
+        # comments: the production and attraction of each node for all trip purposes in purpose_list (default
+        # trip_purpose_list) are computed in one pass from the rates read by GetPoiTripRate, and kept in
+        # self.node_production_matrix and self.node_attraction_matrix of shape (purposes x nodes)
+        # comments: poi types without rates take 0.1 as in GetPoiTripRate, and a poi type without the rates of a
+        # purpose takes 0. The values of residential and boundary nodes are a number for all purposes or a list of one
+        # per purpose. The matrices are saved to node_demand_by_purpose.npz, and node.csv is left untouched
+        self.logger.debug('Starting GetMultiPurposeNodeDemand')
+        if not self.poi_purpose_prod_dict:
+            self.logger.error('Trip rates are not read! Please run GetPoiTripRate first.')
+            sys.exit(0)
+        if purpose_list is None:
+            purpose_list = trip_purpose_list
+        poi_prod_rate_dict_list = []
+        poi_attr_rate_dict_list = []
+        for trip_purpose in purpose_list:
+            poi_prod_rate_dict_list.append(
+                {poi_type: self.poi_purpose_prod_dict[poi_type].get(trip_purpose, 0)
+                 if poi_type in self.poi_purpose_prod_dict else 0.1 for poi_type in set(self.poi_id_type_dict.values())})
+            poi_attr_rate_dict_list.append(
+                {poi_type: self.poi_purpose_attr_dict[poi_type].get(trip_purpose, 0)
+                 if poi_type in self.poi_purpose_attr_dict else 0.1 for poi_type in set(self.poi_id_type_dict.values())})
+
+        self.purpose_list = list(purpose_list)
+        self.node_production_matrix, self.node_attraction_matrix = self._GetNodeDemandMatrix(
+            poi_prod_rate_dict_list, poi_attr_rate_dict_list, residential_production, residential_attraction,
+            boundary_production, boundary_attraction)
+
+        for trip_purpose, production, attraction in zip(self.purpose_list, self.node_production_matrix.sum(axis=1),
+                                                        self.node_attraction_matrix.sum(axis=1)):
+            print('\nTotal production and attraction of nodes under trip purpose ' + str(trip_purpose) + ' = ',
+                  production, attraction)
+            self.logger.info('Total production and attraction of nodes under trip purpose ' + str(trip_purpose) + ' = ' +
+                             str(production) + ', ' + str(attraction))
+        np.savez(os.path.join(self.output_folder or '', 'node_demand_by_purpose.npz'), node_id=self.node_table.id,
+                 trip_purpose=np.array(self.purpose_list), production=self.node_production_matrix,
+                 attraction=self.node_attraction_matrix)
+        self.logger.debug('Ending GetMultiPurposeNodeDemand')
+
+    def _WriteTable(self, table_name, data, output_format_list, geometry=True):
+        """ write a data frame to <table_name>.csv and <table_name>.parquet in the output folder as given """
+        if 'csv' in output_format_list:
+            if self.output_folder is not None:
+                table_filepath = os.path.join(self.output_folder, table_name + '.csv')
+            else:
+                table_filepath = table_name + '.csv'
+            data.to_csv(table_filepath, index=False, line_terminator='\n')
+        if 'parquet' in output_format_list:
+            with _ParquetWriter(os.path.join(self.output_folder or '', table_name + '.parquet'), geometry,
+                                self.logger) as writer:
+                writer.write(data)
+
+    def _WriteODTable(self, filepath, od_matrix_dict, chunk_size=None, file_format='csv', geometry=True):
+        """ write the long-format table of all OD pairs to a csv or parquet file, chunk_size origin zones at a time """
+        # comments: OD pairs are ordered by origin zone and then destination zone, and each column in od_matrix_dict
+        # is taken from a zone-by-zone matrix, so only the rows of the current chunk are held in memory
+        # comments: csr matrices in od_matrix_dict share the stored pairs, and only these pairs are written
+        od_pair_indptr = None
+        for od_matrix in od_matrix_dict.values():
+            if _IsSparse(od_matrix):
+                od_pair_indptr, od_pair_d_zone_index = od_matrix.indptr, od_matrix.indices
+        zone_id_array = np.array([zone.id for zone in self.zone_list])
+        zone_name_array = np.array([zone.name for zone in self.zone_list], dtype=object)
+        zone_coord_array = np.array([str(round(zone.centroid_x, 7)) + ' ' + str(round(zone.centroid_y, 7))
+                                     for zone in self.zone_list], dtype=object)
+        if chunk_size is None:
+            chunk_size = self.number_of_zones
+        chunk_size = max(int(chunk_size), 1)
+
+        if file_format == 'parquet':
+            fp = _ParquetWriter(filepath, geometry, self.logger)
         else:
-            g_poi_type_attr_rate_dict[poi_type[i]] = 0.1  # comments: define default value of attraction rate
-            g_poi_attr_rate_flag[poi_type[i]] = 0  # comments: the poi type attraction rate does not exist in the input table
-            g_number_of_unmatched_poi_attraction_rate += 1
-            if poi_type[i] not in g_undefined_attr_rate_poi_name_list:
-                g_undefined_attr_rate_poi_name_list.append(poi_type[i])
-                logger.info(
-                    'The POI attraction rate of ' + "'" + str(poi_type[i]) + "'" +
-                    ' is NOT defined! Default production rate is 0.1.')
-
-    print('\nTab of trip purposes used in grid2demand = ', g_trip_purpose)
-    print('\nTotal number of poi nodes with unmatched production rate = ', g_number_of_unmatched_poi_production_rate)
-    print('Total number of poi nodes with unmatched attraction rate = ', g_number_of_unmatched_poi_attraction_rate)
-    logger.info('Tab of trip purpose used in grid2demand = ' + str(g_trip_purpose))
-    logger.info('Total number of poi nodes with unmatched production rates = ' + str(
-        g_number_of_unmatched_poi_production_rate))
-    logger.info('Total number of poi nodes with unmatched attraction rates = ' + str(
-        g_number_of_unmatched_poi_attraction_rate))
-
-    # create poi_trip_rate.csv
-    poi_type = [poi.type for poi in g_poi_list]
-    g_poi_type_list = list(set(poi_type))  # comments: obtain unique poi types
-
-    data_index = [i for i in range(len(g_poi_type_list))]
-    data_rate = pd.DataFrame(data_index)
-    data_rate.columns = ["poi_type_id"]
-
-    data_type = [building for building in g_poi_type_list]
-    data_rate['building'] = pd.DataFrame(data_type)
-
-    data_rate['unit_of_measure'] = pd.DataFrame(['1,000 Sq. Ft. GFA'] * len(g_poi_type_list))
-
-    data_rate['trip_purpose'] = pd.DataFrame([g_trip_purpose] * len(g_poi_type_list))
-
-    for item in g_poi_type_list:
-        g_poi_prod_rate_list.append(g_poi_type_prod_rate_dict[item])
-        g_poi_attr_rate_list.append(g_poi_type_attr_rate_dict[item])
-        g_poi_prod_rate_notes_list.append(g_poi_prod_rate_flag[item])
-        g_poi_attr_rate_notes_list.append(g_poi_attr_rate_flag[item])
-
-    data_rate['production_rate' + str(g_trip_purpose)] = pd.DataFrame(g_poi_prod_rate_list)
-
-    data_rate['attraction_rate' + str(g_trip_purpose)] = pd.DataFrame(g_poi_attr_rate_list)
-
-    data_rate['production_notes'] = pd.DataFrame(g_poi_prod_rate_notes_list)
-    data_rate['attraction_notes'] = pd.DataFrame(g_poi_attr_rate_notes_list)
-
-    # print(data_rate)
-    if g_output_folder is not None:
-        triprate_filepath = os.path.join(g_output_folder, 'poi_trip_rate.csv')
-        data_rate.to_csv(triprate_filepath, index=False, line_terminator='\n')
-    else:
-        data_rate.to_csv('poi_trip_rate.csv', index=False, line_terminator='\n')
+            fp = open(filepath, 'w', newline='', encoding='utf-8')
+        with fp:
+            for start in range(0, self.number_of_zones, chunk_size):
+                end = min(start + chunk_size, self.number_of_zones)
+                if od_pair_indptr is not None:
+                    od_pair_slice = slice(od_pair_indptr[start], od_pair_indptr[end])
+                    o_zone_index_array = np.repeat(np.arange(start, end), np.diff(od_pair_indptr[start:end + 1]))
+                    d_zone_index_array = od_pair_d_zone_index[od_pair_slice]
+                else:
+                    o_zone_index_array = np.repeat(np.arange(start, end), self.number_of_zones)
+                    d_zone_index_array = np.tile(np.arange(self.number_of_zones), end - start)
+                data = pd.DataFrame({'o_zone_id': zone_id_array[o_zone_index_array],
+                                     'o_zone_name': zone_name_array[o_zone_index_array],
+                                     'd_zone_id': zone_id_array[d_zone_index_array],
+                                     'd_zone_name': zone_name_array[d_zone_index_array]})
+                for column, od_matrix in od_matrix_dict.items():
+                    if _IsSparse(od_matrix):
+                        data[column] = od_matrix.data[od_pair_slice]
+                    else:
+                        data[column] = od_matrix[start:end].ravel()
+                if (file_format != 'parquet') or geometry:
+                    data['geometry'] = 'LINESTRING (' + zone_coord_array[o_zone_index_array] + ',' + \
+                                       zone_coord_array[d_zone_index_array] + ')'
+                if file_format == 'parquet':
+                    fp.write(data)
+                else:
+                    data.to_csv(fp, index=False, header=(start == 0), line_terminator='\n')
+
+    def _SaveODMatrix(self, matrix_name, od_matrix):
+        """ save a zone-by-zone matrix to <matrix_name>.npy together with the zone index of its rows and columns """
+        # comments: the .npy file can be loaded without copy by np.load(filepath, mmap_mode='r'), and a csr matrix of
+        # the sparse OD mode is saved to <matrix_name>.npz instead, which can be loaded by scipy.sparse.load_npz
+        matrix_filename = matrix_name + ('.npz' if _IsSparse(od_matrix) else '.npy')
+        if self.output_folder is not None:
+            matrix_filepath = os.path.join(self.output_folder, matrix_filename)
+            zone_index_filepath = os.path.join(self.output_folder, 'od_matrix_zone_index.csv')
+        else:
+            matrix_filepath = matrix_filename
+            zone_index_filepath = 'od_matrix_zone_index.csv'
+        if _IsSparse(od_matrix):
+            scipy.sparse.save_npz(matrix_filepath, od_matrix)
+        else:
+            np.save(matrix_filepath, np.ascontiguousarray(od_matrix))
+
+        data_zone_index = pd.DataFrame({'zone_index': np.arange(self.number_of_zones),
+                                        'activity_zone_id': [zone.id for zone in self.zone_list],
+                                        'name': [zone.name for zone in self.zone_list]})
+        data_zone_index.to_csv(zone_index_filepath, index=False, line_terminator='\n')
+
+    def _GetNetworkGraph(self, degree_length, impedance='distance', distance_method='latitude_table'):
+        """ get the csr graph of link.csv and the connectors, and the source and sink graph index of each zone """
+        # comments: nodes of self.node_table come first in the graph, followed by the source centroids and then the
+        # sink centroids in the order of self.zone_list. Links are directed as in link.csv. Connectors go from the
+        # source to the activity nodes of the zone and from these nodes to the sink, with their straight distance, so
+        # a shortest path cannot pass through the centroid of another zone
+        link_filepath = os.path.join(self.output_folder or '', 'link.csv')
+        if not os.path.exists(link_filepath):
+            self.logger.error('link.csv is not found in the input folder! It is needed for impedance ' + str(impedance) + '.')
+            sys.exit(0)
+        data = _ReadNetworkCSV(link_filepath, ['from_node_id', 'to_node_id', 'length', 'free_speed'], [])
+        for column in ['length', 'free_speed']:
+            if column not in data.columns:
+                data[column] = np.nan
+        node_index = pd.Index(self.node_table.id)
+        from_node_index = node_index.get_indexer(data['from_node_id'])
+        to_node_index = node_index.get_indexer(data['to_node_id'])
+        # comments: links with a node which is not in self.node_table, such as centroid nodes, are skipped
+        link_flag = (from_node_index >= 0) & (to_node_index >= 0)
+        from_node_index, to_node_index = from_node_index[link_flag], to_node_index[link_flag]
+        # comments: length is in meters, and links without it take the straight distance between their nodes
+        length_array = data['length'].to_numpy(dtype=float)[link_flag] / 1000
+        straight_length_array = _GetDistance(self.node_table.x_coord[from_node_index],
+                                             self.node_table.y_coord[from_node_index],
+                                             self.node_table.x_coord[to_node_index],
+                                             self.node_table.y_coord[to_node_index], degree_length, distance_method)
+        length_array = np.where(np.isnan(length_array), straight_length_array, length_array)
+        free_speed_array = data['free_speed'].to_numpy(dtype=float)[link_flag]
+        free_speed_array = np.where(free_speed_array > 0, free_speed_array, g_default_free_speed)
+
+        connector_list = [(zone_index, connector_link.from_node_id) for zone_index, zone in enumerate(self.zone_list)
+                          for connector_link in zone.connector_list]
+        connector_zone_index = np.array([connector[0] for connector in connector_list], dtype=np.int64)
+        connector_node_index = node_index.get_indexer(np.array([connector[1] for connector in connector_list],
+                                                               dtype=np.int64))
+        centroid_x_array = np.array([zone.centroid_x for zone in self.zone_list], dtype=float)
+        centroid_y_array = np.array([zone.centroid_y for zone in self.zone_list], dtype=float)
+        connector_length_array = _GetDistance(self.node_table.x_coord[connector_node_index],
+                                              self.node_table.y_coord[connector_node_index],
+                                              centroid_x_array[connector_zone_index],
+                                              centroid_y_array[connector_zone_index], degree_length, distance_method)
+
+        if impedance == 'time':
+            link_impedance_array = length_array / free_speed_array * 60
+            connector_impedance_array = connector_length_array / g_default_free_speed * 60
+        else:
+            link_impedance_array = length_array
+            connector_impedance_array = connector_length_array
+
+        source_index_array = len(self.node_table) + np.arange(self.number_of_zones)
+        sink_index_array = source_index_array + self.number_of_zones
+        from_index = np.concatenate((from_node_index, connector_node_index, source_index_array[connector_zone_index]))
+        to_index = np.concatenate((to_node_index, sink_index_array[connector_zone_index], connector_node_index))
+        impedance_array = np.concatenate((link_impedance_array, connector_impedance_array, connector_impedance_array))
+        # comments: parallel links keep the smallest impedance, and zero impedances are made tiny as csgraph takes
+        # zero entries of a sparse graph as no edge
+        edge_order = np.lexsort((impedance_array, to_index, from_index))
+        from_index, to_index, impedance_array = from_index[edge_order], to_index[edge_order], impedance_array[edge_order]
+        edge_flag = np.ones(len(edge_order), dtype=bool)
+        edge_flag[1:] = (from_index[1:] != from_index[:-1]) | (to_index[1:] != to_index[:-1])
+        number_of_graph_nodes = len(self.node_table) + 2 * self.number_of_zones
+        graph = scipy.sparse.csr_matrix((np.maximum(impedance_array[edge_flag], 1e-9),
+                                         (from_index[edge_flag], to_index[edge_flag])),
+                                        shape=(number_of_graph_nodes, number_of_graph_nodes))
+        return graph, source_index_array, sink_index_array
+
+    def _GetNetworkSkim(self, degree_length, impedance='distance', distance_cutoff=None, number_of_workers=None,
+                        cache_folder=None, distance_method='latitude_table'):
+        """ get the zone-to-zone shortest path impedance matrix, which is a csr matrix if distance_cutoff is given """
+        # comments: if cache_folder is given, the skim is saved there and loaded instead of computed again for the
+        # same graph, which is built from link.csv, the nodes and the zones with their connectors
+        graph, source_index_array, sink_index_array = self._GetNetworkGraph(degree_length, impedance, distance_method)
+        limit = np.inf if distance_cutoff is None else distance_cutoff
+        cache_filepath = None
+        if cache_folder is not None:
+            skim_hash = hashlib.sha256()
+            skim_hash.update(repr((impedance, limit)).encode())
+            for array in [graph.indptr, graph.indices, graph.data, source_index_array, sink_index_array]:
+                skim_hash.update(np.ascontiguousarray(array).tobytes())
+            cache_filepath = os.path.join(cache_folder, 'skim_' + skim_hash.hexdigest() +
+                                          ('.npy' if distance_cutoff is None else '.npz'))
+            if os.path.exists(cache_filepath):
+                self.logger.info('Skim is loaded from ' + cache_filepath)
+                # comments: a dense skim is memory-mapped, so it is read from disk only as it is used
+                if distance_cutoff is None:
+                    return np.load(cache_filepath, mmap_mode='r')
+                return scipy.sparse.load_npz(cache_filepath)
+
+        # comments: dijkstra returns a float64 row over all graph nodes for each origin zone of a block, so a block
+        # has as many origin zones as fit in g_skim_memory_budget, and there are several blocks per worker to balance
+        # the load
+        skim_block_size = max(1, g_skim_memory_budget // (8 * graph.shape[0]))
+        number_of_blocks = max(math.ceil(self.number_of_zones / skim_block_size), max(number_of_workers or 1, 1) * 4)
+        block_list = [block.tolist() for block in np.array_split(np.arange(self.number_of_zones),
+                                                                 min(self.number_of_zones, number_of_blocks))]
+        with tempfile.TemporaryDirectory(dir=cache_folder) as temp_folder:
+            # comments: a dense skim is written row by row by the workers to a .npy file, which becomes the cache file
+            skim_filepath = None
+            if distance_cutoff is None:
+                skim_filepath = os.path.join(temp_folder, 'skim.npy')
+                skim_matrix = np.lib.format.open_memmap(skim_filepath, mode='w+', dtype=float,
+                                                        shape=(self.number_of_zones, self.number_of_zones))
+                del skim_matrix
+            if (number_of_workers is None) or (number_of_workers <= 1):
+                skim_block_list = [_ComputeSkimBlock(block, limit, skim_filepath,
+                                                     (graph, source_index_array, sink_index_array))
+                                   for block in block_list]
+            else:
+                # comments: the graph is put in shared memory once, and each worker reads it without a copy
+                shared_memory_list, array_info_list = _ShareArrays([graph.indptr, graph.indices, graph.data,
+                                                                    source_index_array, sink_index_array])
+                try:
+                    with ProcessPoolExecutor(max_workers=number_of_workers, initializer=_InitSkimWorker,
+                                             initargs=(array_info_list,)) as executor:
+                        skim_block_list = list(executor.map(_ComputeSkimBlock, block_list, [limit] * len(block_list),
+                                                            [skim_filepath] * len(block_list)))
+                finally:
+                    for shared_memory in shared_memory_list:
+                        shared_memory.close()
+                        shared_memory.unlink()
+
+            if distance_cutoff is None:
+                if cache_filepath is None:
+                    return np.load(skim_filepath)
+                os.replace(skim_filepath, cache_filepath)
+                self.logger.info('Skim is saved to ' + cache_filepath)
+                return np.load(cache_filepath, mmap_mode='r')
+
+            o_zone_index, d_zone_index, skim_array = [np.concatenate(array_list) for array_list in zip(*skim_block_list)]
+            skim_matrix = scipy.sparse.coo_matrix((skim_array, (o_zone_index, d_zone_index)),
+                                                  shape=(self.number_of_zones, self.number_of_zones)).tocsr()
+            skim_matrix.sort_indices()
+            if cache_filepath is not None:
+                temp_filepath = os.path.join(temp_folder, 'skim.npz')
+                scipy.sparse.save_npz(temp_filepath, skim_matrix, compressed=False)
+                os.replace(temp_filepath, cache_filepath)
+                self.logger.info('Skim is saved to ' + cache_filepath)
+            return skim_matrix
+
+    @_ReportStage
+    def ProduceAccessMatrix(self, latitude=None, accessibility_folder=None, chunk_size=None, output_format='csv',
+                            geometry=True, distance_cutoff=None, impedance=None, number_of_workers=None,
+                            cache_folder=None, distance_method='latitude_table', dtype='float64'):
+        # comments: chunk_size is the number of origin zones written to accessibility.csv at a time,
+        # and all OD pairs are written at once if it is None
+        # comments: output_format is 'csv', 'npy', 'parquet' or a list of them; 'npy' saves self.distance_matrix to
+        # distance_matrix.npy, and accessibility.parquet omits the geometry column if geometry is False
+        # comments: if distance_cutoff (km) is given, only OD pairs within it are kept in self.distance_matrix as a
+        # scipy csr matrix, and the gravity model, demand.csv and agents use these pairs only (sparse OD mode)
+        # comments: if impedance is 'distance' or 'time', the accessibility is the shortest path length (km) or
+        # free-flow travel time (min) between zone centroids on link.csv of the input folder and the connectors,
+        # instead of the straight distance. distance_cutoff then applies to the impedance, and the origin zones are
+        # spread over number_of_workers processes
+        # comments: if cache_folder is given, the network skim is saved there and reused in later runs until link.csv,
+        # the grid or the impedance settings change
+        # comments: distance_method is 'latitude_table', 'equirectangular' or 'haversine' as in PartitionGrid, and
+        # the distances are computed in dtype, 'float64' or 'float32' which halves the memory of the matrix
+        self.logger.debug('Starting ProduceAccessMatrix')
+        _CheckDistanceMethod(distance_method, self.logger)
+        if dtype not in ['float64', 'float32']:
+            self.logger.error('dtype ' + str(dtype) + " is not supported! Please choose from ['float64', 'float32'].")
+            sys.exit(0)
+        if (impedance is not None) and (impedance not in g_impedance_list):
+            self.logger.error('Impedance ' + str(impedance) + ' is not supported! Please choose from ' +
+                              str(g_impedance_list) + '.')
+            sys.exit(0)
+        if ((distance_cutoff is not None) or (impedance is not None)) and (scipy is None):
+            self.logger.error('scipy is not installed! Please install it by pip install scipy for distance_cutoff or '
+                              'impedance.')
+            sys.exit(0)
+
+        degree_length = self._GetReferenceDegreeLength(latitude, distance_method)
+
+        print('\nLatitude used for calculating accessibility = ', self.used_latitude)
+        self.logger.info('Latitude used for calculating accessibility = ' + str(self.used_latitude))
+
+        # define accessibility by calculating straight distance between zone centroids
+        if accessibility_folder:
+            accessibility_filepath = os.path.join(accessibility_folder, 'accessibility.csv')
+        else:
+            accessibility_filepath = 'accessibility.csv'
+
+        # calculate the straight distance between zone centroids
+        centroid_x_array = np.array([zone.centroid_x for zone in self.zone_list], dtype=dtype)
+        centroid_y_array = np.array([zone.centroid_y for zone in self.zone_list], dtype=dtype)
+        if impedance is not None:
+            self.distance_matrix = self._GetNetworkSkim(degree_length, impedance, distance_cutoff, number_of_workers,
+                                                        cache_folder, distance_method).astype(dtype, copy=False)
+            distance_array = self.distance_matrix.data if _IsSparse(self.distance_matrix) else self.distance_matrix
+            # comments: zone pairs without any path keep an inf impedance and get no trips
+            number_of_unreachable_od_pairs = int(np.isinf(distance_array).sum())
+            if number_of_unreachable_od_pairs > 0:
+                self.logger.warning('Number of OD pairs without any path on the network = ' +
+                                    str(number_of_unreachable_od_pairs))
+                distance_array = distance_array[np.isfinite(distance_array)]
+        elif distance_cutoff is not None:
+            self.distance_matrix = _GetSparseDistanceMatrix(centroid_x_array, centroid_y_array, degree_length,
+                                                            distance_cutoff, distance_method)
+            distance_array = self.distance_matrix.data
+        else:
+            self.distance_matrix = _GetDistance(centroid_x_array[:, np.newaxis], centroid_y_array[:, np.newaxis],
+                                                centroid_x_array[np.newaxis, :], centroid_y_array[np.newaxis, :],
+                                                degree_length, distance_method)
+            distance_array = self.distance_matrix
+
+        # create accessibility.csv
+        # comments: the size of a sparse matrix is the number of its stored OD pairs
+        print('\nNumber of OD pairs = ', self.distance_matrix.size)
+        self.logger.info('Number of OD pairs = '+str(self.distance_matrix.size))
+        max_distance = distance_array.max(initial=0)
+        average_distance = distance_array.mean() if distance_array.size > 0 else 0
+        # comments: the matrix holds free-flow times in min for impedance='time', and distances in km otherwise
+        measure, unit = ('time', ' min') if impedance == 'time' else ('distance', ' km')
+        print('\nLargest accessibility of ' + measure + ' = '+str(round(max_distance,2))+unit)
+        print('Average accessibility of ' + measure + ' = '+str(round(average_distance,2))+unit)
+        self.logger.info('Largest accessibility of ' + measure + ' = '+str(round(max_distance,2))+unit)
+        self.logger.info('Average accessibility of ' + measure + ' = '+str(round(average_distance,2))+unit)
+
+        output_format_list = _GetOutputFormatList(output_format, logger=self.logger)
+        if 'csv' in output_format_list:
+            if self.output_folder is not None:
+                accessibility_filepath = os.path.join(self.output_folder, 'accessibility.csv')
+            else:
+                accessibility_filepath = 'accessibility.csv'
+            self._WriteODTable(accessibility_filepath, {'accessibility': self.distance_matrix}, chunk_size)
+        if 'parquet' in output_format_list:
+            self._WriteODTable(os.path.join(self.output_folder or '', 'accessibility.parquet'),
+                               {'accessibility': self.distance_matrix}, chunk_size, 'parquet', geometry)
+        if 'npy' in output_format_list:
+            self._SaveODMatrix('distance_matrix', self.distance_matrix)
+        self.logger.debug("Ending ProduceAccessMatrix")
+
+    def _GetFrictionFactorCoefficient(self, trip_purpose=None, a=None, b=None, c=None):
+        """ fill the friction factor coefficients which are None with the default values of the trip purpose """
+        default_trip_purpose = 1 if trip_purpose == None else trip_purpose
+        if default_trip_purpose in g_friction_factor_coefficient_dict:
+            default_a, default_b, default_c = g_friction_factor_coefficient_dict[default_trip_purpose]
+            if a == None:
+                a = default_a
+            if b == None:
+                b = default_b
+            if c == None:
+                c = default_c
+        return a, b, c
+
+    def _GetZoneProductionAttraction(self, node_production=None, node_attraction=None):
+        """ add up the production and attraction of the activity nodes in each zone """
+        # comments: node_production and node_attraction are self.node_table.production and attraction if None, or
+        # (purposes x nodes) matrices, for which the zone values are (purposes x zones) matrices
+        "deal with multiple nodes within one zone"
+        if node_production is None:
+            zone_production, zone_attraction = self._GetZoneProductionAttraction(
+                self.node_table.production[np.newaxis, :], self.node_table.attraction[np.newaxis, :])
+            return zone_production[0], zone_attraction[0]
+        activity_node_index = np.nonzero(np.isin(self.node_table.activity_tab,
+                                                 [g_activity_location_tab_list.index('poi'),
+                                                  g_activity_location_tab_list.index('boundary'),
+                                                  g_activity_location_tab_list.index('residential')]) &
+                                         (self.node_table.zone_index >= 0))[0]
+        if len(activity_node_index) == 0:
+            # print("There is no node with activity_type = 'poi/residential' or is_boundary = '1'. Please check
+            # node.csv!")
+            self.logger.error("There is no node with activity_type = 'poi/residential' or is_boundary = '1'. Please check "
+                              "node.csv!")
+            sys.exit(0)
+        # comments: bincount adds up node values of each zone in the order of nodes, with the zones of each purpose
+        # after those of the previous purpose
+        number_of_purposes = len(node_production)
+        zone_index = (self.node_table.zone_index[activity_node_index][np.newaxis, :] +
+                      self.number_of_zones * np.arange(number_of_purposes)[:, np.newaxis]).ravel()
+        zone_production = np.bincount(zone_index, weights=node_production[:, activity_node_index].ravel(),
+                                      minlength=self.number_of_zones * number_of_purposes)
+        zone_attraction = np.bincount(zone_index, weights=node_attraction[:, activity_node_index].ravel(),
+                                      minlength=self.number_of_zones * number_of_purposes)
+        return zone_production.reshape(number_of_purposes, -1), zone_attraction.reshape(number_of_purposes, -1)
+
+    def _UpdateZoneToNodes(self):
+        """ get the nodes of each zone, in the order of self.node_table """
+        self.zone_to_nodes_dict.clear()
+        zoned_node_index = np.nonzero(self.node_table.zone_index >= 0)[0]
+        zoned_node_index = zoned_node_index[np.argsort(self.node_table.zone_index[zoned_node_index], kind='stable')]
+        zone_index_array, zone_start_array = np.unique(self.node_table.zone_index[zoned_node_index], return_index=True)
+        for zone_index, node_index in zip(zone_index_array.tolist(), np.split(zoned_node_index, zone_start_array[1:])):
+            self.zone_to_nodes_dict[str(self.zone_id_list[zone_index])] = self.node_table.id[node_index].tolist()
+
+    @_ReportStage
+    def RunGravityModel(self, trip_purpose=None, a=None, b=None, c=None, chunk_size=None, output_format='csv',
+                        geometry=True, friction_cutoff=None, doubly_constrained=False, tolerance=0.0001,
+                        max_iterations=100):
+        # comments: chunk_size is the number of origin zones written to demand.csv at a time,
+        # and all OD pairs are written at once if it is None
+        # comments: output_format is 'csv', 'npy', 'parquet' or a list of them; 'npy' saves self.friction_matrix and
+        # self.trip_matrix to friction_matrix.npy and trip_matrix.npy, and zone.csv is also written in 'parquet' if given
+        # comments: parquet files omit the wkt columns if geometry is False
+        # comments: OD pairs with a friction factor below friction_cutoff get no trips, and the production of each
+        # zone is distributed among the other pairs. In the sparse OD mode of ProduceAccessMatrix, self.friction_matrix
+        # and self.trip_matrix are csr matrices of the kept pairs, and demand.csv lists these pairs only
+        # comments: if doubly_constrained is True, the trip matrix is balanced by Furness iterations until the row and
+        # column totals are within tolerance (relative) of zone production and attraction or max_iterations is
+        # reached, and total_attraction in zone.csv is the attraction scaled to the total production
+        self.logger.debug("Starting RunGravityModel")
+
+        if trip_purpose == None:  # default values of friction factor coefficients for Purpose 1 (HBW)
+            self.logger.warning('Trip purpose is not defined! Default trip purpose is Purpose 1.')
+        a, b, c = self._GetFrictionFactorCoefficient(trip_purpose, a, b, c)
+        default_trip_purpose = 1 if trip_purpose == None else trip_purpose
+        if default_trip_purpose in g_friction_factor_coefficient_dict:
+            print('\nDefault values of friction factor coefficients under trip purpose ' + str(default_trip_purpose) +
+                  ':', '\na=', a, '\nb=', b, '\nc=', c)
+            self.logger.info(
+                'Default values of friction factor coefficients under trip purpose ' + str(default_trip_purpose) +
+                ': \na=' + str(a) + '\nb=' + str(b) + '\nc=' + str(c))
+
+        self._UpdateZoneToNodes()
+        zone_production, zone_attraction = self._GetZoneProductionAttraction()
+        self.total_production_list = zone_production.tolist()
+        self.total_attraction_list = zone_attraction.tolist()
+
+        "perform the distribution with friction matrix"
+        self.friction_matrix, self.trip_matrix = _RunGravityKernel(self.distance_matrix, zone_production, zone_attraction,
+                                                                   a, b, c, friction_cutoff)
+        if doubly_constrained:
+            zone_attraction, number_of_iterations, residual = _BalanceTripMatrix(self.trip_matrix, zone_production,
+                                                                                 zone_attraction, tolerance,
+                                                                                 max_iterations)
+            self.total_attraction_list = zone_attraction.tolist()
+            print('\nNumber of balancing iterations = ', number_of_iterations)
+            print('Residual of balancing = ', residual)
+            self.logger.info('Number of balancing iterations = ' + str(number_of_iterations))
+            self.logger.info('Residual of balancing = ' + str(residual))
+            if residual > tolerance:
+                self.logger.warning('Balancing of the trip matrix does not converge within ' + str(max_iterations) +
+                                    ' iterations! Residual = ' + str(residual))
+
+        # create demand.csv
+        if _IsSparse(self.trip_matrix):
+            volume_matrix = scipy.sparse.csr_matrix((np.ceil(self.trip_matrix.data).astype(np.int64),
+                                                     self.trip_matrix.indices, self.trip_matrix.indptr),
+                                                    shape=self.trip_matrix.shape)
+            volume_list = volume_matrix.data
+        else:
+            volume_matrix = np.ceil(self.trip_matrix).astype(np.int64)
+            volume_list = volume_matrix.ravel()
+
+        # By Entai 2021/4/11
+        print('\nTop 10 O-D Volume:')
+        volume_idx = np.argsort(-volume_list, kind='stable')[:10]
+        for od in range(len(volume_idx)):
+            o_zone_index, d_zone_index = _GetODPairIndex(volume_matrix, volume_idx[od])
+            print('Top ' + str(od+1) + ' O/D pair: '+ \
+                'zone ' + str(self.zone_list[o_zone_index].id) + '->zone ' + str(self.zone_list[d_zone_index].id) + \
+                    ', volume = ' + str(volume_list[volume_idx[od]]))
+            self.logger.info('Top ' + str(od+1) + ' O/D pair: '+ \
+                'zone ' + str(self.zone_list[o_zone_index].id) + '->zone ' + str(self.zone_list[d_zone_index].id) + \
+                    ', volume = ' + str(volume_list[volume_idx[od]]))
+
+        o_zone_index, d_zone_index = _GetODPairIndex(volume_matrix, np.argmax(volume_list))
+        print('\nZone-to-zone OD pair with largest volume is from ' + str(self.zone_list[o_zone_index].name) + ' to ' +
+              str(self.zone_list[d_zone_index].name))
+        self.logger.info('Zone-to-zone OD pair with largest volume is from ' + str(self.zone_list[o_zone_index].name) + ' to ' +
+              str(self.zone_list[d_zone_index].name))
+
+        output_format_list = _GetOutputFormatList(output_format, logger=self.logger)
+        if 'csv' in output_format_list:
+            if self.output_folder is not None:
+                demand_filepath = os.path.join(self.output_folder, 'demand.csv')
+            else:
+                demand_filepath = 'demand.csv'
+            self._WriteODTable(demand_filepath, {'accessibility': self.distance_matrix, 'volume': volume_matrix}, chunk_size)
+        if 'parquet' in output_format_list:
+            self._WriteODTable(os.path.join(self.output_folder or '', 'demand.parquet'),
+                               {'accessibility': self.distance_matrix, 'volume': volume_matrix}, chunk_size, 'parquet',
+                               geometry)
+        if 'npy' in output_format_list:
+            self._SaveODMatrix('friction_matrix', self.friction_matrix)
+            self._SaveODMatrix('trip_matrix', self.trip_matrix)
+
+        # update zone.csv with total production and attraction in each zone
+        data_zone = self._GetZoneTable()
+        data_zone_name_list = [zone.name for zone in self.zone_list]
+
+        data_zone['total_production'] = pd.DataFrame(self.total_production_list)
+        data_zone['total_attraction'] = pd.DataFrame(self.total_attraction_list)
+
+        max_prod_o_zone_index = self.total_production_list.index(max(self.total_production_list))
+        max_attr_d_zone_index = self.total_attraction_list.index(max(self.total_attraction_list))
+        print('Origin zone with largest production volume is '+str(data_zone_name_list[max_prod_o_zone_index]))
+        print('Destination zone with largest attraction volume is ' + str(data_zone_name_list[max_attr_d_zone_index]))
+        self.logger.info('Origin zone with largest production volume is '+str(data_zone_name_list[max_prod_o_zone_index]))
+        self.logger.info('Destination zone with largest attraction volume is ' + str(data_zone_name_list[max_attr_d_zone_index]))
+
+        # print(data_zone)
+
+        # comments: zone.csv is written as before if no table format is given, such as output_format='npy'
+        self._WriteTable('zone', data_zone, [item for item in output_format_list if item in g_table_output_format_list]
+                         or ['csv'], geometry)
+        self.logger.debug("Ending RunGravityModel")
+
+    def _GetZoneTable(self):
+        """ get the data frame of zone.csv without the production and attraction columns """
+        data_list = [zone.id for zone in self.zone_list]
+        data_zone = pd.DataFrame(data_list)
+        data_zone.columns = ["activity_zone_id"]
+
+        data_list = [zone.name for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['name'] = data1
 
-    logger.debug('Ending GetPOITripRate')
+        data_list = [zone.centroid_x for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['centroid_x'] = data1
 
+        data_list = [zone.centroid_y for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['centroid_y'] = data1
 
-def GetNodeDemand(residential_production = None, residential_attraction = None,
-                  boundary_production = None, boundary_attraction = None):
-    logger.debug('Starting GetNodeDemand')
-    global g_node_prod_list
-    global g_node_attr_list
-    global g_node_list
-    global g_output_folder
-
-    if residential_production is None:
-        logger.warning('Production value of residential nodes is not defined! Default value is 10.')
-        residential_production = 10  # comments: default value if no given residential_production
-    if residential_attraction is None:
-        logger.warning('Attraction value of residential nodes is not defined! Default value is 10.')
-        residential_attraction = 10  # comments: default value if no given residential_attraction
-    if boundary_production is None:
-        logger.warning('Production value of boundary nodes is not defined! Default value is 1000.')
-        boundary_production = 1000  # comments: default value if no given boundary_production
-    if boundary_attraction is None:
-        logger.warning('Attraction value of boundary nodes is not defined! Default value is 1000.')
-        boundary_attraction = 1000  # comments: default value if no given boundary_attraction
-
-    # calculate production/attraction values of each node
-    log_flag = 0
-    for node in g_node_list:
-        if node.activity_location_tab == 'residential':   # residential node
-            g_node_prod_list.append(residential_production)  # comments: default production value of residential node
-            node.production = residential_production
-            g_node_attr_list.append(residential_attraction)  # comments: default attraction value of residential node
-            node.attraction = residential_attraction
-
-        elif node.activity_location_tab == 'boundary':   # boundary node
-            g_node_prod_list.append(boundary_production)  # comments: default production value of boundary node
-            node.production = boundary_production
-            g_node_attr_list.append(boundary_attraction)  # comments: default attraction value of boundary node
-            node.attraction = boundary_attraction
-
-        elif node.activity_location_tab == 'poi':   # poi node
-            # define production value of each poi node
-            if (int(float(node.poi_id)) in g_poi_id_type_dict.keys()):
-                node_poi_type = g_poi_id_type_dict[int(float(node.poi_id))]
-                node_poi_prod = g_poi_type_prod_rate_dict[node_poi_type] * g_poi_id_area_dict[
-                    int(float(node.poi_id))] / 1000  # convert the unit of measure to be 1,000 Sq. Ft. GFA
-                node.production = node_poi_prod
-                g_node_prod_list.append(node_poi_prod)
-
-            # define attraction value of each poi node
-            if (int(float(node.poi_id)) in g_poi_id_type_dict.keys()):
-                node_poi_type = g_poi_id_type_dict[int(float(node.poi_id))]
-                node_poi_attr = g_poi_type_attr_rate_dict[node_poi_type] * g_poi_id_area_dict[
-                    int(float(node.poi_id))] / 1000  # convert the unit of measure to be 1,000 Sq. Ft. GFA
-                node.attraction = node_poi_attr
-                g_node_attr_list.append(node_poi_attr)
+        data_list = [zone.polygon for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['geometry'] = data1
 
-        else:
-            g_node_prod_list.append(0)
-            node.production = 0
-
-            g_node_attr_list.append(0)
-            node.attraction = 0
-            if (log_flag == 0):
-                logger.info("This is not a node producing or attracting demand. Default value of production and "
-                            "attraction is 0.")
-                log_flag = 1
-
-    # update node.csv with zone_id and demand values
-    local_encoding = locale.getdefaultlocale()
-    if g_output_folder is not None:
-        node_filepath = os.path.join(g_output_folder, 'node.csv')
-        try:
-            data = pd.read_csv(node_filepath)
-        except UnicodeDecodeError:
-            data = pd.read_csv(node_filepath, encoding=local_encoding[1])
-        data_list = [node.zone_id for node in g_node_list]
+        data_list = [zone.centroid for zone in self.zone_list]
         data1 = pd.DataFrame(data_list)
-        data['activity_zone_id'] = data1
-        data['production'] = pd.DataFrame(g_node_prod_list)
-        data['attraction'] = pd.DataFrame(g_node_attr_list)
-        data['activity_location_tab'] = pd.DataFrame([node.activity_location_tab for node in g_node_list])
-        
-        for block in g_zone_list:
-            centroid_node = block.centroid_node
-            series = pd.Series({"node_id": int(centroid_node.id),   
-                                "zone_id": int(centroid_node.zone_id),
-                                "x_coord": centroid_node.x_coord,
-                                "y_coord": centroid_node.y_coord,
-                                "activity_type": centroid_node.node_type
-                                })
-            name = int(centroid_node.id)
-            try:
-                data.loc[name] = series
-            except:
-                data = data.append(series)
-        # print(data)
+        data_zone['centroid'] = data1
 
-        data.to_csv(node_filepath, index=False, line_terminator='\n')
+        data_list = [zone.poi_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['total_poi_count'] = data1
 
-    else:
-        try:
-            data = pd.read_csv('node.csv')
-        except UnicodeDecodeError:
-            data = pd.read_csv('node.csv', encoding=local_encoding[1])
-        data_list = [node.zone_id for node in g_node_list]
+        data_list = [zone.residential_count for zone in self.zone_list]
         data1 = pd.DataFrame(data_list)
-        data['activity_zone_id'] = data1
-        data['production'] = pd.DataFrame(g_node_prod_list)
-        data['attraction'] = pd.DataFrame(g_node_attr_list)
-        # print(data)
-        data.to_csv('node.csv', index=False, line_terminator='\n')
-    logger.debug('Ending GetNodeDemand')
+        data_zone['residential_poi_count'] = data1
 
+        data_list = [zone.office_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['office_poi_count'] = data1
 
-"""PART 4  CALCULATE ACCESSIBILITY"""
-o_zone_id_list = []
-o_zone_name_list = []
-d_zone_id_list = []
-d_zone_name_list = []
-od_distance_list = []
-od_geometry_list = []
-g_distance_matrix = []
-
-
-def ProduceAccessMatrix(latitude=None, accessibility_folder=None):
-    logger.debug('Starting ProduceAccessMatrix')
-    global o_zone_id_list
-    global o_zone_name_list
-    global d_zone_id_list
-    global d_zone_name_list
-    global od_distance_list
-    global od_geometry_list
-    global g_distance_matrix
-    global g_output_folder
-    global g_used_latitude
-    global g_average_latitude
-
-    g_distance_matrix = np.ones((g_number_of_zones, g_number_of_zones)) * 9999  # initialize distance matrix
-
-    if latitude is None:  # use the average latitude according to node.csv
-        if g_average_latitude == 99:
-            logger.warning('Please check y_coord in node.csv! Default latitude is 30 degree!')
-            latitude = 30  # comments: default value if no given latitude
-            flat_length = g_degree_length_dict[latitude]
-            g_used_latitude = latitude
-        else:
-            # match the closest latitude key according to the given latitude
-            dif = float('inf')
-            for i in g_degree_length_dict.keys():
-                if abs(abs(g_average_latitude) - i) < dif:
-                    temp_latitude = i
-                    dif = abs(abs(g_average_latitude) - i)
-                    g_used_latitude = temp_latitude
-            flat_length = g_degree_length_dict[temp_latitude]
-    else:  # use the given latitude
-        # match the closest latitude key according to the given latitude
-        dif = float('inf')
-        for i in g_degree_length_dict.keys():
-            if abs(abs(latitude) - i) < dif:
-                temp_latitude = i
-                dif = abs(abs(latitude) - i)
-                g_used_latitude = temp_latitude
-        flat_length = g_degree_length_dict[temp_latitude]
-
-    print('\nLatitude used for calculating accessibility = ', g_used_latitude)
-    logger.info('Latitude used for calculating accessibility = ' + str(g_used_latitude))
-
-    # define accessibility by calculating straight distance between zone centroids
-    if accessibility_folder:
-        accessibility_filepath = os.path.join(accessibility_folder, 'accessibility.csv')
-    else:
-        accessibility_filepath = 'accessibility.csv'
-
-    o_zone_id_list = []
-    o_zone_name_list = []
-    d_zone_id_list = []
-    d_zone_name_list = []
-    od_distance_list = []
-    od_geometry_list = []
-
-    for o_zone in g_zone_list:
-        for d_zone in g_zone_list:
-            o_zone_id_list.append(o_zone.id)
-            o_zone_name_list.append(o_zone.name)
-            d_zone_id_list.append(d_zone.id)
-            d_zone_name_list.append(d_zone.name)
-            od_geometry_list.append(
-                'LINESTRING (' + str(round(o_zone.centroid_x, 7)) + ' ' + str(round(o_zone.centroid_y, 7))
-                + ',' + str(round(d_zone.centroid_x, 7)) + ' ' + str(round(d_zone.centroid_y, 7)) + ')')
-            distance_km = (((float(o_zone.centroid_x) - float(d_zone.centroid_x)) * flat_length) ** 2 +
-                           ((float(o_zone.centroid_y) - float(d_zone.centroid_y)) * flat_length) ** 2) ** 0.5
-            od_distance_list.append(distance_km)
-            o_zone_index = g_zone_index_dict[o_zone.id]
-            d_zone_index = g_zone_index_dict[d_zone.id]
-            g_distance_matrix[o_zone_index][d_zone_index] = distance_km
-
-    # create accessibility.csv
-    data = pd.DataFrame(o_zone_id_list)
-    print('\nNumber of OD pairs = ', len(o_zone_id_list))
-    logger.info('Number of OD pairs = '+str(len(o_zone_id_list)))
-    data.columns = ["o_zone_id"]
-    data["o_zone_name"] = pd.DataFrame(o_zone_name_list)
-
-    data1 = pd.DataFrame(d_zone_id_list)
-    data['d_zone_id'] = data1
-    data["d_zone_name"] = pd.DataFrame(d_zone_name_list)
-
-    data2 = pd.DataFrame(od_distance_list)
-    data['accessibility'] = data2
-    max_accessibility_index = od_distance_list.index(max(od_distance_list))
-    sum = 0
-    for i in od_distance_list:
-        sum += float(i)
-    print('\nLargest accessibility of distance = '+str(round(od_distance_list[max_accessibility_index],2))+' km')
-    print('Average accessibility of distance = '+str(round(sum/len(od_distance_list),2))+' km')
-    logger.info('Largest accessibility of distance = '+str(round(od_distance_list[max_accessibility_index],2))+' km')
-    logger.info('Average accessibility of distance = '+str(round(sum/len(od_distance_list),2))+' km')
-
-    data3 = pd.DataFrame(od_geometry_list)
-    data['geometry'] = data3
-
-    # print(data)
-    if g_output_folder is not None:
-        accessibility_filepath = os.path.join(g_output_folder, 'accessibility.csv')
-        data.to_csv(accessibility_filepath, index=False, line_terminator='\n')
-    else:
-        data.to_csv('accessibility.csv', index=False, line_terminator='\n')
-    logger.debug("Ending ProduceAccessMatrix")
+        data_list = [zone.shopping_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['shopping_poi_count'] = data1
 
+        data_list = [zone.school_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['school_poi_count'] = data1
 
-"""PART 5  TRIP DISTRIBUTION"""
-g_node_id_list = []
-g_node_zone_id_list = []
-g_node_production_dict = {}
-g_node_attraction_dict = {}
-g_trip_matrix = []
-g_total_production_list = []
-g_total_attraction_list = []
-g_zone_to_nodes_dict = {}
-
-
-def RunGravityModel(trip_purpose=None, a=None, b=None, c=None):
-    logger.debug("Starting RunGravityModel")
-    global g_node_id_list
-    global g_node_production_dict
-    global g_node_attraction_dict
-    global g_trip_matrix
-    global g_output_folder
-
-    if trip_purpose == None:  # default values of friction factor coefficients for Purpose 1 (HBW)
-        if a == None:
-            a = 28507
-        if b == None:
-            b = -0.02
-        if c == None:
-            c = -0.123
-
-        logger.warning('Trip purpose is not defined! Default trip purpose is Purpose 1.')
-        print('\nDefault values of friction factor coefficients under trip purpose 1:', '\na=', a, '\nb=', b,
-              '\nc=', c)
-        logger.info(
-            'Default values of friction factor coefficients under trip purpose 1: \na=' + str(a) + '\nb=' + str(b) +
-            '\nc=' + str(c))
-    if trip_purpose == 1:  # default values of friction factor coefficients for Purpose 1
-        if a == None:
-            a = 28507
-        if b == None:
-            b = -0.02
-        if c == None:
-            c = -0.123
-
-        print('\nDefault values of friction factor coefficients under trip purpose 1:', '\na=', a, '\nb=', b,
-              '\nc=', c)
-        logger.info(
-            'Default values of friction factor coefficients under trip purpose 1: \na=' + str(a) + '\nb=' + str(b) +
-            '\nc=' + str(c))
-    if trip_purpose == 2:  # default values of friction factor coefficients for Purpose 2
-        if a == None:
-            a = 139173
-        if b == None:
-            b = -1.285
-        if c == None:
-            c = -0.094
-
-        print('\nDefault values of friction factor coefficients under trip purpose 2:', '\na=', a, '\nb=', b,
-              '\nc=', c)
-        logger.info(
-            'Default values of friction factor coefficients under trip purpose 2: \na=' + str(a) + '\nb=' + str(b) +
-            '\nc=' + str(c))
-    if trip_purpose == 3:  # default values of friction factor coefficients for Purpose 3
-        if a == None:
-            a = 219113
-        if b == None:
-            b = -1.332
-        if c == None:
-            c = -0.1
-
-        print('\nDefault values of friction factor coefficients under trip purpose 3:', '\na=', a, '\nb=', b,
-              '\nc=', c)
-        logger.info(
-            'Default values of friction factor coefficients under trip purpose 3: \na=' + str(a) + '\nb=' + str(b) +
-            '\nc=' + str(c))
-
-    for node in g_node_list:
-        g_node_production_dict[node.id] = float(node.production)
-        g_node_attraction_dict[node.id] = float(node.attraction)
-        g_node_id_list.append(node.id)
-        g_node_zone_id_list.append(node.zone_id)
-        if node.zone_id != '' and node.zone_id not in g_zone_to_nodes_dict.keys():
-            g_zone_to_nodes_dict[node.zone_id] = list()
-            g_zone_to_nodes_dict[node.zone_id].append(node.id)
-        elif node.zone_id != '':
-            g_zone_to_nodes_dict[node.zone_id].append(node.id)
-
-    g_number_of_nodes = len(g_node_list)
-
-    "deal with multiple nodes within one zone"
-    g_zone_production = np.zeros(g_number_of_zones)
-    g_zone_attraction = np.zeros(g_number_of_zones)
-    error_flag = 0
-    for i in range(g_number_of_nodes):
-        if g_node_list[i].activity_location_tab == 'poi' or g_node_list[i].activity_location_tab == 'boundary' or \
-                g_node_list[i].activity_location_tab == 'residential':
-            node_id = g_node_id_list[i]
-            if g_node_zone_dict.get(node_id) is not None:
-                zone_id = g_node_zone_dict[node_id]
-                zone_index = g_zone_index_dict[zone_id]
-                node_prod = g_node_production_dict[node_id]
-                node_attr = g_node_attraction_dict[node_id]
-                g_zone_production[zone_index] = g_zone_production[zone_index] + node_prod
-                g_zone_attraction[zone_index] = g_zone_attraction[zone_index] + node_attr
-                error_flag += 1
-    if error_flag == 0:
-        # print("There is no node with activity_type = 'poi/residential' or is_boundary = '1'. Please check
-        # node.csv!")
-        logger.error("There is no node with activity_type = 'poi/residential' or is_boundary = '1'. Please check "
-                     "node.csv!")
-        sys.exit(0)
+        data_list = [zone.parking_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['parking_poi_count'] = data1
 
-    for zone in g_zone_list:
-        zone_index = g_zone_index_dict[zone.id]
-        g_total_production_list.append(g_zone_production[zone_index])
-        g_total_attraction_list.append(g_zone_attraction[zone_index])
-
-    "perform the distribution with friction matrix"
-    g_friction_matrix = np.ones((g_number_of_zones, g_number_of_zones)) * 9999  # initialize friction matrix
-    for o_zone in g_zone_list:
-        for d_zone in g_zone_list:
-            o_zone_index = g_zone_index_dict[o_zone.id]
-            d_zone_index = g_zone_index_dict[d_zone.id]
-            od_distance = g_distance_matrix[o_zone_index][d_zone_index]
-            if od_distance != 0:
-                g_friction_matrix[o_zone_index][d_zone_index] = a * (od_distance ** b) * (np.exp(c * od_distance))
+        data_list = [zone.boundary_count for zone in self.zone_list]
+        data1 = pd.DataFrame(data_list)
+        data_zone['boundary_node_count'] = data1
+        return data_zone
+
+    @_ReportStage
+    def RunMultiPurposeGravityModel(self, coefficient_dict=None, chunk_size=None, output_format='csv', geometry=True,
+                                    friction_cutoff=None, doubly_constrained=False, tolerance=0.0001,
+                                    max_iterations=100, stacked=True):
+        # comments: the gravity model is run for each trip purpose of GetMultiPurposeNodeDemand on the distance matrix
+        # of ProduceAccessMatrix, which is converted once and shared by all purposes. coefficient_dict maps a trip
+        # purpose to its (a, b, c), and None or a missing purpose takes the default values as in RunGravityModel
+        # comments: chunk_size, output_format, geometry, friction_cutoff, doubly_constrained, tolerance and
+        # max_iterations are used as in RunGravityModel for all purposes
+        # comments: the friction and trip matrices of each purpose are kept in self.purpose_friction_matrix_list and
+        # self.purpose_trip_matrix_list, and self.trip_matrix is their sum, so GenerateAgentBasedDemand generates the
+        # agents of all purposes
+        # comments: if stacked is True, demand.csv has the volume of each purpose in volume_<purpose> and the volume of
+        # the summed trip matrix in volume, and 'npy' saves the matrices of all purposes to friction_matrix.npy and
+        # trip_matrix.npy of shape (purposes x zones x zones), or in the sparse OD mode to .npz files of the csr
+        # matrices stacked by rows. Otherwise each purpose is written to demand_<purpose>.csv,
+        # friction_matrix_<purpose>.npy and trip_matrix_<purpose>.npy as RunGravityModel does
+        self.logger.debug("Starting RunMultiPurposeGravityModel")
+        if len(self.purpose_list) == 0:
+            self.logger.error('Node demand of multiple trip purposes is not calculated! Please run GetMultiPurposeNodeDemand '
+                              'first.')
+            sys.exit(0)
+        if (not _IsSparse(self.distance_matrix)) and (len(self.distance_matrix) == 0):
+            self.logger.error('Accessibility matrix is not calculated! Please run ProduceAccessMatrix first.')
+            sys.exit(0)
+        if coefficient_dict is None:
+            coefficient_dict = {}
+        distance_matrix = self.distance_matrix if _IsSparse(self.distance_matrix) else \
+            np.asarray(self.distance_matrix, dtype=float)
+        self._UpdateZoneToNodes()
+        zone_production_matrix, zone_attraction_matrix = self._GetZoneProductionAttraction(self.node_production_matrix,
+                                                                                           self.node_attraction_matrix)
+
+        self.purpose_friction_matrix_list = []
+        self.purpose_trip_matrix_list = []
+        for trip_purpose, zone_production, zone_attraction in zip(self.purpose_list, zone_production_matrix,
+                                                                  zone_attraction_matrix):
+            a, b, c = self._GetFrictionFactorCoefficient(trip_purpose, *coefficient_dict.get(trip_purpose,
+                                                                                              (None, None, None)))
+            friction_matrix, trip_matrix = _RunGravityKernel(distance_matrix, zone_production, zone_attraction, a, b, c,
+                                                             friction_cutoff)
+            print('\nFriction factor coefficients under trip purpose ' + str(trip_purpose) + ':', '\na=', a, '\nb=', b,
+                  '\nc=', c)
+            self.logger.info('Friction factor coefficients under trip purpose ' + str(trip_purpose) + ': \na=' + str(a) +
+                             '\nb=' + str(b) + '\nc=' + str(c))
+            if doubly_constrained:
+                zone_attraction[:], number_of_iterations, residual = _BalanceTripMatrix(trip_matrix, zone_production,
+                                                                                        zone_attraction, tolerance,
+                                                                                        max_iterations)
+                print('Number of balancing iterations = ', number_of_iterations)
+                print('Residual of balancing = ', residual)
+                self.logger.info('Number of balancing iterations = ' + str(number_of_iterations))
+                self.logger.info('Residual of balancing = ' + str(residual))
+                if residual > tolerance:
+                    self.logger.warning('Balancing of the trip matrix of trip purpose ' + str(trip_purpose) +
+                                        ' does not converge within ' + str(max_iterations) + ' iterations! Residual = ' +
+                                        str(residual))
+            total_trips = float(trip_matrix.sum())
+            print('Total trips under trip purpose ' + str(trip_purpose) + ' = ', total_trips)
+            self.logger.info('Total trips under trip purpose ' + str(trip_purpose) + ' = ' + str(total_trips))
+            self.purpose_friction_matrix_list.append(friction_matrix)
+            self.purpose_trip_matrix_list.append(trip_matrix)
+
+        # comments: the sparse trip matrices of all purposes keep the stored pairs of the distance matrix, so their
+        # values are added up without changing the pairs
+        if _IsSparse(distance_matrix):
+            self.trip_matrix = scipy.sparse.csr_matrix((np.sum([trip_matrix.data for trip_matrix in
+                                                                self.purpose_trip_matrix_list], axis=0),
+                                                        distance_matrix.indices, distance_matrix.indptr),
+                                                       shape=distance_matrix.shape)
+            volume_matrix_list = [scipy.sparse.csr_matrix((np.ceil(trip_matrix.data).astype(np.int64),
+                                                           trip_matrix.indices, trip_matrix.indptr),
+                                                          shape=trip_matrix.shape)
+                                  for trip_matrix in self.purpose_trip_matrix_list + [self.trip_matrix]]
+        else:
+            self.trip_matrix = np.sum(self.purpose_trip_matrix_list, axis=0)
+            volume_matrix_list = [np.ceil(trip_matrix).astype(np.int64)
+                                  for trip_matrix in self.purpose_trip_matrix_list + [self.trip_matrix]]
+        self.total_production_list = zone_production_matrix.sum(axis=0).tolist()
+        self.total_attraction_list = zone_attraction_matrix.sum(axis=0).tolist()
+        print('\nTotal trips of all trip purposes = ', float(self.trip_matrix.sum()))
+        self.logger.info('Total trips of all trip purposes = ' + str(float(self.trip_matrix.sum())))
+
+        output_format_list = _GetOutputFormatList(output_format, logger=self.logger)
+        if stacked:
+            od_matrix_dict_list = [('demand', dict([('accessibility', self.distance_matrix),
+                                                    ('volume', volume_matrix_list[-1])] +
+                                                   [('volume_' + str(trip_purpose), volume_matrix)
+                                                    for trip_purpose, volume_matrix in
+                                                    zip(self.purpose_list, volume_matrix_list)]))]
+        else:
+            od_matrix_dict_list = [('demand_' + str(trip_purpose), {'accessibility': self.distance_matrix,
+                                                                    'volume': volume_matrix})
+                                   for trip_purpose, volume_matrix in zip(self.purpose_list, volume_matrix_list)]
+        for table_name, od_matrix_dict in od_matrix_dict_list:
+            if 'csv' in output_format_list:
+                self._WriteODTable(os.path.join(self.output_folder or '', table_name + '.csv'), od_matrix_dict,
+                                   chunk_size)
+            if 'parquet' in output_format_list:
+                self._WriteODTable(os.path.join(self.output_folder or '', table_name + '.parquet'), od_matrix_dict,
+                                   chunk_size, 'parquet', geometry)
+        if 'npy' in output_format_list:
+            if stacked and _IsSparse(distance_matrix):
+                self._SaveODMatrix('friction_matrix', scipy.sparse.vstack(self.purpose_friction_matrix_list, 'csr'))
+                self._SaveODMatrix('trip_matrix', scipy.sparse.vstack(self.purpose_trip_matrix_list, 'csr'))
+            elif stacked:
+                self._SaveODMatrix('friction_matrix', np.stack(self.purpose_friction_matrix_list))
+                self._SaveODMatrix('trip_matrix', np.stack(self.purpose_trip_matrix_list))
             else:
-                g_friction_matrix[o_zone_index][d_zone_index] = 0
-
-    "step 1: calculate total attraction for each zone"
-    g_trip_matrix = np.zeros((g_number_of_zones, g_number_of_zones))
-    total_attraction_friction = np.zeros(g_number_of_zones)
-    for i in g_zone_id_list:
-        prod_zone_index = g_zone_index_dict[i]
-        for j in g_zone_id_list:
-            attr_zone_index = g_zone_index_dict[j]
-            total_attraction_friction[prod_zone_index] += g_zone_attraction[attr_zone_index] * \
-                                                          g_friction_matrix[prod_zone_index][attr_zone_index]
-
-    "step 2: update OD matrix"
-    for i in g_zone_id_list:
-        prod_zone_index = g_zone_index_dict[i]
-        for j in g_zone_id_list:
-            attr_zone_index = g_zone_index_dict[j]
-            g_trip_matrix[prod_zone_index][attr_zone_index] = float(
-                g_zone_production[prod_zone_index] * g_zone_attraction[attr_zone_index] *
-                g_friction_matrix[prod_zone_index][attr_zone_index] / max(0.000001,
-                                                                          total_attraction_friction[prod_zone_index]))
-
-
-    # create demand.csv
-    volume_list = []
-    for i in range(len(o_zone_id_list)):
-        od_volume = g_trip_matrix[g_zone_index_dict[o_zone_id_list[i]]][g_zone_index_dict[d_zone_id_list[i]]]
-        volume_list.append(math.ceil(od_volume))
-
-    # By Entai 2021/4/11
-    print('\nTop 10 O-D Volume:')
-    od_id = [i for i in range(0, len(volume_list))]
-    volume_idx=sorted(enumerate(volume_list), key=lambda od_id:od_id[1], reverse = True)
-    for od in range(0,10):
-        index_truple = volume_idx[od]
-        print('Top ' + str(od+1) + ' O/D pair: '+ \
-            'zone ' + str(o_zone_id_list[index_truple[0]]) + '->zone ' + str(d_zone_id_list[index_truple[0]]) + \
-                ', volume = ' + str(volume_idx[od][1]))
-        logger.info('Top ' + str(od+1) + ' O/D pair: '+ \
-            'zone ' + str(o_zone_id_list[index_truple[0]]) + '->zone ' + str(d_zone_id_list[index_truple[0]]) + \
-                ', volume = ' + str(volume_idx[od][1]))
-
-
-    data = pd.DataFrame(o_zone_id_list)
-    data.columns = ["o_zone_id"]
-    data["o_zone_name"] = pd.DataFrame(o_zone_name_list)
-    data["d_zone_id"] = pd.DataFrame(d_zone_id_list)
-    data["d_zone_name"] = pd.DataFrame(d_zone_name_list)
-    data["accessibility"] = pd.DataFrame(od_distance_list)
-    data["volume"] = pd.DataFrame(volume_list)
-    data["geometry"] = pd.DataFrame(od_geometry_list)
-
-    max_OD_index = volume_list.index(max(volume_list))
-    print('\nZone-to-zone OD pair with largest volume is from ' + str(o_zone_name_list[max_OD_index]) + ' to ' +
-          str(d_zone_name_list[max_OD_index]))
-    logger.info('Zone-to-zone OD pair with largest volume is from ' + str(o_zone_name_list[max_OD_index]) + ' to ' +
-          str(d_zone_name_list[max_OD_index]))
-
-    # print(data)
-    if g_output_folder is not None:
-        demand_filepath = os.path.join(g_output_folder, 'demand.csv')
-        data.to_csv(demand_filepath, index=False, line_terminator='\n')
-    else:
-        data.to_csv('demand.csv', index=False, line_terminator='\n')
+                for trip_purpose, friction_matrix, trip_matrix in zip(self.purpose_list,
+                                                                      self.purpose_friction_matrix_list,
+                                                                      self.purpose_trip_matrix_list):
+                    self._SaveODMatrix('friction_matrix_' + str(trip_purpose), friction_matrix)
+                    self._SaveODMatrix('trip_matrix_' + str(trip_purpose), trip_matrix)
+
+        # update zone.csv with total production and attraction of each trip purpose in each zone
+        data_zone = self._GetZoneTable()
+        data_zone['total_production'] = pd.DataFrame(self.total_production_list)
+        data_zone['total_attraction'] = pd.DataFrame(self.total_attraction_list)
+        for trip_purpose, zone_production, zone_attraction in zip(self.purpose_list, zone_production_matrix,
+                                                                  zone_attraction_matrix):
+            data_zone['total_production_' + str(trip_purpose)] = zone_production
+            data_zone['total_attraction_' + str(trip_purpose)] = zone_attraction
+        self._WriteTable('zone', data_zone, [item for item in output_format_list if item in g_table_output_format_list]
+                         or ['csv'], geometry)
+        self.logger.debug("Ending RunMultiPurposeGravityModel")
+
+    @_ReportStage
+    def RunGravityScenarios(self, scenario_list, keep_trip_matrix=True, doubly_constrained=False, tolerance=0.0001,
+                            max_iterations=100):
+        # comments: each scenario is a tuple of (trip_purpose, a, b, c), where None takes the same default value as
+        # in RunGravityModel. The distance matrix of ProduceAccessMatrix and the zone production and attraction are
+        # computed once and shared by all scenarios, and no file is written
+        # comments: the trip matrix of each scenario is kept in its result if keep_trip_matrix is True
+        # comments: doubly_constrained, tolerance and max_iterations are used as in RunGravityModel for all scenarios
+        self.logger.debug("Starting RunGravityScenarios")
+        if (not _IsSparse(self.distance_matrix)) and (len(self.distance_matrix) == 0):
+            self.logger.error('Accessibility matrix is not calculated! Please run ProduceAccessMatrix first.')
+            sys.exit(0)
+        distance_matrix = self.distance_matrix if _IsSparse(self.distance_matrix) else \
+            np.asarray(self.distance_matrix, dtype=float)
+        zone_production, zone_attraction = self._GetZoneProductionAttraction()
+        # comments: log(d) is shared by all scenarios, so each scenario takes one exp of the distance matrix
+        with np.errstate(divide='ignore'):
+            log_distance_matrix = np.log(distance_matrix.data if _IsSparse(distance_matrix) else distance_matrix)
+
+        scenario_result_list = []
+        for trip_purpose, a, b, c in scenario_list:
+            a, b, c = self._GetFrictionFactorCoefficient(trip_purpose, a, b, c)
+            trip_matrix = _RunGravityKernel(distance_matrix, zone_production, zone_attraction, a, b, c,
+                                            log_distance_matrix=log_distance_matrix)[1]
+            if doubly_constrained:
+                number_of_iterations, residual = _BalanceTripMatrix(trip_matrix, zone_production, zone_attraction,
+                                                                    tolerance, max_iterations)[1:]
+            # comments: a sparse trip matrix has the stored pairs of the distance matrix, so their values line up
+            trip_array = trip_matrix.data if _IsSparse(trip_matrix) else trip_matrix
+            distance_array = distance_matrix.data if _IsSparse(distance_matrix) else distance_matrix
+            total_trips = float(trip_array.sum())
+            # comments: pairs without trips are left out of the average distance, as pairs without a path are inf
+            trip_flag = trip_array > 0
+            scenario_result = {'trip_purpose': trip_purpose, 'a': a, 'b': b, 'c': c,
+                               'total_trips': total_trips,
+                               'number_of_agents': int(np.ceil(trip_array).sum()),
+                               'average_distance': float((trip_array[trip_flag] * distance_array[trip_flag]).sum()
+                                                         / total_trips)
+                               if total_trips > 0 else 0}
+            if doubly_constrained:
+                scenario_result['number_of_iterations'] = number_of_iterations
+                scenario_result['residual'] = residual
+            if keep_trip_matrix:
+                scenario_result['trip_matrix'] = trip_matrix
+            scenario_result_list.append(scenario_result)
+            self.logger.debug('Scenario ' + str(len(scenario_result_list)) + ': a=' + str(a) + ', b=' + str(b) +
+                              ', c=' + str(c) + ', total trips = ' + str(total_trips))
+
+        print('\nNumber of gravity model scenarios = ', len(scenario_result_list))
+        self.logger.info('Number of gravity model scenarios = ' + str(len(scenario_result_list)))
+        self.logger.debug("Ending RunGravityScenarios")
+        return scenario_result_list
+
+    def _GetZoneNodeArrays(self):
+        """ get the node indexes of self.node_table grouped by zone, with the start position and number of nodes of each zone """
+        zoned_node_index = np.nonzero(self.node_table.zone_index >= 0)[0]
+        zoned_node_index = zoned_node_index[np.argsort(self.node_table.zone_index[zoned_node_index], kind='stable')]
+        zone_node_count_array = np.bincount(self.node_table.zone_index[zoned_node_index], minlength=self.number_of_zones)
+        zone_node_start_array = np.concatenate(([0], np.cumsum(zone_node_count_array)[:-1]))
+        return zoned_node_index, zone_node_start_array, zone_node_count_array
+
+    def _GetAgentContext(self):
+        """ get the arrays needed to generate agents, which are also sent to each worker process once """
+        zone_node_index, zone_node_start_array, zone_node_count_array = self._GetZoneNodeArrays()
+        node_coord_array = np.full(len(self.node_table), '', dtype=object)
+        node_coord_array[zone_node_index] = [str(round(x_coord, 7)) + ' ' + str(round(y_coord, 7)) for x_coord, y_coord in
+                                             zip(self.node_table.x_coord[zone_node_index].tolist(),
+                                                 self.node_table.y_coord[zone_node_index].tolist())]
+        departure_time_array = np.array(['07' + str(minute).zfill(2) for minute in range(60)] + ['0800'], dtype=object)
+        # comments: the OD pairs with agents are kept in csr form, (indptr, destination zone index, volume), which is
+        # also how the trip matrix of the sparse OD mode is stored
+        if _IsSparse(self.trip_matrix):
+            o_zone_index = np.repeat(np.arange(self.number_of_zones), np.diff(self.trip_matrix.indptr))
+            d_zone_index = self.trip_matrix.indices
+            volume_array = np.ceil(self.trip_matrix.data).astype(np.int64)
+            od_pair_index = np.nonzero(volume_array > 0)[0]
+            o_zone_index, d_zone_index, volume_array = \
+                o_zone_index[od_pair_index], d_zone_index[od_pair_index], volume_array[od_pair_index]
+        else:
+            volume_matrix = np.ceil(self.trip_matrix).astype(np.int64)
+            o_zone_index, d_zone_index = np.nonzero(volume_matrix > 0)
+            volume_array = volume_matrix[o_zone_index, d_zone_index]
+        volume_indptr = np.concatenate(([0], np.cumsum(np.bincount(o_zone_index, minlength=self.number_of_zones))))
+        return (volume_indptr, d_zone_index, volume_array, zone_node_index, zone_node_start_array, zone_node_count_array,
+                self.node_table.id, self.node_table.osm_node_id, node_coord_array, np.array(self.zone_id_list),
+                departure_time_array)
+
+    @_ReportStage
+    def GenerateAgentBasedDemand(self, seed=None, batch_size=None, number_of_workers=None, output_format='csv',
+                                 geometry=True):
+        # comments: output_format is 'csv', 'parquet' or a list of them for input_agent, and the geometry column is
+        # left out of input_agent.parquet if geometry is False
+        self.logger.debug("Starting GenerateAgentBasedDemand")
+        output_format_list = _GetOutputFormatList(output_format, g_table_output_format_list, self.logger)
+        if self.output_folder is not None:
+            agent_filepath = os.path.join(self.output_folder, 'input_agent')
+        else:
+            agent_filepath = 'input_agent'
+        filepath_dict = {output_format: agent_filepath + '.' + output_format for output_format in output_format_list}
+
+        # comments: agents are generated and written batch_size at a time, so memory does not grow with the number
+        # of agents. Each origin zone has its own random streams derived from seed and a contiguous range of agent_id,
+        # so a given seed reproduces input_agent.csv for any batch_size and number_of_workers
+        context = self._GetAgentContext()
+        o_zone_index_list = list(range(self.number_of_zones))
+        seed_sequence_list = np.random.SeedSequence(seed).spawn(self.number_of_zones)
+        volume_indptr, volume_array = context[0], context[2]
+        first_agent_id_list = (np.concatenate(([0], np.cumsum(volume_array)))[volume_indptr[:-1]] + 1).tolist()
+
+        writer_list = _OpenAgentWriters(filepath_dict, geometry, self.logger)
+        try:
+            for output_format, writer in zip(filepath_dict, writer_list):
+                if output_format == 'csv':
+                    writer.write('agent_id,agent_type,o_node_id,d_node_id,o_osm_node_id,d_osm_node_id,o_zone_id,'
+                                 'd_zone_id,geometry,departure_time\r\n')
+            if (number_of_workers is None) or (number_of_workers <= 1):
+                number_of_agents = _WriteZoneAgents(writer_list, context, o_zone_index_list, seed_sequence_list,
+                                                    first_agent_id_list, batch_size)
+            else:
+                # comments: each worker writes the agents of a block of origin zones to shard files, and the shard
+                # files are appended to the agent files in the order of the blocks
+                block_list = [block.tolist() for block in
+                              np.array_split(np.arange(self.number_of_zones), min(self.number_of_zones, number_of_workers * 4))]
+                number_of_agents = 0
+                with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(agent_filepath))) as shard_folder, \
+                        ProcessPoolExecutor(max_workers=number_of_workers, initializer=_InitAgentWorker,
+                                            initargs=(context,)) as executor:
+                    shard_filepath_dict_list = [{output_format: os.path.join(shard_folder, 'input_agent_' + str(i) + '.'
+                                                                             + output_format)
+                                                 for output_format in output_format_list}
+                                                for i in range(len(block_list))]
+                    future_list = [executor.submit(_WriteAgentShard, shard_filepath_dict_list[i], block,
+                                                   [seed_sequence_list[j] for j in block],
+                                                   [first_agent_id_list[j] for j in block], batch_size, geometry)
+                                   for i, block in enumerate(block_list)]
+                    for shard_filepath_dict, future in zip(shard_filepath_dict_list, future_list):
+                        number_of_agents += future.result()
+                        for writer, shard_filepath in zip(writer_list, shard_filepath_dict.values()):
+                            if not os.path.exists(shard_filepath):
+                                continue  # comments: a _ParquetWriter of a block without any agent writes no file
+                            if isinstance(writer, _ParquetWriter):
+                                writer.write_file(shard_filepath)
+                            else:
+                                with open(shard_filepath, 'r', newline='', encoding='gbk') as shard_fp:
+                                    shutil.copyfileobj(shard_fp, writer)
+                            os.remove(shard_filepath)
+        finally:
+            for writer in writer_list:
+                writer.close()
+
+        self.number_of_agents = number_of_agents
+        print('\nNumber of agents = ', number_of_agents)
+        self.logger.info('Number of agents = '+str(number_of_agents))
+        if number_of_agents == 0:
+            print('Empty agent may be caused by empty poi demand. Please check node.csv or poi_trip_rate.csv!')
+            self.logger.warning('Empty agent may be caused by empty poi demand. Please check node.csv or poi_trip_rate.csv!')
+        self.logger.debug("Ending GenerateAgentBasedDemand")
+        # comments: 
+        # Please visit https://github.com/dabreegster/grid2demand/blob/scenario_script/src/demand_to_abst_scenario.py for simulation in AB Street
+
+
+"""FUNCTION API"""
+g_default_model = DemandModel()  # comments: the model used by the module-level functions below
 
-    # update zone.csv with total production and attraction in each zone
-    data_list = [zone.id for zone in g_zone_list]
-    data_zone = pd.DataFrame(data_list)
-    data_zone.columns = ["activity_zone_id"]
 
-    data_zone_name_list = [zone.name for zone in g_zone_list]
-    data1 = pd.DataFrame(data_zone_name_list)
-    data_zone['name'] = data1
+def ReadNetworkFiles(input_folder=None):
+    return g_default_model.ReadNetworkFiles(input_folder)
 
-    data_list = [zone.centroid_x for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['centroid_x'] = data1
 
-    data_list = [zone.centroid_y for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['centroid_y'] = data1
+def PartitionGrid(number_of_x_blocks=None,
+                  number_of_y_blocks=None,
+                  cell_width=None,
+                  cell_height=None,
+                  latitude=None,
+                  connector=True,
+                  cache_folder=None,
+                  update_input_files=True,
+                  output_format='csv',
+                  geometry=True,
+                  distance_method='latitude_table'):
+    return g_default_model.PartitionGrid(number_of_x_blocks, number_of_y_blocks, cell_width, cell_height, latitude,
+                                         connector, cache_folder, update_input_files, output_format, geometry,
+                                         distance_method)
 
-    data_list = [zone.polygon for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['geometry'] = data1
 
-    data_list = [zone.centroid for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['centroid'] = data1
+def GetPoiTripRate(trip_rate_folder=None,
+                   trip_purpose=None,
+                   output_format='csv'):
+    return g_default_model.GetPoiTripRate(trip_rate_folder, trip_purpose, output_format)
 
-    data_list = [zone.poi_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['total_poi_count'] = data1
 
-    data_list = [zone.residential_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['residential_poi_count'] = data1
+def GetNodeDemand(residential_production = None, residential_attraction = None,
+                  boundary_production = None, boundary_attraction = None, update_input_files=True):
+    return g_default_model.GetNodeDemand(residential_production, residential_attraction, boundary_production,
+                                         boundary_attraction, update_input_files)
 
-    data_list = [zone.office_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['office_poi_count'] = data1
 
-    data_list = [zone.shopping_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['shopping_poi_count'] = data1
+def GetMultiPurposeNodeDemand(purpose_list=None, residential_production=None, residential_attraction=None,
+                              boundary_production=None, boundary_attraction=None):
+    return g_default_model.GetMultiPurposeNodeDemand(purpose_list, residential_production, residential_attraction,
+                                                     boundary_production, boundary_attraction)
 
-    data_list = [zone.school_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['school_poi_count'] = data1
 
-    data_list = [zone.parking_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['parking_poi_count'] = data1
+def ProduceAccessMatrix(latitude=None, accessibility_folder=None, chunk_size=None, output_format='csv',
+                        geometry=True, distance_cutoff=None, impedance=None, number_of_workers=None,
+                        cache_folder=None, distance_method='latitude_table', dtype='float64'):
+    return g_default_model.ProduceAccessMatrix(latitude, accessibility_folder, chunk_size, output_format, geometry,
+                                               distance_cutoff, impedance, number_of_workers, cache_folder,
+                                               distance_method, dtype)
 
-    data_list = [zone.boundary_count for zone in g_zone_list]
-    data1 = pd.DataFrame(data_list)
-    data_zone['boundary_node_count'] = data1
 
-    data_zone['total_production'] = pd.DataFrame(g_total_production_list)
-    data_zone['total_attraction'] = pd.DataFrame(g_total_attraction_list)
+def RunGravityModel(trip_purpose=None, a=None, b=None, c=None, chunk_size=None, output_format='csv', geometry=True,
+                    friction_cutoff=None, doubly_constrained=False, tolerance=0.0001, max_iterations=100):
+    return g_default_model.RunGravityModel(trip_purpose, a, b, c, chunk_size, output_format, geometry, friction_cutoff,
+                                           doubly_constrained, tolerance, max_iterations)
 
-    max_prod_o_zone_index = g_total_production_list.index(max(g_total_production_list))
-    max_attr_d_zone_index = g_total_attraction_list.index(max(g_total_attraction_list))
-    print('Origin zone with largest production volume is '+str(data_zone_name_list[max_prod_o_zone_index]))
-    print('Destination zone with largest attraction volume is ' + str(data_zone_name_list[max_attr_d_zone_index]))
-    logger.info('Origin zone with largest production volume is '+str(data_zone_name_list[max_prod_o_zone_index]))
-    logger.info('Destination zone with largest attraction volume is ' + str(data_zone_name_list[max_attr_d_zone_index]))
 
-    # print(data_zone)
+def RunMultiPurposeGravityModel(coefficient_dict=None, chunk_size=None, output_format='csv', geometry=True,
+                                friction_cutoff=None, doubly_constrained=False, tolerance=0.0001, max_iterations=100,
+                                stacked=True):
+    return g_default_model.RunMultiPurposeGravityModel(coefficient_dict, chunk_size, output_format, geometry,
+                                                       friction_cutoff, doubly_constrained, tolerance, max_iterations,
+                                                       stacked)
 
-    if g_output_folder is not None:
-        zone_filepath = os.path.join(g_output_folder, 'zone.csv')
-        data_zone.to_csv(zone_filepath, index=False, line_terminator='\n')
-    else:
-        data_zone.to_csv('zone.csv', index=False, line_terminator='\n')
-    logger.debug("Ending RunGravityModel")
 
+def RunGravityScenarios(scenario_list, keep_trip_matrix=True, doubly_constrained=False, tolerance=0.0001,
+                        max_iterations=100):
+    return g_default_model.RunGravityScenarios(scenario_list, keep_trip_matrix, doubly_constrained, tolerance,
+                                               max_iterations)
 
-"""PART 6  GENERATE AGENT"""
-agent_list = []
 
+def GenerateAgentBasedDemand(seed=None, batch_size=None, number_of_workers=None, output_format='csv', geometry=True):
+    return g_default_model.GenerateAgentBasedDemand(seed, batch_size, number_of_workers, output_format, geometry)
 
-def GenerateAgentBasedDemand():
-    logger.debug("Starting GenerateAgentBasedDemand")
-    global g_output_folder
-    agent_id = 1
-    agent_type = 'v'
-    if g_output_folder is not None:
-        demand_filepath = os.path.join(g_output_folder, 'demand.csv')
-        agent_filepath = os.path.join(g_output_folder, 'input_agent.csv')
-    else:
-        demand_filepath = 'demand.csv'
-        agent_filepath = 'input_agent.csv'
-
-    with open(demand_filepath, 'r', errors='ignore') as fp:
-        reader = csv.DictReader(fp)
-        for line in reader:
-            for i in range(math.ceil(float(line['volume']))):
-                agent = Agent(agent_id,
-                              agent_type,
-                              line['o_zone_id'],
-                              line['d_zone_id'])
-
-                # generate o_node_id and d_node_id randomly according to o_zone_id and d_zone_id
-                agent.o_node_id = choice(g_zone_to_nodes_dict[str(agent.o_zone_id)])
-                agent.d_node_id = choice(g_zone_to_nodes_dict[str(agent.d_zone_id)])
-                agent_list.append(agent)
-                agent_id += 1
-    print('\nNumber of agents = ', len(agent_list))
-    logger.info('Number of agents = '+str(len(agent_list)))
-    if len(agent_list) == 0:
-        print('Empty agent may be caused by empty poi demand. Please check node.csv or poi_trip_rate.csv!')
-        logger.warning('Empty agent may be caused by empty poi demand. Please check node.csv or poi_trip_rate.csv!')
-
-    with open(agent_filepath, 'w', newline='', encoding='gbk') as fp:
-        writer = csv.writer(fp)
-        line = ["agent_id", "agent_type", "o_node_id", "d_node_id", "o_osm_node_id",
-                "d_osm_node_id", "o_zone_id", "d_zone_id", "geometry", "departure_time"]
-        writer.writerow(line)
-        for agent in agent_list:
-            from_node = g_node_id_to_node[agent.o_node_id]
-            to_node = g_node_id_to_node[agent.d_node_id]
-            o_osm_node_id = from_node.osm_node_id
-            d_osm_node_id = to_node.osm_node_id
-            time_stamp = math.ceil(random.uniform(1, 60))
-            if time_stamp == 60:
-                departure_time = "0800"
-            else:
-                if time_stamp < 10:
-                    departure_time = "070" + str(time_stamp)
-                else:
-                    departure_time = "07" + str(time_stamp)
-            geometry = "LINESTRING({0} {1},{2} {3})".format(round(from_node.x_coord, 7), round(from_node.y_coord, 7),
-                                                            round(to_node.x_coord, 7), round(to_node.y_coord, 7))
-            line = [agent.agent_id, agent.agent_type, agent.o_node_id,
-                    agent.d_node_id, o_osm_node_id,
-                    d_osm_node_id, agent.o_zone_id, agent.d_zone_id, geometry, departure_time]
-            writer.writerow(line)
-    logger.debug("Ending GenerateAgentBasedDemand")
-    # comments: 
-    # Please visit https://github.com/dabreegster/grid2demand/blob/scenario_script/src/demand_to_abst_scenario.py for simulation in AB Street
 
+def __getattr__(name):
+    """ g_<name> of the module is the attribute <name> of g_default_model """
+    if name.startswith('g_') and name[2:] in vars(g_default_model):
+        return getattr(g_default_model, name[2:])
+    raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
@@ -0,0 +1,72 @@
+"""Benchmark of ReadNetworkFiles on synthetic poi.csv files of growing size.
+
+Run it from the repository root:
+
+    python tests/benchmark_read_network.py [number_of_pois ...]
+
+The default sizes are 125k, 250k and 500k pois. Each load runs in a fresh interpreter, since ReadNetworkFiles fills
+module globals. The script prints the load time of each size and its time per poi,
+and exits with status 1 if the time per poi of the largest size is more than 1.5 times that of the smallest size,
+i.e. if loading does not grow linearly with the number of rows.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+g_package_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+g_default_size_list = [125000, 250000, 500000]
+g_max_time_ratio = 1.5  # comments: allowed ratio of the time per poi of the largest size to that of the smallest
+g_number_of_repeats = 3  # comments: the fastest of the repeated loads is taken for each size
+
+
+def WriteSyntheticNetwork(folder, number_of_pois, seed=1):
+    """ write node.csv with one poi node per poi and poi.csv with number_of_pois buildings to folder """
+    rng = np.random.default_rng(seed)
+    x_coord = np.round(-77 + rng.random(number_of_pois) * 0.2, 7)
+    y_coord = np.round(38.9 + rng.random(number_of_pois) * 0.2, 7)
+    poi_id = np.arange(number_of_pois)
+    building = rng.choice(['residential', 'office', 'retail', 'school', 'yes'], number_of_pois)
+    pd.DataFrame({'name': '', 'node_id': poi_id, 'osm_node_id': poi_id + 1000000, 'activity_type': 'poi',
+                  'is_boundary': 0, 'x_coord': x_coord, 'y_coord': y_coord,
+                  'poi_id': poi_id}).to_csv(os.path.join(folder, 'node.csv'), index=False)
+    pd.DataFrame({'name': '', 'poi_id': poi_id, 'building': building,
+                  'centroid': 'POINT (' + pd.Series(x_coord).astype(str) + ' ' + pd.Series(y_coord).astype(str) + ')',
+                  'area': np.round(rng.random(number_of_pois) * 5000, 1)}).to_csv(os.path.join(folder, 'poi.csv'),
+                                                                                   index=False)
+
+
+def TimeReadNetworkFiles(folder):
+    """ get the fastest wall time of ReadNetworkFiles on folder over g_number_of_repeats loads """
+    # comments: the child process imports grid2demand before starting the clock and prints the load time only
+    script = ('import sys, time; sys.path.insert(0, sys.argv[1]); import grid2demand as gd; '
+              'start_time = time.perf_counter(); gd.ReadNetworkFiles(sys.argv[2]); '
+              'print(time.perf_counter() - start_time)')
+    time_list = []
+    for _ in range(g_number_of_repeats):
+        result = subprocess.run([sys.executable, '-c', script, g_package_folder, folder], capture_output=True,
+                                text=True, check=True)
+        time_list.append(float(result.stdout.split()[-1]))
+    return min(time_list)
+
+
+def main(size_list):
+    time_per_poi_list = []
+    with tempfile.TemporaryDirectory() as folder:
+        for number_of_pois in size_list:
+            WriteSyntheticNetwork(folder, number_of_pois)
+            load_time = TimeReadNetworkFiles(folder)
+            time_per_poi_list.append(load_time / number_of_pois)
+            print('number_of_pois = ' + str(number_of_pois) + ', load time = ' + str(round(load_time, 3)) +
+                  ' s, time per poi = ' + str(round(load_time / number_of_pois * 1e6, 3)) + ' us')
+    time_ratio = time_per_poi_list[-1] / time_per_poi_list[0]
+    print('ratio of time per poi = ' + str(round(time_ratio, 2)))
+    return 0 if time_ratio <= g_max_time_ratio else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main([int(number_of_pois) for number_of_pois in sys.argv[1:]] or g_default_size_list))
@@ -0,0 +1,84 @@
+"""Network skims of ProduceAccessMatrix(impedance=...) on a small network with a shortcut through a zone centroid.
+
+Run it from the repository root with python -m pytest tests.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+g_package_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, g_package_folder)
+import grid2demand as gd  # noqa: E402
+
+g_flat_length = 111.3  # comments: length (km) of a degree at latitude 0, as in g_degree_length_dict
+g_road_length = 12.0  # comments: length (km) of the road path a -> c1 -> m -> c2 -> d
+
+
+def _WriteNetwork(folder):
+    """ write a road a - c1 - m - c2 - d with activity nodes a, c1, c2 and d and the detour node m """
+    # comments: the grid has 3 zones from west to east, holding a, (c1, c2) and d, and m is not an activity node.
+    # c1 and c2 are joined only by the 10 km detour through m, while the centroid of the middle zone lies between
+    # them, 0.33 km from each, so a path through that centroid would be 2.7 km instead of 12 km
+    pd.DataFrame({'node_id': [1, 2, 3, 4, 5],
+                  'activity_type': ['residential', 'residential', '', 'residential', 'residential'],
+                  'is_boundary': 0,
+                  'x_coord': [0.001, 0.012, 0.015, 0.018, 0.029],
+                  'y_coord': [0.0, 0.0, 0.01, 0.0, 0.0],
+                  'poi_id': ''}).to_csv(os.path.join(folder, 'node.csv'), index=False)
+    pd.DataFrame({'poi_id': [1], 'building': ['yes'], 'centroid': ['POINT (0.015 0.005)'],
+                  'area': [100.0]}).to_csv(os.path.join(folder, 'poi.csv'), index=False)
+    road_list = [(1, 2, 1000), (2, 3, 5000), (3, 4, 5000), (4, 5, 1000)]
+    pd.DataFrame({'link_id': range(2 * len(road_list)),
+                  'from_node_id': [road[0] for road in road_list] + [road[1] for road in road_list],
+                  'to_node_id': [road[1] for road in road_list] + [road[0] for road in road_list],
+                  'length': [road[2] for road in road_list] * 2,
+                  'free_speed': 60}).to_csv(os.path.join(folder, 'link.csv'), index=False)
+
+
+@pytest.fixture
+def network_model(tmp_path):
+    folder = str(tmp_path)
+    _WriteNetwork(folder)
+    with gd.DemandModel() as model:
+        model.ReadNetworkFiles(folder)
+        model.PartitionGrid(number_of_x_blocks=3, number_of_y_blocks=1)
+        yield model
+
+
+def _GetZoneIndex(model, node_id):
+    return model.zone_index_dict[model.node_zone_dict[node_id]]
+
+
+def _GetConnectorLength(model, node_id):
+    """ get the straight distance (km) between a node and the centroid of its zone """
+    zone = model.zone_list[_GetZoneIndex(model, node_id)]
+    node = model.node_id_to_node[node_id]
+    return ((node.x_coord - zone.centroid_x) ** 2 + (node.y_coord - zone.centroid_y) ** 2) ** 0.5 * g_flat_length
+
+
+def test_skim_does_not_pass_through_other_centroids(network_model):
+    model = network_model
+    assert len({_GetZoneIndex(model, node_id) for node_id in [1, 2, 4, 5]}) == 3
+    model.ProduceAccessMatrix(latitude=0, impedance='distance')
+    o_zone_index, d_zone_index = _GetZoneIndex(model, 1), _GetZoneIndex(model, 5)
+    expected_skim = g_road_length + _GetConnectorLength(model, 1) + _GetConnectorLength(model, 5)
+    # comments: zero-length connectors are kept as 1e-9 km edges of the graph
+    np.testing.assert_allclose(model.distance_matrix[o_zone_index, d_zone_index], expected_skim, rtol=1e-9)
+    np.testing.assert_allclose(model.distance_matrix[d_zone_index, o_zone_index], expected_skim, rtol=1e-9)
+    assert (np.diag(model.distance_matrix) == 0).all()
+
+
+def test_sparse_skim_matches_dense_skim(network_model):
+    model = network_model
+    model.ProduceAccessMatrix(latitude=0, impedance='distance')
+    dense_skim_matrix = np.array(model.distance_matrix)
+    model.ProduceAccessMatrix(latitude=0, impedance='distance', distance_cutoff=g_road_length / 2)
+    sparse_skim_matrix = model.distance_matrix.toarray()
+    # comments: the pairs beyond the cutoff, which include the pair of the far ends of the road, are not stored
+    kept_flag = dense_skim_matrix <= g_road_length / 2
+    assert not kept_flag[_GetZoneIndex(model, 1), _GetZoneIndex(model, 5)]
+    assert model.distance_matrix.nnz == kept_flag.sum()
+    np.testing.assert_array_equal(sparse_skim_matrix[kept_flag], dense_skim_matrix[kept_flag])